@@ -0,0 +1,88 @@
+"""
+Measures poll wakeups per second, with a number of idle sockets registered on
+the hub alongside the active ones which are being woken.
+
+    $ python bench/dispatch.py [idle] [active]
+
+The spawn row replays the previous behaviour of spawning a new green thread to
+dispatch every batch of poll events.
+"""
+import resource
+import socket
+import time
+import sys
+
+import vanilla
+import vanilla.poll
+
+
+class SpawnHub(vanilla.Hub):
+    def dispatch_events(self, events):
+        self.spawn(self.send_events, events)
+
+    def send_events(self, events):
+        for fd, mask in events:
+            if fd in self.registered:
+                masks = self.registered[fd]
+                if mask == vanilla.poll.POLLERR:
+                    for sender in masks.values():
+                        sender.close()
+                elif masks[mask].ready:
+                    masks[mask].send(True)
+
+
+def benchmark(name, Hub, idle, active, duration=2):
+    h = Hub()
+    pairs = [socket.socketpair() for _ in range(idle + active)]
+
+    for a, b in pairs[:idle]:
+        a.setblocking(0)
+        h.register(a.fileno(), vanilla.poll.POLLIN)
+
+    wakeups = [0]
+    pending = [0]
+    done = h.pipe()
+
+    def reader(a, ready):
+        for _ in ready:
+            a.recv(4096)
+            wakeups[0] += 1
+            pending[0] -= 1
+            if not pending[0]:
+                done.send(True)
+
+    for a, b in pairs[idle:]:
+        a.setblocking(0)
+        h.spawn(reader, a, h.register(a.fileno(), vanilla.poll.POLLIN))
+
+    h.sleep(1)
+
+    start = time.time()
+    while time.time() - start < duration:
+        pending[0] = active
+        for a, b in pairs[idle:]:
+            b.send(b'x')
+        done.recv()
+    elapsed = time.time() - start
+
+    print('%-10s %8d idle %6d active %12.2f wakeups/s' % (
+        name, idle, active, wakeups[0] / elapsed))
+
+    for a, b in pairs:
+        h.unregister(a.fileno())
+        a.close()
+        b.close()
+
+
+if __name__ == '__main__':
+    idle = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    active = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    # each socket pair needs two descriptors
+    need = (idle + active) * 2 + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < need:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(need, hard), hard))
+
+    benchmark('direct', vanilla.Hub, idle, active)
+    benchmark('spawn', SpawnHub, idle, active)
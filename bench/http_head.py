@@ -0,0 +1,136 @@
+"""
+Measures responses per second through the HTTPServer writer for small
+keep-alive replies, against rendering each head the previous way: the Date
+with strftime, the status line with string formatting and every header
+joined on every reply.
+
+The served figure is end to end: a client process pipelines GETs over one
+keep-alive connection to a real server. It only uses the public API, so it
+can be run against older trees to compare.
+
+    $ python bench/http_head.py [responses]
+"""
+import multiprocessing
+import socket
+import time
+import sys
+
+import vanilla
+import vanilla.http
+
+
+HEADERS = {
+    'Server': 'vanilla',
+    'Content-Type': 'text/plain; charset=utf-8',
+    'Cache-Control': 'no-cache', }
+
+
+BODY = b'Hello, World!'
+REQUEST = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+
+
+class Sender(object):
+    # a sender which throws everything away, so only rendering is measured
+    def write(self, data):
+        pass
+
+    def send(self, data):
+        pass
+
+
+class Socket(object):
+    sender = Sender()
+
+    def send(self, data):
+        pass
+
+
+def formatted(server, status, body):
+    headers = dict(HEADERS)
+    server.socket.sender.write(
+        ('HTTP/1.1 %s %s\r\n' % status).encode('latin-1'))
+    headers.setdefault(
+        'Date',
+        time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()))
+    headers['Content-Length'] = len(body)
+    server.socket.sender.write((''.join(
+        '%s: %s\r\n' % (k, v) for k, v in headers.items()) + '\r\n').encode(
+            'latin-1'))
+    server.socket.send(body)
+
+
+def rendered():
+    block = vanilla.http.HeaderBlock(HEADERS)
+
+    def write(server, status, body):
+        headers = {'Content-Length': len(body)}
+        server.send_head(status, [block], headers, date=False)
+        server.socket.send(body)
+    return write
+
+
+def benchmark(name, n, write):
+    server = vanilla.http.HTTPServer.__new__(vanilla.http.HTTPServer)
+    server.socket = Socket()
+    status = vanilla.http.Status(200)
+
+    start = time.time()
+    for _ in range(n):
+        write(server, status, BODY)
+    elapsed = time.time() - start
+
+    print('%-10s %8d responses %12.2f responses/s' % (name, n, n / elapsed))
+
+
+def client(port, n, results):
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def pipeline():
+        for _ in range(n // 100):
+            conn.sendall(REQUEST * 100)
+
+    start = time.time()
+    ctx = multiprocessing.get_context('fork')
+    sender = ctx.Process(target=pipeline)
+    sender.start()
+    got = 0
+    tail = b''
+    while got < n // 100 * 100:
+        data = tail + conn.recv(65536)
+        got += data.count(BODY)
+        # keep enough of the end to spot a body split across reads
+        tail = b'' if data.endswith(BODY) else data[-len(BODY) + 1:]
+    results.put(time.time() - start)
+    sender.join()
+    conn.close()
+
+
+def served(n):
+    h = vanilla.Hub()
+    server = h.http.listen()
+
+    @server.consume
+    def serve(conn):
+        @h.spawn
+        def _():
+            for request in conn:
+                request.reply(vanilla.http.Status(200), dict(HEADERS), BODY)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    p = ctx.Process(target=client, args=(server.port, n, results))
+    p.start()
+    elapsed = h.thread.call(results.get).recv()
+    p.join()
+
+    print('%-10s %8d responses %12.2f responses/s' % (
+        'served', n, n / elapsed))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    if hasattr(vanilla.http, 'HeaderBlock'):
+        benchmark('formatted', n, formatted)
+        benchmark('rendered', n, rendered())
+    served(n)
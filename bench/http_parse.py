@@ -0,0 +1,69 @@
+"""
+Measures requests per second through RequestParser for a buffer of pipelined
+GET requests, against the previous parser, which read a line at a time and
+split each header line into a Headers object up front.
+
+    $ python bench/http_parse.py [requests]
+"""
+import time
+import sys
+
+import vanilla
+import vanilla.message
+import vanilla.http
+
+
+REQUEST = (
+    b'GET /index.html HTTP/1.1\r\n'
+    b'Host: localhost:8000\r\n'
+    b'User-Agent: vanilla-bench\r\n'
+    b'Accept: text/html,application/xhtml+xml,application/xml\r\n'
+    b'Accept-Language: en-US,en;q=0.5\r\n'
+    b'Accept-Encoding: gzip, deflate\r\n'
+    b'Connection: keep-alive\r\n'
+    b'\r\n')
+
+
+def by_line(recver):
+    method, path, version = recver.recv_line().split(b' ', 2)
+    headers = vanilla.http.Headers()
+    while True:
+        line = recver.recv_line()
+        if not line:
+            break
+        k, v = line.split(b': ', 1)
+        headers[k.decode('latin-1')] = v.strip().decode('latin-1')
+    return method, path, version, headers
+
+
+def parser(recver):
+    return vanilla.http.RequestParser(recver).recv
+
+
+def benchmark(name, n, make):
+    h = vanilla.Hub()
+    sender, recver = h.pipe()
+    recver = vanilla.message.Stream(recver, sep=b'\r\n')
+    data = REQUEST * n
+
+    @h.spawn
+    def _():
+        # arrive in socket sized reads
+        for i in range(0, len(data), 65536):
+            sender.send(data[i:i + 65536])
+
+    recv = make(recver)
+    start = time.time()
+    for _ in range(n):
+        method, path, version, headers = recv()
+        # handlers typically look at a header or two
+        headers.get('Host')
+    elapsed = time.time() - start
+
+    print('%-10s %8d requests %12.2f requests/s' % (name, n, n / elapsed))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    benchmark('by line', n, lambda recver: lambda: by_line(recver))
+    benchmark('parser', n, parser)
@@ -0,0 +1,53 @@
+"""
+Measures the memory used per Pipe, and send/recv throughput over a Pipe.
+
+    $ python bench/pipe.py [pipes] [messages]
+"""
+import tracemalloc
+import time
+import gc
+import sys
+
+import vanilla
+
+
+def memory(n):
+    h = vanilla.Hub()
+
+    start = time.time()
+    pipes = [h.pipe() for _ in range(n)]
+    elapsed = time.time() - start
+    del pipes
+    gc.collect()
+
+    tracemalloc.start()
+    pipes = [h.pipe() for _ in range(n)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del pipes
+
+    print('%-10s %8d pipes %10.2f MB %8.1f bytes/pipe %12.2f pipes/s' % (
+        'create', n, size / 1024.0**2, size / float(n), n / elapsed))
+
+
+def throughput(n):
+    h = vanilla.Hub()
+    sender, recver = h.pipe()
+
+    @h.spawn
+    def _():
+        for i in range(n):
+            sender.send(i)
+
+    start = time.time()
+    for i in range(n):
+        recver.recv()
+    elapsed = time.time() - start
+    print('%-10s %8d items %31.2f items/s' % ('send/recv', n, n / elapsed))
+
+
+if __name__ == '__main__':
+    pipes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    memory(pipes)
+    throughput(messages)
@@ -0,0 +1,68 @@
+"""
+Measures the latency of starting a worker process and hearing back from it,
+with hub.process.spawn, which execs a fresh interpreter for each worker,
+against a Zygote, which forks workers from a template process. Each worker is
+passed *size* bytes of arguments.
+
+    $ python bench/process_spawn.py [n] [size]
+"""
+import time
+import sys
+
+import vanilla
+
+
+def worker(data):
+    import sys
+    sys.stdout.write('%s\n' % len(data))
+    return len(data)
+
+
+def finish(child):
+    child.done.recv()
+    # read to the end, so the pipes close themselves
+    for stream in (child.stdout, child.stderr):
+        for _ in stream:
+            pass
+
+
+def report(name, latencies):
+    latencies.sort()
+    print('%-8s %8.2f ms mean %8.2f ms p50 %8.2f ms p99' % (
+        name,
+        sum(latencies) / len(latencies) * 1000,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def execv(h, n, data):
+    latencies = []
+    for _ in range(n):
+        start = time.time()
+        child = h.process.spawn(worker, data)
+        assert int(child.stdout.recv_partition(b'\n')) == len(data)
+        latencies.append(time.time() - start)
+        finish(child)
+    report('execv', latencies)
+
+
+def zygote(h, n, data):
+    zygote = h.process.zygote()
+    latencies = []
+    for _ in range(n):
+        start = time.time()
+        child = zygote.spawn(worker, data)
+        assert child.result.recv() == len(data)
+        latencies.append(time.time() - start)
+        finish(child)
+    zygote.close()
+    report('zygote', latencies)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    h = vanilla.Hub()
+    data = 'x' * size
+    execv(h, n, data)
+    zygote(h, n, data)
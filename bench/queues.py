@@ -0,0 +1,75 @@
+"""
+Compares items per second through a buffered Queue against the previous
+Queue, which ran a green thread to shuttle items between two Pipes.
+
+    $ python bench/queues.py [items] [size]
+"""
+import collections
+import time
+import sys
+
+import vanilla
+import vanilla.exception
+import vanilla.message
+
+
+def greenlet_queue(hub, size):
+    # the previous implementation of vanilla.message.Queue
+    def main(upstream, downstream, size):
+        queue = collections.deque()
+
+        while True:
+            if downstream.halted:
+                upstream.close()
+                return
+
+            watch = []
+            if queue:
+                watch.append(downstream)
+            else:
+                if upstream.halted:
+                    downstream.close()
+                    return
+
+            if not upstream.halted and len(queue) < size:
+                watch.append(upstream)
+
+            try:
+                ch, item = hub.select(watch)
+            except vanilla.exception.Halt:
+                continue
+
+            if ch == upstream:
+                queue.append(item)
+
+            elif ch == downstream:
+                item = queue.popleft()
+                downstream.send(item)
+
+    upstream = hub.pipe()
+    downstream = hub.pipe()
+    hub.spawn(main, upstream.recver, downstream.sender, size)
+    return vanilla.message.Pair(upstream.sender, downstream.recver)
+
+
+def benchmark(name, make, n, size):
+    h = vanilla.Hub()
+    sender, recver = make(h, size)
+
+    @h.spawn
+    def _():
+        for i in range(n):
+            sender.send(i)
+
+    start = time.time()
+    for i in range(n):
+        recver.recv()
+    elapsed = time.time() - start
+    print('%-10s size %6d %12.2f items/s' % (name, size, n / elapsed))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    benchmark('greenlet', greenlet_queue, n, size)
+    benchmark('buffer', vanilla.message.Queue, n, size)
@@ -0,0 +1,65 @@
+"""
+Measures echo server throughput as hubs are added to a Runtime. Each hub
+listens on the same port with SO_REUSEPORT. The load comes from separate
+client processes, each holding a connection and doing round trips for a few
+seconds.
+
+    $ python bench/runtime_echo.py [clients] [seconds]
+"""
+import multiprocessing
+import socket
+import time
+import sys
+
+import vanilla
+
+
+MESSAGE = b'x' * 64
+
+
+def client(port, seconds, results):
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    n = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        conn.sendall(MESSAGE)
+        got = 0
+        while got < len(MESSAGE):
+            got += len(conn.recv(65536))
+        n += 1
+    conn.close()
+    results.put(n)
+
+
+def echo(hub, conn):
+    for data in conn.recver:
+        conn.send(data)
+
+
+def benchmark(hubs, clients, seconds):
+    h = vanilla.Hub()
+    runtime = h.thread.runtime(hubs)
+    port = runtime.listen(echo)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=client, args=(port, seconds, results))
+        for _ in range(clients)]
+    for p in procs:
+        p.start()
+    total = sum(results.get() for _ in procs)
+    for p in procs:
+        p.join()
+    runtime.stop()
+
+    print('%2d hubs %4d clients %12.2f echoes/s' % (
+        hubs, clients, total / float(seconds)))
+
+
+if __name__ == '__main__':
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    for hubs in (1, 2, 4):
+        benchmark(hubs, clients, seconds)
@@ -0,0 +1,43 @@
+"""
+Compares spawn throughput with the hub's greenlet pool on and off.
+
+    $ python bench/spawn.py [n]
+"""
+import time
+import sys
+
+import vanilla
+
+
+def benchmark(name, n, **kw):
+    h = vanilla.Hub(**kw)
+    done = h.pipe()
+    count = [0]
+
+    def task():
+        count[0] += 1
+
+    def short():
+        # spawn in small batches so the pool gets a chance to be reused
+        for i in range(n // 100):
+            for _ in range(100):
+                h.spawn(task)
+            h.sleep(0)
+        done.send(True)
+
+    start = time.time()
+    h.spawn(short)
+    done.recv()
+    elapsed = time.time() - start
+
+    assert count[0] == n // 100 * 100
+    line = '%-10s %12.2f spawns/s' % (name, count[0] / elapsed)
+    if h.pool is not None:
+        line += '  %(hits)d hits %(misses)d misses' % h.pool.stats()
+    print(line)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    benchmark('no pool', n)
+    benchmark('pool', n, pool=256)
@@ -0,0 +1,40 @@
+"""
+Measures Stream.recv_n and Stream.recv_line throughput as the size of the
+message grows, while it arrives in small chunks.
+
+    $ python bench/stream.py [chunk]
+"""
+import time
+import sys
+
+import vanilla
+import vanilla.message
+
+
+def benchmark(name, size, chunk, recv):
+    h = vanilla.Hub()
+    sender, recver = h.pipe()
+    recver = vanilla.message.Stream(recver)
+
+    data = b'x' * (size - 1) + b'\n'
+
+    @h.spawn
+    def _():
+        for i in range(0, size, chunk):
+            sender.send(data[i:i + chunk])
+
+    start = time.time()
+    got = recv(recver, size)
+    elapsed = time.time() - start
+    assert len(got) >= size - 1
+
+    print('%-10s %10d bytes %8d chunks %12.2f MB/s' % (
+        name, size, size // chunk, size / elapsed / 1024.0**2))
+
+
+if __name__ == '__main__':
+    chunk = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    for size in (2**16, 2**20, 2**24):
+        benchmark('recv_n', size, chunk, lambda r, n: r.recv_n(n))
+    for size in (2**16, 2**20, 2**24):
+        benchmark('recv_line', size, chunk, lambda r, n: r.recv_line())
@@ -0,0 +1,64 @@
+"""
+Measures messages per second from a worker thread to a hub over
+hub.thread.pipe, against the previous pipe, which wrote a byte to an os.pipe
+for every message.
+
+    $ python bench/thread_pipe.py [messages]
+"""
+import collections
+import threading
+import time
+import sys
+import os
+
+import vanilla
+import vanilla.message
+
+
+def bytewise(hub):
+    class Sender:
+        def __init__(self, q, w):
+            self.q = q
+            self.w = w
+
+        def send(self, item, timeout=-1):
+            self.q.append(item)
+            os.write(self.w, b'\x01')
+
+    r, w = os.pipe()
+    q = collections.deque()
+    sender = Sender(q, w)
+    r = hub.io.fd_in(r)
+
+    @r.pipe
+    def recver(r, out):
+        for s in r:
+            for _ in s:
+                out.send(q.popleft())
+
+    return vanilla.message.Pair(sender, recver)
+
+
+def benchmark(name, n, make):
+    h = vanilla.Hub()
+    sender, recver = make(h)
+
+    def producer():
+        for i in range(n):
+            sender.send(i)
+
+    start = time.time()
+    t = threading.Thread(target=producer)
+    t.start()
+    for _ in range(n):
+        recver.recv()
+    elapsed = time.time() - start
+    t.join()
+
+    print('%-10s %8d messages %12.2f messages/s' % (name, n, n / elapsed))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    benchmark('bytewise', n, bytewise)
+    benchmark('batched', n, lambda h: h.thread.pipe())
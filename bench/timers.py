@@ -0,0 +1,34 @@
+"""
+Compares the Wheel and Scheduler timer structures on the pattern timeouts
+mostly follow: a short timeout is armed and then cancelled before it fires,
+while many long timeouts sit idle. The hub asks for the time to the next
+timer on every pass of its loop, so that's included in each operation.
+
+    $ python bench/timers.py [idle] [n]
+"""
+import time
+import sys
+
+import vanilla.core
+
+
+def benchmark(name, scheduler, idle, n):
+    s = scheduler()
+    for i in range(idle):
+        s.add(60000 + i, None)
+
+    start = time.time()
+    for _ in range(n):
+        item = s.add(50, None)
+        s.timeout()
+        s.remove(item)
+        s.timeout()
+    elapsed = time.time() - start
+    print('%-10s %12.2f arm/cancel per second' % (name, n / elapsed))
+
+
+if __name__ == '__main__':
+    idle = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    benchmark('Scheduler', vanilla.core.Scheduler, idle, n)
+    benchmark('Wheel', vanilla.core.Wheel, idle, n)
@@ -0,0 +1,46 @@
+"""
+Measures WebSocket messages per second across a local socketpair, from a
+client to a server, for a range of message sizes. Messages larger than the
+fragment size go out as several frames.
+
+    $ python bench/websocket_messages.py [messages]
+"""
+import socket
+import time
+import sys
+import os
+
+import vanilla
+import vanilla.http
+
+
+def benchmark(size, n, fragment=vanilla.http.WebSocket.FRAGMENT):
+    h = vanilla.Hub()
+    a, b = socket.socketpair()
+    client = vanilla.http.WebSocket(h, h.io.socket(a), fragment=fragment)
+    server = vanilla.http.WebSocket(
+        h, h.io.socket(b), is_client=False, fragment=fragment)
+
+    message = os.urandom(size)
+
+    @h.spawn
+    def _():
+        for _ in range(n):
+            client.send(message)
+
+    start = time.time()
+    for _ in range(n):
+        server.recv()
+    elapsed = time.time() - start
+
+    print('%10d bytes %8d fragment %8d messages %12.2f messages/s' % (
+        size, fragment, n, n / elapsed))
+    h.stop()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for size in (16, 1024, 65536):
+        benchmark(size, n)
+    benchmark(2**20, max(1, n // 100))
+    benchmark(2**20, max(1, n // 100), fragment=65536)
@@ -0,0 +1,51 @@
+"""
+Measures small-message write throughput over a local socketpair, flushing
+after every message versus coalescing batches of messages into one write.
+
+    $ python bench/write.py [messages] [size]
+"""
+import socket
+import time
+import sys
+
+import vanilla
+
+
+def benchmark(name, n, size, batch):
+    h = vanilla.Hub()
+    a, b = socket.socketpair()
+    sender = h.io.socket(a).sender
+    recver = h.io.socket(b).recver
+
+    message = b'x' * size
+    done = h.pipe()
+
+    @h.spawn
+    def _():
+        got = 0
+        while got < n * size:
+            got += len(recver.recv())
+        done.send(True)
+
+    start = time.time()
+    for i in range(n):
+        sender.write(message)
+        if i % batch == batch - 1:
+            sender.flush()
+    sender.flush()
+    done.recv()
+    elapsed = time.time() - start
+
+    print('%-10s %8d x %4d bytes %12.2f messages/s' % (
+        name, n, size, n / elapsed))
+
+    a.close()
+    b.close()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    benchmark('send', n, size, 1)
+    benchmark('batch 16', n, size, 16)
+    benchmark('batch 256', n, size, 256)
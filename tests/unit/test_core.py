@@ -1,7 +1,13 @@
+import socket
+import random
+import threading
 import time
 
+import pytest
+
 import vanilla
 import vanilla.core
+import vanilla.poll
 
 
 def test_lazy():
@@ -42,6 +48,133 @@ def test_Scheduler():
     assert not s
 
 
+def test_Wheel():
+    s = vanilla.core.Wheel()
+    s.add(4, 'f2')
+    s.add(9, 'f4')
+    s.add(3, 'f1')
+    item3 = s.add(7, 'f3')
+
+    assert 0.003 - s.timeout() < 0.001
+    assert len(s) == 4
+
+    s.remove(item3)
+    assert 0.003 - s.timeout() < 0.001
+    assert len(s) == 3
+
+    assert s.pop() == ('f1', ())
+    assert 0.004 - s.timeout() < 0.001
+    assert len(s) == 2
+
+    assert s.pop() == ('f2', ())
+    assert 0.009 - s.timeout() < 0.001
+    assert len(s) == 1
+
+    assert s.pop() == ('f4', ())
+    assert not s
+
+
+def test_Wheel_cascade():
+    s = vanilla.core.Wheel()
+    # spread items across every level of the wheel
+    delays = [2**40, 5, 2**30, 300, 2**20, 20000, 2**14, 2**8, 0]
+    items = dict((delay, s.add(delay, delay)) for delay in delays)
+
+    s.remove(items[20000])
+    s.remove(items[2**30])
+    # removing twice is a no-op
+    s.remove(items[2**30])
+    assert len(s) == 7
+
+    got = []
+    while s:
+        got.append(s.pop()[0])
+    assert got == [0, 5, 2**8, 300, 2**14, 2**20, 2**40]
+
+
+def test_Wheel_expired_next():
+    s = vanilla.core.Wheel(clock=lambda: 1000.0)
+    s.add(0, 'x')
+    s.add(256, 'a')
+    assert s.pop() == ('x', ())
+    s.timeout()
+    s.add(0, 'z')
+    assert s.pop() == ('z', ())
+    assert abs(s.timeout() - 0.256) < 1e-9
+    assert s.pop() == ('a', ())
+    assert not s
+
+
+def test_Wheel_cancel():
+    s = vanilla.core.Wheel(clock=lambda: 1000.0)
+    idle = [s.add(60000 + i, i) for i in range(1000)]
+
+    # the cached earliest item on the lower level is replaced, and the
+    # level holding the idle items still knows its earliest
+    for _ in range(100):
+        item = s.add(50, 'short')
+        assert abs(s.timeout() - 0.05) < 1e-9
+        s.remove(item)
+        assert abs(s.timeout() - 60.0) < 1e-9
+
+    s.remove(idle[0])
+    assert abs(s.timeout() - 60.001) < 1e-9
+    assert s.pop() == (1, ())
+    assert len(s) == 998
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_Wheel_matches_Scheduler(seed):
+    rand = random.Random(seed)
+    now = [1000.0]
+
+    def clock():
+        return now[0]
+
+    wheel = vanilla.core.Wheel(clock=clock)
+    heap = vanilla.core.Scheduler(clock=clock)
+    items = []
+
+    for _ in range(500):
+        op = rand.random()
+        if op < 0.4:
+            delay = rand.choice([0, 1, rand.random() * 10,
+                                 rand.randint(0, 300), rand.randint(0, 10**5)])
+            name = len(items)
+            items.append((wheel.add(delay, name), heap.add(delay, name)))
+        elif op < 0.55 and items:
+            w, h = items.pop(rand.randrange(len(items)))
+            if h not in heap.removed and h in heap.queue:
+                wheel.remove(w)
+                heap.remove(h)
+        elif op < 0.8 and heap:
+            assert abs(wheel.timeout() - heap.timeout()) < 1e-9
+            assert wheel.pop() == heap.pop()
+        else:
+            now[0] += rand.choice([0, 0.0001, 0.001, rand.random()])
+        assert len(wheel) == len(heap)
+
+    while heap:
+        assert wheel.pop() == heap.pop()
+    assert not wheel
+
+
+def test_Scheduler_clock():
+    now = [100.0]
+    s = vanilla.core.Scheduler(clock=lambda: now[0])
+    s.add(10, 'f1')
+    assert abs(s.timeout() - 0.01) < 1e-9
+    # a wall clock jump has no effect as the clock is injected
+    now[0] += 0.005
+    assert abs(s.timeout() - 0.005) < 1e-9
+
+    # items due at the same time are popped in the order they were added
+    now[0] = 100.0
+    s.add(10, 'f2')
+    s.add(10, 'f3')
+    assert [s.pop()[0] for _ in range(3)] == ['f1', 'f2', 'f3']
+
+
 class TestHub(object):
     def test_spawn(self):
         h = vanilla.Hub()
@@ -77,3 +210,115 @@ class TestHub(object):
             h.sleep(20)
 
         h.stop()
+
+    def test_now(self):
+        h = vanilla.Hub()
+        start = h.now()
+        time.sleep(0.01)
+        # now is cached until the loop next runs
+        assert h.now() == start
+        h.sleep(10)
+        assert h.now() - start >= 0.01
+
+    def test_now_after_sleep(self):
+        h = vanilla.Hub()
+        took = []
+
+        def f():
+            start = time.time()
+            h.sleep(50)
+            took.append(time.time() - start)
+
+        # the hub sleeps until f is due, timers armed by f mustn't be
+        # computed from the time before that sleep
+        h.spawn_later(50, f)
+        h.sleep(150)
+        assert took[0] >= 0.045
+
+    def test_pulse(self):
+        h = vanilla.Hub()
+        recver = h.pulse(10, 'tick')
+        start = h.now()
+        for _ in range(5):
+            assert recver.recv() == 'tick'
+        assert 0.04 <= h.now() - start < 0.1
+        recver.close()
+
+    def test_dispatch_events(self):
+        h = vanilla.Hub()
+        a, b = socket.socketpair()
+        a.setblocking(0)
+        ready = h.register(a.fileno(), vanilla.poll.POLLIN)
+
+        b.send(b'1')
+        assert ready.recv() is True
+        assert a.recv(10) == b'1'
+
+        # a hang up wakes the recver and then closes the registered pipes
+        b.close()
+        assert ready.recv() is True
+        pytest.raises(vanilla.Closed, ready.recv)
+        h.unregister(a.fileno())
+        a.close()
+
+    def test_now_after_poll(self):
+        h = vanilla.Hub()
+        a, b = socket.socketpair()
+        a.setblocking(0)
+        ready = h.register(a.fileno(), vanilla.poll.POLLIN)
+
+        # the hub waits in poll until the send, timers armed once we're woken
+        # mustn't be computed from the time before that wait
+        threading.Timer(0.1, b.send, [b'1']).start()
+        assert ready.recv() is True
+        start = time.time()
+        pytest.raises(vanilla.Timeout, ready.recv, timeout=50)
+        assert time.time() - start >= 0.045
+        h.unregister(a.fileno())
+        a.close()
+        b.close()
+
+    def test_pool(self):
+        h = vanilla.Hub(pool=2)
+        a = []
+
+        def raiser():
+            raise Exception()
+
+        for i in range(3):
+            h.spawn(a.append, i)
+        h.spawn(raiser)
+        h.sleep(1)
+        assert a == [0, 1, 2]
+        # each task finished before the next was run, so one greenlet ran all
+        # four
+        assert h.pool.stats() == {
+            'size': 2, 'free': 1, 'hits': 3, 'misses': 1}
+
+        # pooled greenlets can block and be resumed
+        p = h.dealer()
+        for i in range(4):
+            h.spawn(lambda: a.append(p.recv()))
+        h.sleep(1)
+        for i in range(4):
+            p.send(i)
+        assert a == [0, 1, 2, 0, 1, 2, 3]
+        assert h.pool.stats() == {
+            'size': 2, 'free': 2, 'hits': 4, 'misses': 4}
+
+    def test_wheel(self):
+        h = vanilla.Hub(scheduler=vanilla.core.Wheel)
+        a = []
+
+        h.spawn_later(10, lambda: a.append(1))
+        h.spawn(lambda: a.append(2))
+
+        h.sleep(1)
+        assert a == [2]
+
+        h.sleep(10)
+        assert a == [2, 1]
+
+        p = h.pipe()
+        pytest.raises(vanilla.Timeout, p.recv, timeout=5)
+        assert not h.scheduled
@@ -1,10 +1,15 @@
+import socket
+import struct
 import json
+import time
 import gc
+import os
 
 import pytest
 
 import vanilla
 
+import vanilla.message
 import vanilla.http
 
 
@@ -23,7 +28,8 @@ class TestHTTP(object):
         def _():
             conn = serve.recv()
             for request in conn:
-                request.reply(vanilla.http.Status(200), {}, request.path)
+                request.reply(
+                    vanilla.http.Status(200), {}, request.path.encode())
 
         uri = 'http://localhost:%s' % serve.port
         conn = h.http.connect(uri)
@@ -31,12 +37,12 @@ class TestHTTP(object):
         response = conn.get('/')
         response = response.recv()
         assert response.status.code == 200
-        assert response.consume() == '/'
+        assert response.consume() == b'/'
         assert response.headers['Date']
 
         response = conn.get('/toby').recv()
         assert response.status.code == 200
-        assert response.consume() == '/toby'
+        assert response.consume() == b'/toby'
         h.stop()
         assert not h.registered
 
@@ -52,12 +58,12 @@ class TestHTTP(object):
                 sender, recver = h.pipe()
                 request.reply(vanilla.http.Status(200), {}, recver)
 
-                for i in xrange(3):
+                for i in range(3):
                     h.sleep(10)
-                    sender.send(str(i))
+                    sender.send(str(i).encode())
 
                 if len(request.path) > 1:
-                    sender.send(request.path[1:])
+                    sender.send(request.path[1:].encode())
 
                 sender.close()
 
@@ -66,14 +72,52 @@ class TestHTTP(object):
 
         response = conn.get('/').recv()
         assert response.status.code == 200
-        assert list(response.body) == ['0', '1', '2']
+        assert list(response.body) == [b'0', b'1', b'2']
 
         response = conn.get('/peace').recv()
         assert response.status.code == 200
-        assert list(response.body) == ['0', '1', '2', 'peace']
+        assert list(response.body) == [b'0', b'1', b'2', b'peace']
         h.stop()
         assert not h.registered
 
+    def test_get_compressed(self):
+        h = vanilla.Hub()
+
+        serve = h.http.listen(compress=True)
+        want = json.dumps(
+            [{'id': i, 'name': 'toby'} for i in range(1000)]).encode()
+
+        @h.spawn
+        def _():
+            conn = serve.recv()
+            for request in conn:
+                if request.path == '/big':
+                    request.reply(vanilla.http.Status(200), {}, want * 20)
+                    continue
+                sender, recver = h.pipe()
+                request.reply(vanilla.http.Status(200), {}, recver)
+                for i in range(3):
+                    sender.send(str(i).encode())
+                sender.close()
+
+        uri = 'http://localhost:%s' % serve.port
+        conn = h.http.connect(uri)
+
+        response = conn.get('/').recv()
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.consume() == b'012'
+
+        response = conn.get('/big').recv()
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert int(response.headers['Content-Length']) < len(want)
+        assert response.consume() == want * 20
+
+        response = conn.get('/', headers={'Accept-Encoding': 'identity'})
+        response = response.recv()
+        assert 'Content-Encoding' not in response.headers
+        assert list(response.body) == [b'0', b'1', b'2']
+        h.stop()
+
     def test_post(self):
         h = vanilla.Hub()
 
@@ -90,17 +134,14 @@ class TestHTTP(object):
 
         response = conn.post('/').recv()
         assert response.status.code == 200
-        assert response.consume() == ''
+        assert response.consume() == b''
 
-        response = conn.post('/', data='toby').recv()
+        response = conn.post('/', data=b'toby').recv()
         assert response.status.code == 200
-        assert response.consume() == 'toby'
+        assert response.consume() == b'toby'
         h.stop()
 
-    @pytest.mark.skipif(True, reason='TODO')
     def test_post_chunked(self):
-        print
-        print
         h = vanilla.Hub()
 
         serve = h.http.listen()
@@ -122,17 +163,74 @@ class TestHTTP(object):
 
         @h.spawn
         def _():
-            for i in xrange(3):
-                sender.send(str(i))
+            for i in range(3):
+                sender.send(str(i).encode())
                 h.sleep(10)
             sender.close()
 
         response = conn.post('/', data=recver).recv()
+        assert list(response.body) == [b'0', b'1', b'2']
+        h.stop()
+
+    def test_post_streamed(self):
+        h = vanilla.Hub()
+
+        serve = h.http.listen(max_body=10)
+        client = h.tcp.connect(serve.port)
+        client.send(
+            b'POST /a HTTP/1.1\r\nContent-Length: 6\r\n\r\nfoobar'
+            b'POST /b HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'3\r\nfoo\r\n3;x=y\r\nbar\r\n0\r\n\r\n'
+            b'POST /c HTTP/1.1\r\nContent-Length: 6\r\n\r\nfoobar'
+            b'POST /d HTTP/1.1\r\nContent-Length: 11\r\n\r\n')
+
+        conn = serve.recv()
+
+        # nothing is read until the body is asked for
+        request = conn.recv()
+        assert request.path == '/a'
+        h.sleep(10)
+        assert conn.socket.recver.buffer.startswith(b'foobar')
+        assert request.consume() == b'foobar'
+
+        request = conn.recv()
+        assert request.path == '/b'
+        assert list(request.body) == [b'foo', b'bar']
 
-        for data in response.body:
-            print data
+        # an unread body is skipped over
+        request = conn.recv()
+        assert request.path == '/c'
+
+        e = pytest.raises(vanilla.BadRequest, conn.recv)
+        assert e.value.status == 413
+        h.stop()
+
+    def test_post_invalid(self):
+        h = vanilla.Hub()
+        serve = h.http.listen()
 
-        # h.stop()
+        # the bad length is refused, rather than reading the next request
+        # as part of the body
+        for length in (b'-5', b'abc'):
+            client = h.tcp.connect(serve.port)
+            client.send(
+                b'POST /a HTTP/1.1\r\nContent-Length: %s\r\n\r\n'
+                b'GET /b HTTP/1.1\r\n\r\n' % length)
+            conn = serve.recv()
+            e = pytest.raises(vanilla.BadRequest, conn.recv)
+            assert e.value.status == 400
+            assert client.recv_line().startswith(b'HTTP/1.1 400 ')
+
+        client = h.tcp.connect(serve.port)
+        client.send(
+            b'POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'-1\r\nfoo\r\n0\r\n\r\nGET /b HTTP/1.1\r\n\r\n')
+        conn = serve.recv()
+        request = conn.recv()
+        e = pytest.raises(vanilla.BadRequest, request.consume)
+        assert e.value.status == 400
+        pytest.raises(vanilla.Closed, conn.recv)
+        h.stop()
 
     def test_post_form_encoded(self):
         h = vanilla.Hub()
@@ -147,7 +245,7 @@ class TestHTTP(object):
         request = conn.recv()
         assert request.form == {'k1': 'v1', 'k2': 'v2'}
         assert request.form_multi == {'k1': ['v1'], 'k2': ['v2']}
-        request.reply(vanilla.http.Status(200), {}, '')
+        request.reply(vanilla.http.Status(200), {}, b'')
 
         response = response.recv()
         assert response.status.code == 200
@@ -166,18 +264,18 @@ class TestHTTP(object):
                 request.reply(
                     vanilla.http.Status(200),
                     {},
-                    request.method+request.consume())
+                    request.method.encode() + request.consume())
 
         uri = 'http://localhost:%s' % serve.port
         conn = h.http.connect(uri)
 
         response = conn.put('/').recv()
         assert response.status.code == 200
-        assert response.consume() == 'PUT'
+        assert response.consume() == b'PUT'
 
-        response = conn.put('/', data='toby').recv()
+        response = conn.put('/', data=b'toby').recv()
         assert response.status.code == 200
-        assert response.consume() == 'PUTtoby'
+        assert response.consume() == b'PUTtoby'
         h.stop()
 
     def test_delete(self):
@@ -189,16 +287,67 @@ class TestHTTP(object):
         def _():
             conn = serve.recv()
             for request in conn:
-                request.reply(vanilla.http.Status(200), {}, request.method)
+                request.reply(
+                    vanilla.http.Status(200), {}, request.method.encode())
 
         uri = 'http://localhost:%s' % serve.port
         conn = h.http.connect(uri)
 
         response = conn.delete('/').recv()
         assert response.status.code == 200
-        assert response.consume() == 'DELETE'
+        assert response.consume() == b'DELETE'
+        h.stop()
+
+    def test_file(self, tmpdir):
+        h = vanilla.Hub()
+
+        serve = h.http.listen()
+        path = tmpdir.join('data')
+        path.write_binary(b'0123456789')
+
+        @h.spawn
+        def _():
+            conn = serve.recv()
+            for request in conn:
+                if request.path == '/path':
+                    body = vanilla.http.File(str(path))
+                else:
+                    body = open(str(path), 'rb')
+                request.reply(vanilla.http.Status(200), {}, body)
+
+        uri = 'http://localhost:%s' % serve.port
+        conn = h.http.connect(uri)
+
+        response = conn.get('/path').recv()
+        assert response.status.code == 200
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.consume() == b'0123456789'
+
+        response = conn.get('/', headers={'Range': 'bytes=2-5'}).recv()
+        assert response.status.code == 206
+        assert response.headers['Content-Range'] == 'bytes 2-5/10'
+        assert response.consume() == b'2345'
+
+        response = conn.get('/', headers={'Range': 'bytes=-3'}).recv()
+        assert response.status.code == 206
+        assert response.consume() == b'789'
+
+        response = conn.get('/', headers={'Range': 'bytes=10-'}).recv()
+        assert response.status.code == 416
+        assert response.headers['Content-Range'] == 'bytes */10'
         h.stop()
 
+    def test_file_mmap(self, tmpdir):
+        h = vanilla.Hub()
+        path = tmpdir.join('data')
+        path.write_binary(b'0123456789')
+
+        # the fallback for when sendfile can't be used
+        server = vanilla.http.HTTPServer(h, h.io.pipe())
+        with open(str(path), 'rb') as f:
+            h.spawn(server.send_mmap, f.fileno(), 3, 4)
+            assert server.socket.recv() == b'3456'
+
     def test_404(self):
         h = vanilla.Hub()
 
@@ -208,7 +357,7 @@ class TestHTTP(object):
         def _():
             conn = serve.recv()
             for request in conn:
-                request.reply(vanilla.http.Status(404), {}, '')
+                request.reply(vanilla.http.Status(404), {}, b'')
 
         uri = 'http://localhost:%s' % serve.port
         response = h.http.connect(uri).get('/').recv()
@@ -226,7 +375,7 @@ class TestHTTP(object):
             for request in conn:
                 t = request.path[1:]
                 h.sleep(int(t))
-                request.reply(vanilla.http.Status(200), {}, t)
+                request.reply(vanilla.http.Status(200), {}, t.encode())
 
         uri = 'http://localhost:%s' % serve.port
         conn = h.http.connect(uri)
@@ -256,14 +405,14 @@ class TestHTTP(object):
                 request.reply(
                     vanilla.http.Status(200),
                     {},
-                    request.headers['Authorization'])
+                    request.headers['Authorization'].encode())
 
         uri = 'http://localhost:%s' % serve.port
         conn = h.http.connect(uri)
 
         response = conn.get('/', auth=('foo', 'bar'))
         response = response.recv()
-        assert response.consume() == 'Basic Zm9vOmJhcg=='
+        assert response.consume() == b'Basic Zm9vOmJhcg=='
 
     def test_connection_lost(self):
         h = vanilla.Hub()
@@ -292,11 +441,266 @@ class TestHTTP(object):
 
         conn = serve.recv()
         request = conn.recv()
-        request.reply(vanilla.http.Status(200), {}, json.dumps({'foo': 'bar'}))
+        request.reply(
+            vanilla.http.Status(200), {}, json.dumps({'foo': 'bar'}).encode())
 
         response = response.recv()
         assert response.json() == {'foo': 'bar'}
 
+    def test_pool(self):
+        h = vanilla.Hub()
+        serve = h.http.listen()
+        uri = 'http://localhost:%s' % serve.port
+
+        @h.spawn
+        def _():
+            for conn in serve:
+                @h.spawn
+                def _(conn=conn):
+                    for request in conn:
+                        if request.path == '/close':
+                            request.reply(
+                                vanilla.http.Status(200),
+                                {'Connection': 'close'}, b'bye')
+                        else:
+                            request.reply(
+                                vanilla.http.Status(200), {},
+                                request.path.encode())
+
+        pool = h.http.pool(uri, size=2, idle=50)
+        assert h.http.pool(uri + '/') is pool
+
+        # a consumed response releases its connection for the next request
+        for path in ('/a', '/b', '/c'):
+            assert h.http.get(uri + path).recv().consume() == path.encode()
+        h.sleep(1)
+        assert pool.stats()['created'] == 1
+        assert pool.stats()['reused'] == 2
+        assert pool.stats()['idle'] == 1
+        # with a single timer for the pool's idle connections
+        assert len(h.scheduled) == 1
+
+        # requests beyond the pool's size wait for a connection
+        responses = [pool.get('/%s' % i) for i in range(2)]
+        q = h.queue(1)
+        h.spawn(lambda: q.send(pool.get('/2').recv().consume()))
+        h.sleep(1)
+        assert pool.stats()['waiting'] == 1
+        assert [r.recv().consume() for r in responses] == [b'/0', b'/1']
+        assert q.recv() == b'/2'
+        assert pool.stats()['created'] == 2
+
+        # connections the server closes are dropped
+        assert pool.get('/close').recv().consume() == b'bye'
+        h.sleep(1)
+        assert pool.stats()['dropped'] == 1
+
+        # idle connections are closed after the idle timeout
+        h.sleep(100)
+        assert pool.stats()['idle'] == 0
+        assert pool.stats()['active'] == 0
+
+
+class TestServe(object):
+    def test_serve(self):
+        h = vanilla.Hub()
+        serve = h.http.listen()
+
+        def handler(request):
+            t = int(request.path[1:])
+            h.sleep(t)
+            if not t:
+                raise Exception('boom')
+            request.reply(vanilla.http.Status(200), {}, str(t).encode())
+
+        @h.spawn
+        def _():
+            for conn in serve:
+                conn.serve(handler, concurrency=3)
+
+        uri = 'http://localhost:%s' % serve.port
+        conn = h.http.connect(uri)
+
+        start = time.time()
+        # pipelined on the one connection
+        responses = [conn.get('/%s' % t) for t in (50, 20, 0, 10)]
+        got = []
+        for response in responses:
+            response = response.recv()
+            got.append((response.status.code, response.consume()))
+        # the handlers ran concurrently, but replied in order
+        assert time.time() - start < 0.075
+        assert got == [(200, b'50'), (200, b'20'), (500, b''), (200, b'10')]
+        h.stop()
+
+    def test_serve_limit(self):
+        h = vanilla.Hub()
+        serve = h.http.listen()
+        seen = []
+        gate = h.channel()
+
+        def handler(request):
+            seen.append(request.path)
+            gate.recv()
+            request.reply(vanilla.http.Status(200), {}, request.path.encode())
+
+        @h.spawn
+        def _():
+            for conn in serve:
+                conn.serve(handler, concurrency=10, limit=2)
+
+        uri = 'http://localhost:%s' % serve.port
+        conn = h.http.connect(uri)
+        responses = [conn.get('/%s' % i) for i in range(6)]
+        h.sleep(20)
+        # reading stops the limit beyond the response being written
+        assert seen == ['/0', '/1', '/2']
+
+        for i, response in enumerate(responses):
+            gate.send(True)
+            assert response.recv().consume() == b'/%d' % i
+        assert len(seen) == 6
+        h.stop()
+
+
+class TestRequestParser(object):
+    def test_parse(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        recver = vanilla.message.Stream(recver)
+        parser = vanilla.http.RequestParser(recver)
+
+        @h.spawn
+        def _():
+            sender.send(b'\r\nGET /a HTTP/1.1\r\nHost:localhost\r\n')
+            sender.send(b'X-Foo:  bar \r\n\r\nGET /b HTTP/1.1\r')
+            sender.send(b'\n\r\n')
+
+        method, path, version, headers = parser.recv()
+        assert (method, path, version) == ('GET', '/a', 'HTTP/1.1')
+        # headers are split on first use
+        assert headers.lines
+        assert headers['host'] == 'localhost'
+        assert headers['x-foo'] == 'bar'
+        assert not headers.lines
+
+        assert parser.recv()[:3] == ('GET', '/b', 'HTTP/1.1')
+
+    def test_limits(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        recver = vanilla.message.Stream(recver)
+        parser = vanilla.http.RequestParser(
+            recver, max_headers=2, max_size=100)
+
+        @h.spawn
+        def _():
+            sender.send(b'GET / HTTP/1.1\r\n' + b'A: b\r\n' * 3 + b'\r\n')
+            sender.send(b'GET / HTTP/1.1\r\nbad\r\n\r\n')
+            sender.send(b'GET / HTTP/1.1\r\n' + b'x' * 100)
+
+        e = pytest.raises(vanilla.BadRequest, parser.recv)
+        assert e.value.status == 431
+        e = pytest.raises(vanilla.BadRequest, parser.recv)
+        assert e.value.status == 400
+        e = pytest.raises(vanilla.BadRequest, parser.recv)
+        assert e.value.status == 431
+
+    def test_reply(self):
+        h = vanilla.Hub()
+        serve = h.http.listen(max_headers=1)
+
+        client = h.tcp.connect(serve.port)
+        client.send(b'GET / HTTP/1.1\r\nA: b\r\nC: d\r\n\r\n')
+
+        conn = serve.recv()
+        assert list(conn) == []
+        response = client.recv_line()
+        assert response.startswith(b'HTTP/1.1 431 ')
+
+
+class TestHead(object):
+    def test_status_line(self):
+        assert vanilla.http.status_line(vanilla.http.Status(404)) == \
+            b'HTTP/1.1 404 NOT FOUND\r\n'
+        assert vanilla.http.status_line((299, 'SOMETHING')) == \
+            b'HTTP/1.1 299 SOMETHING\r\n'
+
+    def test_date(self):
+        date = vanilla.http.HTTPDate()
+        line = date()
+        assert line.startswith(b'Date: ') and line.endswith(b' GMT\r\n')
+        # rendered once for the second
+        assert date() is line or date.second != int(time.time())
+
+    def test_header_block(self):
+        h = vanilla.Hub()
+        serve = h.http.listen(headers={'Server': 'vanilla'})
+        block = vanilla.http.HeaderBlock({'Cache-Control': 'no-cache'})
+
+        client = h.tcp.connect(serve.port)
+        client.send(b'GET / HTTP/1.1\r\n\r\n')
+
+        conn = serve.recv()
+        request = conn.recv()
+        request.reply(vanilla.http.Status(200), (block, {'X-Foo': 'bar'}), b'')
+
+        assert client.recv_line().strip() == b'HTTP/1.1 200 OK'
+        headers = set()
+        while True:
+            line = client.recv_line().strip()
+            if not line:
+                break
+            headers.add(line.split(b':')[0])
+        assert headers == set([
+            b'Server', b'Cache-Control', b'X-Foo', b'Date',
+            b'Content-Length'])
+
+
+class TestCompress(object):
+    def test_accept_encoding(self):
+        accept = vanilla.http.accept_encoding
+        assert accept('gzip, deflate') == 'gzip'
+        assert accept('deflate;q=1, gzip;q=0.5') == 'deflate'
+        assert accept('br, *') == 'gzip'
+        assert accept('*;q=0.5, gzip;q=0') == 'deflate'
+        assert accept('identity') is None
+        assert accept('') is None
+
+    def test_reply(self):
+        import zlib
+        h = vanilla.Hub()
+        serve = h.http.listen(compress=True)
+        want = b'toby' * 1024
+
+        client = h.tcp.connect(serve.port)
+        client.send(
+            b'GET / HTTP/1.1\r\nAccept-Encoding: deflate\r\n\r\n'
+            b'GET / HTTP/1.1\r\n\r\n')
+
+        conn = serve.recv()
+
+        def recv_response():
+            assert client.recv_line().strip() == b'HTTP/1.1 200 OK'
+            headers = {}
+            while True:
+                line = client.recv_line().strip()
+                if not line:
+                    break
+                k, v = line.split(b': ')
+                headers[k] = v
+            return headers, client.recv_n(int(headers[b'Content-Length']))
+
+        conn.recv().reply(vanilla.http.Status(200), {}, want)
+        headers, body = recv_response()
+        assert headers[b'Content-Encoding'] == b'deflate'
+        assert zlib.decompress(body) == want
+
+        conn.recv().reply(vanilla.http.Status(200), {}, want)
+        headers, body = recv_response()
+        assert b'Content-Encoding' not in headers
+        assert body == want
+
 
 class TestWebsocket(object):
     def test_websocket(self):
@@ -317,24 +721,24 @@ class TestWebsocket(object):
 
         gc.collect()
 
-        message = 'x' * 125
+        message = b'x' * 125
         ws.send(message)
         assert ws.recv() == message
 
-        message = 'x' * 126
+        message = b'x' * 126
         ws.send(message)
         assert ws.recv() == message
 
-        message = 'x' * 65535
+        message = b'x' * 65535
         ws.send(message)
         assert ws.recv() == message
 
-        message = 'x' * 65536
+        message = b'x' * 65536
         ws.send(message)
         assert ws.recv() == message
 
         # test we can call select on the websocket
-        message = 'x' * 125
+        message = b'x' * 125
         ws.send(message)
         assert h.select([ws.recver]) == (ws.recver, message)
         h.stop()
@@ -354,6 +758,151 @@ class TestWebsocket(object):
 
         uri = 'ws://localhost:%s' % serve.port
         ws = h.http.connect(uri).websocket('/')
-        ws.send('1')
+        ws.send(b'1')
         pytest.raises(vanilla.Closed, ws.recv)
         h.stop()
+
+    @staticmethod
+    def pair(h, **kw):
+        a, b = socket.socketpair()
+        client = vanilla.http.WebSocket(h, h.io.socket(a), **kw)
+        server = vanilla.http.WebSocket(
+            h, h.io.socket(b), is_client=False, **kw)
+        return client, server
+
+    def test_fragments(self):
+        h = vanilla.Hub()
+        client, server = self.pair(h, fragment=1000)
+
+        client.send(u'toby')
+        assert server.recv() == u'toby'
+
+        message = os.urandom(2500)
+        client.send(message)
+        assert server.recv() == message
+        server.send(message)
+        assert client.recv() == message
+
+        client.send(b'')
+        assert server.recv() == b''
+
+    def test_stream(self):
+        h = vanilla.Hub()
+        client, server = self.pair(h, fragment=1000)
+
+        sender, recver = h.pipe()
+
+        @h.spawn
+        def _():
+            sender.send(u'ab')
+            sender.send(u'c' * 2500)
+            sender.close()
+
+        client.send(recver)
+        assert server.recv() == u'ab' + u'c' * 2500
+
+    def test_ping(self):
+        h = vanilla.Hub()
+        a, b = socket.socketpair()
+        raw = h.io.socket(a)
+        ws = vanilla.http.WebSocket(h, h.io.socket(b), is_client=False)
+
+        def frame(b1, payload):
+            mask = os.urandom(4)
+            return struct.pack('!BB', b1, len(payload) | 0x80) + mask + \
+                vanilla.http.WebSocket.mask(mask, payload)
+
+        # a ping in between the fragments of a message
+        raw.send(frame(0x01, b'hel') + frame(0x89, b'ping') + frame(0x80, b'lo'))
+        assert raw.recv_n(6) == b'\x8a\x04ping'
+        assert ws.recv() == u'hello'
+
+    def test_deflate(self):
+        Deflate = vanilla.http.PerMessageDeflate
+        h = vanilla.Hub()
+
+        for window_bits, context_takeover in [(15, True), (9, False)]:
+            offer = Deflate.offer(window_bits, context_takeover)
+            extension, deflate = Deflate.accept(offer)
+
+            a, b = socket.socketpair()
+            client = vanilla.http.WebSocket(
+                h, h.io.socket(a), fragment=100,
+                deflate=Deflate.accepted(extension))
+            server = vanilla.http.WebSocket(
+                h, h.io.socket(b), is_client=False, fragment=100,
+                deflate=deflate)
+
+            message = json.dumps([{'id': i} for i in range(100)])
+            for _ in range(3):
+                client.send(message)
+                assert server.recv() == message
+                server.send(message.encode())
+                assert client.recv() == message.encode()
+
+            sender, recver = h.pipe()
+
+            @h.spawn
+            def _():
+                sender.send(u'ab')
+                sender.send(u'c' * 500)
+                sender.close()
+
+            client.send(recver)
+            assert server.recv() == u'ab' + u'c' * 500
+
+    def test_deflate_negotiate(self):
+        Deflate = vanilla.http.PerMessageDeflate
+
+        # the example from RFC 7692
+        deflate = Deflate.accepted('permessage-deflate')
+        assert deflate.compress(b'Hello') == b'\xf2\x48\xcd\xc9\xc9\x07\x00'
+        assert deflate.decompress(
+            b'\xf2\x48\xcd\xc9\xc9\x07\x00', 100) == b'Hello'
+
+        extension, deflate = Deflate.accept(
+            'x-webkit-deflate-frame, '
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; client_max_window_bits',
+            window_bits=12, context_takeover=False)
+        assert extension == (
+            'permessage-deflate; client_max_window_bits=12; '
+            'client_no_context_takeover; server_max_window_bits=12; '
+            'server_no_context_takeover')
+        assert deflate.send_bits == 12 and not deflate.send_takeover
+
+        assert Deflate.accept('x-webkit-deflate-frame') == (None, None)
+        assert Deflate.accepted('') is None
+
+    def test_websocket_deflate(self):
+        h = vanilla.Hub()
+
+        serve = h.http.listen()
+
+        @h.spawn
+        def _():
+            conn = serve.recv()
+            request = conn.recv()
+            ws = request.upgrade(compress=True)
+            for item in ws.recver:
+                ws.send(item)
+
+        uri = 'ws://localhost:%s' % serve.port
+        ws = h.http.connect(uri).websocket('/', compress=True)
+
+        message = b'x' * 65536
+        ws.send(message)
+        assert ws.recv() == message
+        h.stop()
+
+    def test_mask(self):
+        def reference(mask, s):
+            return bytes(bytearray(
+                bytearray(mask)[i % 4] ^ c for i, c in enumerate(bytearray(s))))
+
+        for length in (0, 1, 3, 4, 5, 125, 126, 65535, 65536):
+            mask = os.urandom(4)
+            data = os.urandom(length)
+            masked = vanilla.http.WebSocket.mask(mask, data)
+            assert masked == reference(mask, data)
+            assert vanilla.http.WebSocket.mask(mask, masked) == data
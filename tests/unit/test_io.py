@@ -1,6 +1,11 @@
+import functools
+import socket
+import os
+
 import pytest
 
 import vanilla
+import vanilla.io
 
 
 # TODO: remove
@@ -61,6 +66,71 @@ class TestIO(object):
             got += recver.recv()
         assert got == want1+want2
 
+    def test_write_coalesce(self):
+        h = vanilla.Hub()
+        sender, recver = h.io.pipe()
+
+        sender.write(b'HTTP/1.1 200 OK\r\n')
+        sender.write(b'Content-Length: 3\r\n\r\n')
+        pytest.raises(vanilla.Timeout, recver.recv, timeout=10)
+
+        sender.send(b'foo')
+        assert recver.recv() == \
+            b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nfoo'
+
+    def test_write_threshold(self):
+        h = vanilla.Hub()
+        sender, recver = h.io.pipe(threshold=4)
+
+        sender.write(b'12')
+        pytest.raises(vanilla.Timeout, recver.recv, timeout=10)
+        sender.write(b'34')
+        assert recver.recv() == b'1234'
+        assert not sender.queued
+
+    def test_write_partial(self):
+        h = vanilla.Hub()
+        sender, recver = h.io.pipe()
+
+        want = [c * 300 * 1024 for c in (b'a', b'b', b'c')]
+
+        @h.spawn
+        def _():
+            for chunk in want:
+                sender.write(chunk)
+            sender.flush()
+
+        got = b''
+        while len(got) < 900 * 1024:
+            got += recver.recv()
+        assert got == b''.join(want)
+
+    def test_read_size(self):
+        reads = vanilla.io.ReadSize(minimum=4, maximum=16)
+        assert reads.size == 4
+        reads.update(4)
+        assert reads.size == 8
+        reads.update(8)
+        reads.update(16)
+        assert reads.size == 16
+        reads.update(3)
+        assert reads.size == 8
+        reads.update(1)
+        reads.update(1)
+        assert reads.size == 4
+
+    def test_read_into(self):
+        h = vanilla.Hub()
+        reads = functools.partial(vanilla.io.ReadSize, 4, 16, into=True)
+        sender, recver = h.io.pipe(reads=reads)
+
+        sender.send(b'x' * 10)
+        assert recver.recv() == b'xxxx'
+        assert recver.recv() == b'xxxxxx'
+        sender.send(b'y' * 10)
+        assert recver.recv() == b'yyyyyyyy'
+        assert recver.recv() == b'yy'
+
     def test_write_close(self):
         h = vanilla.Hub()
         sender, recver = h.io.pipe()
@@ -114,3 +184,60 @@ class TestIO(object):
         pytest.raises(vanilla.Closed, recver.recv)
         h.sleep(1)
         assert not h.registered
+
+    def test_sendfile(self, tmpdir):
+        h = vanilla.Hub()
+        sender, recver = h.io.pipe()
+
+        path = tmpdir.join('data')
+        want = os.urandom(1024 * 1024)
+        path.write_binary(want)
+
+        @h.spawn
+        def _():
+            with open(str(path), 'rb') as f:
+                sender.write(b'head')
+                assert sender.sendfile(f.fileno(), 10, len(want)) == \
+                    len(want) - 10
+                sender.send(b'tail')
+
+        got = b''
+        while len(got) < len(want) - 10 + 8:
+            got += recver.recv()
+        assert got == b'head' + want[10:] + b'tail'
+
+    def test_sendfile_closed(self, tmpdir):
+        h = vanilla.Hub()
+        a, b = socket.socketpair()
+        sender = h.io.socket(a).sender
+
+        path = tmpdir.join('data')
+        path.write_binary(os.urandom(8 * 1024 * 1024))
+
+        results = h.queue(2)
+
+        @h.spawn
+        def _():
+            with open(str(path), 'rb') as f:
+                try:
+                    sender.sendfile(f.fileno(), 0, 8 * 1024 * 1024)
+                except vanilla.Halt as e:
+                    results.send(('sendfile', type(e)))
+
+        h.sleep(10)
+
+        # waits behind the file, which the peer stops reading
+        @h.spawn
+        def _():
+            try:
+                sender.send(b'after')
+            except vanilla.Halt as e:
+                results.send(('send', type(e)))
+
+        h.sleep(10)
+        assert len(sender.waiters) == 1
+        b.close()
+
+        got = dict(results.recv(timeout=1000) for _ in range(2))
+        assert got['send'] is vanilla.Closed
+        assert not sender.waiters
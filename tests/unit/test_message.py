@@ -72,6 +72,17 @@ class TestPipe(object):
         p = h.pipe()
         pytest.raises(vanilla.Stop, p.send, 1)
 
+    def test_slots(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        # the shared middle is fully slotted
+        pytest.raises(AttributeError, setattr, sender.middle, 'foo', 1)
+        assert sender.middle is recver.middle
+        assert sender.hub is recver.hub is h
+        # while ends can still be given extra attributes
+        recver.foo = 1
+        assert recver.foo == 1
+
     def test_close_recver(self):
         h = vanilla.Hub()
 
@@ -404,10 +415,63 @@ class TestQueue(object):
 
         assert recver.recv() == 1
         assert recver.recv() == 2
+        pytest.raises(vanilla.Abandoned, recver.recv)
 
         gc.collect()
         h.sleep(1)
 
+    def test_queue_close(self):
+        h = vanilla.Hub()
+        sender, recver = h.queue(2)
+
+        sender.send(1)
+        sender.close()
+        pytest.raises(vanilla.Closed, sender.send, 2)
+
+        # buffered items are still delivered once the sender is closed
+        assert recver.recv() == 1
+        pytest.raises(vanilla.Closed, recver.recv)
+
+    def test_queue_waiters(self):
+        h = vanilla.Hub()
+        q = h.queue(1)
+        check = h.queue(10)
+
+        # many recvers can wait on an empty queue
+        for _ in range(3):
+            h.spawn(lambda: check.send(q.recv()))
+        h.sleep(1)
+        for i in range(3):
+            q.send(i)
+        assert [check.recv() for _ in range(3)] == [0, 1, 2]
+
+        # and many senders can wait on a full queue
+        for i in range(3):
+            h.spawn(q.send, i)
+        h.sleep(1)
+        assert [q.recv() for _ in range(3)] == [0, 1, 2]
+
+    def test_queue_select(self):
+        h = vanilla.Hub()
+        sender, recver = h.queue(1)
+
+        h.spawn(sender.send, 1)
+        ch, item = h.select([recver])
+        assert (ch, item) == (recver, 1)
+
+        sender.send(2)
+        h.spawn(lambda: h.sleep(10) or recver.recv())
+        ch, item = h.select([sender])
+        assert (ch, item) == (sender, None)
+
+    def test_queue_pipe(self):
+        h = vanilla.Hub()
+        p = h.pipe().pipe(h.queue(2)).pipe(h.pipe())
+        p.send(1)
+        p.send(2)
+        assert p.recv() == 1
+        assert p.recv() == 2
+
 
 class TestPulse(object):
     def test_pulse(self):
@@ -748,20 +812,45 @@ class TestStream(object):
 
         @h.spawn
         def _():
-            sender.send('foo')
-            sender.send('123')
-            sender.send('456')
-            sender.send('TobyTobyToby')
-            sender.send('foo\n')
-            sender.send('bar\nend.')
+            sender.send(b'foo')
+            sender.send(b'123')
+            sender.send(b'456')
+            sender.send(b'TobyTobyToby')
+            sender.send(b'foo\n')
+            sender.send(b'bar\nend.')
             sender.close()
 
-        assert recver.recv() == 'foo'
-        assert recver.recv_n(2) == '12'
-        assert recver.recv_n(2) == '34'
-        assert recver.recv_partition('y') == '56Tob'
-        assert recver.recv_partition('y') == 'Tob'
-        assert recver.recv_line() == 'Tobyfoo'
-        assert recver.recv_line() == 'bar'
-        assert recver.recv() == 'end.'
+        assert recver.recv() == b'foo'
+        assert recver.recv_n(2) == b'12'
+        assert recver.recv_n(2) == b'34'
+        assert recver.recv_partition(b'y') == b'56Tob'
+        assert recver.recv_partition(b'y') == b'Tob'
+        assert recver.recv_line() == b'Tobyfoo'
+        assert recver.recv_line() == b'bar'
+        assert recver.recv() == b'end.'
         pytest.raises(vanilla.Closed, recver.recv_n, 2)
+
+    def test_stream_recv_into(self):
+        h = vanilla.Hub()
+
+        sender, recver = h.pipe()
+        recver = vanilla.message.Stream(recver)
+
+        @h.spawn
+        def _():
+            sender.send(b'foo\r')
+            sender.send(b'\nbar')
+            sender.send(b'123456')
+            sender.close()
+
+        # the separator is split across chunks
+        assert recver.recv_partition(b'\r\n') == b'foo'
+
+        buf = bytearray(4)
+        assert recver.recv_into(buf) == 3
+        assert buf[:3] == b'bar'
+        assert recver.recv_into(buf) == 4
+        assert buf == b'1234'
+        assert recver.recv_into(memoryview(buf)[1:]) == 2
+        assert buf == b'1564'
+        pytest.raises(vanilla.Closed, recver.recv_into, buf)
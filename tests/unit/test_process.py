@@ -1,4 +1,5 @@
 import vanilla
+import vanilla.process
 import signal
 import os
 
@@ -100,3 +101,154 @@ class TestProcess(object):
         assert child.stdout.recv_partition('\n') == 'worker: line1'
         child.stdin.send('line2\n')
         assert child.stdout.recv_partition('\n') == 'worker: line2'
+
+    def test_spawn_large(self):
+        h = vanilla.Hub()
+
+        def worker(data):
+            import sys
+            sys.stdout.write('%s\n' % len(data))
+
+        # well past what a single read of the old bootstrap pipe could take
+        child = h.process.spawn(worker, 'x' * 1000000)
+        assert child.stdout.recv_partition(b'\n') == b'1000000'
+        child.done.recv()
+        assert child.exitcode == 0
+
+
+class TestZygote(object):
+    def test_result(self):
+        h = vanilla.Hub()
+        zygote = h.process.zygote(preload=['json'])
+
+        def worker(data):
+            import json
+            return json.dumps(data[::-1])
+
+        data = list(range(500000))
+        child = zygote.spawn(worker, data)
+        assert child.result.recv() == json_reversed(data)
+        child.done.recv()
+        assert (child.exitcode, child.exitsignal) == (0, 0)
+        assert not child.check_liveness()
+        zygote.close()
+
+    def test_exception(self):
+        h = vanilla.Hub()
+        zygote = h.process.zygote()
+
+        def worker():
+            raise ValueError('boom')
+
+        child = zygote.spawn(worker)
+        pytest.raises(ValueError, child.result.recv)
+        child.done.recv()
+        assert child.exitcode == 1
+        # the traceback goes to the worker's stderr
+        assert child.stderr.recv_partition(b'ValueError: boom\n')
+        zygote.close()
+
+    def test_defaults(self):
+        h = vanilla.Hub()
+        zygote = h.process.zygote()
+
+        def worker(a, b=2, c='three'):
+            return (a, b, c)
+
+        child = zygote.spawn(worker, 1, c=3)
+        assert child.result.recv() == (1, 2, 3)
+        zygote.close()
+
+    def test_closure(self):
+        h = vanilla.Hub()
+        zygote = h.process.zygote()
+        data = 'data'
+
+        def worker():
+            return data
+
+        pytest.raises(ValueError, zygote.spawn, worker)
+        zygote.close()
+
+    def test_stdio(self):
+        h = vanilla.Hub()
+        zygote = h.process.zygote()
+
+        def worker():
+            import sys
+            for line in sys.stdin:
+                sys.stdout.write('worker: %s' % line)
+            return 'done'
+
+        child = zygote.spawn(worker)
+        child.stdin.send(b'line1\n')
+        assert child.stdout.recv_partition(b'\n') == b'worker: line1'
+        child.stdin.send(b'line2\n')
+        assert child.stdout.recv_partition(b'\n') == b'worker: line2'
+        child.stdin.close()
+        assert child.result.recv() == 'done'
+        zygote.close()
+
+    def test_terminate(self):
+        h = vanilla.Hub()
+        zygote = h.process.zygote()
+
+        def worker():
+            import time
+            time.sleep(10)
+
+        child = zygote.spawn(worker)
+        assert child.check_liveness()
+        child.terminate()
+        child.done.recv()
+        assert child.exitsignal == signal.SIGTERM
+        pytest.raises(vanilla.Closed, child.result.recv)
+
+        zygote.close()
+        assert not zygote.template.check_liveness()
+        pytest.raises(vanilla.Closed, zygote.spawn, worker)
+
+
+def json_reversed(data):
+    import json
+    return json.dumps(data[::-1])
+
+
+class TestPrefork(object):
+    @staticmethod
+    def serve(h, server):
+        for conn in server:
+            conn.send(str(os.getpid()).encode())
+            conn.close()
+
+    @pytest.mark.parametrize('reuse_port', [False, True])
+    def test_prefork(self, monkeypatch, reuse_port):
+        monkeypatch.setattr(vanilla.process, 'RESTART_DELAY', 10)
+        h = vanilla.Hub()
+        prefork = h.process.prefork(self.serve, 2, reuse_port=reuse_port)
+
+        def served_by():
+            conn = h.tcp.connect(prefork.port)
+            return int(conn.recv())
+
+        workers = set(prefork.workers)
+        assert len(workers) == 2
+        assert set(served_by() for _ in range(20)) <= workers
+
+        # a worker which dies is replaced
+        victim = workers.pop()
+        os.kill(victim, signal.SIGKILL)
+        while prefork.restarts < 1 or len(prefork.workers) < 2:
+            h.sleep(10)
+        assert victim not in prefork.workers
+        assert served_by() in prefork.workers
+
+        # every worker is replaced, one at a time
+        before = set(prefork.workers)
+        prefork.restart()
+        assert len(prefork.workers) == 2
+        assert not before & set(prefork.workers)
+        assert served_by() in prefork.workers
+
+        prefork.stop()
+        assert not prefork.workers
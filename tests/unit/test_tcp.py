@@ -1,4 +1,10 @@
+import socket
+import errno
+
+import pytest
+
 import vanilla
+import vanilla.poll
 
 
 class TestTCP(object):
@@ -10,11 +16,65 @@ class TestTCP(object):
         def _():
             conn = server.recv()
             message = conn.recv()
-            conn.send('Echo: ' + message)
+            conn.send(b'Echo: ' + message)
 
         client = h.tcp.connect(server.port)
-        client.send('Toby')
-        assert client.recv() == 'Echo: Toby'
+        client.send(b'Toby')
+        assert client.recv() == b'Echo: Toby'
 
         h.stop()
         assert not h.registered
+
+    def test_connect_refused(self):
+        h = vanilla.Hub()
+        # a bound socket which isn't listening refuses connections
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+
+        e = pytest.raises(socket.error, h.tcp.connect, port)
+        assert e.value.errno == errno.ECONNREFUSED
+        assert not h.registered
+        closed.close()
+
+    def test_connect_timeout(self):
+        h = vanilla.Hub()
+        full, backlog = self.full()
+
+        pytest.raises(
+            vanilla.Timeout, h.tcp.connect, full.getsockname()[1], timeout=50)
+        assert not h.registered
+
+    def test_connect_happy_eyeballs(self):
+        h = vanilla.Hub()
+        full, backlog = self.full()
+        server = h.tcp.listen()
+
+        # the first address hangs, so the second is raced against it
+        conn = h.tcp.race([
+            (socket.AF_INET, full.getsockname()),
+            (socket.AF_INET, ('127.0.0.1', server.port))], lambda: -1)
+        assert conn.getpeername() == ('127.0.0.1', server.port)
+        # the hung attempt is cancelled, leaving no one waiting on POLLOUT
+        assert all(
+            vanilla.poll.POLLIN in masks for masks in h.registered.values())
+        conn.close()
+        server.recv().close()
+
+        client = h.tcp.connect(server.port, happy_eyeballs=True)
+        client.send(b'Toby')
+        assert server.recv().recv() == b'Toby'
+
+    @staticmethod
+    def full():
+        # once the accept backlog is full, further connects hang
+        full = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        full.bind(('127.0.0.1', 0))
+        full.listen(0)
+        backlog = []
+        for _ in range(4):
+            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            conn.setblocking(0)
+            conn.connect_ex(full.getsockname())
+            backlog.append(conn)
+        return full, backlog
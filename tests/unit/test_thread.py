@@ -1,4 +1,8 @@
+import threading
 import time
+import os
+
+import pytest
 
 import vanilla
 
@@ -15,6 +19,69 @@ def test_pipe():
     assert recver.recv() == 2
 
 
+def test_pipe_burst():
+    h = vanilla.Hub()
+    sender, recver = h.thread.pipe()
+
+    wakes = []
+    wake = sender.wake
+
+    def counted():
+        wakes.append(1)
+        wake()
+    sender.wake = counted
+
+    def burst(n):
+        for i in range(n):
+            sender.send(i)
+
+    t = threading.Thread(target=burst, args=(100000,))
+    t.start()
+    assert [recver.recv() for _ in range(100000)] == list(range(100000))
+    t.join()
+    # far fewer wakeups than items
+    assert len(wakes) < 1000
+
+
+def test_pipe_close():
+    h = vanilla.Hub()
+    sender, recver = h.thread.pipe()
+    recver.close()
+    # the next wakeup finds the recver gone, and the hub closes the pipe
+    sender.send(1)
+    h.sleep(10)
+    assert sender.closed
+    pytest.raises(OSError, os.fstat, sender.fd)
+
+    # a descriptor reusing the sender's number isn't written to
+    r, w = os.pipe()
+    t = threading.Thread(target=sender.send, args=(2,))
+    t.start()
+    t.join()
+    os.close(w)
+    assert os.read(r, 1) == b''
+    os.close(r)
+
+
+def test_pipe_threads():
+    h = vanilla.Hub()
+    sender, recver = h.thread.pipe()
+
+    def burst(name):
+        for i in range(1000):
+            sender.send((name, i))
+
+    threads = [threading.Thread(target=burst, args=(x,)) for x in range(4)]
+    for t in threads:
+        t.start()
+    got = [recver.recv() for _ in range(4000)]
+    for t in threads:
+        t.join()
+    for name in range(4):
+        assert [i for x, i in got if x == name] == list(range(1000))
+    pytest.raises(vanilla.Timeout, recver.recv, timeout=10)
+
+
 def test_call():
     def add(a, b):
         return a + b
@@ -42,6 +109,74 @@ def test_pool():
     assert check.recv() == 0.2
 
 
+def test_pool_exception():
+    h = vanilla.Hub()
+    p = h.thread.pool(2)
+
+    def fail():
+        raise ValueError('toby')
+
+    pytest.raises(ValueError, p.call(fail).recv)
+    assert p.call(lambda: 3).recv() == 3
+
+
+def test_pool_backpressure():
+    h = vanilla.Hub()
+    p = h.thread.pool(1, backlog=1)
+    release = threading.Event()
+
+    p.call(release.wait)
+    p.call(release.wait)
+
+    # the third call waits for a slot, but only its green thread does
+    blocked = h.pipe()
+    h.spawn(lambda: blocked.send(p.call(lambda: 3)))
+    pytest.raises(vanilla.Timeout, blocked.recv, timeout=50)
+
+    release.set()
+    assert blocked.recv().recv() == 3
+
+
+def test_pool_cancel():
+    h = vanilla.Hub()
+    p = h.thread.pool(1)
+    release = threading.Event()
+    called = []
+
+    first = p.call(release.wait)
+    p.call(called.append, 1).close()
+    release.set()
+    assert first.recv() is True
+    assert p.call(lambda: 3).recv() == 3
+    assert called == []
+
+
+def test_pool_map():
+    h = vanilla.Hub()
+    p = h.thread.pool(4, backlog=2)
+    assert p.map(lambda x: x * 2, range(100)) == list(range(0, 200, 2))
+    assert list(p.imap(str, range(3))) == ['0', '1', '2']
+
+
+def test_pool_grow_shrink():
+    h = vanilla.Hub()
+    p = h.thread.pool(4, minimum=1, idle=50)
+    assert p.threads == 1
+
+    release = threading.Event()
+    calls = [p.call(release.wait) for _ in range(4)]
+    assert p.threads == 4
+
+    release.set()
+    for call in calls:
+        call.recv()
+    h.sleep(300)
+    assert p.threads == 1
+
+    p.close()
+    pytest.raises(vanilla.Closed, p.call, release.wait)
+
+
 def test_wrap():
 
     class Target(object):
@@ -71,7 +206,7 @@ def test_spawn():
     def producer(h, extra):
         assert extra == 'foo'
         for n in h.parent.recver:
-            for i in xrange(n):
+            for i in range(n):
                 h.parent.send(i)
 
     h = vanilla.Hub()
@@ -82,3 +217,38 @@ def test_spawn():
     assert child.recv() == 0
     assert child.recv() == 1
     assert child.recv() == 2
+
+
+def test_runtime():
+    h = vanilla.Hub()
+    runtime = h.thread.runtime(2)
+
+    idents = [
+        runtime.call(i, lambda hub: threading.current_thread().ident).recv()
+        for i in range(2)]
+    assert len(set(idents + [threading.current_thread().ident])) == 3
+
+    # a message from one hub to another
+    got = h.thread.pipe()
+
+    def owner(hub):
+        sender, recver = hub.thread.pipe()
+        hub.spawn(lambda: got.send(recver.recv()))
+        return sender
+
+    sender = runtime.call(0, owner).recv()
+    runtime.spawn(1, lambda hub: sender.send('toby'))
+    assert got.recv() == 'toby'
+
+    def echo(hub, conn):
+        for data in conn.recver:
+            conn.send(data)
+
+    port = runtime.listen(echo)
+    for _ in range(8):
+        conn = h.tcp.connect(port)
+        conn.send(b'toby')
+        assert conn.recv() == b'toby'
+        conn.close()
+
+    runtime.stop()
@@ -3,6 +3,7 @@ __import__('pkg_resources').declare_namespace(__name__)
 from vanilla.core import Hub
 
 from vanilla.exception import ConnectionLost
+from vanilla.exception import BadRequest
 from vanilla.exception import Abandoned
 from vanilla.exception import Timeout
 from vanilla.exception import Closed
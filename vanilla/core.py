@@ -3,9 +3,11 @@ import sys
 import collections
 import functools
 import importlib
+import itertools
 import logging
 import signal
 import heapq
+import math
 import time
 
 from greenlet import getcurrent
@@ -30,16 +32,20 @@ class lazy:
 
 
 class Scheduler:
-    Item = collections.namedtuple('Item', ['due', 'action', 'args'])
+    Item = collections.namedtuple('Item', ['due', 'seq', 'action', 'args'])
 
-    def __init__(self):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
         self.count = 0
         self.queue = []
         self.removed = {}
+        # breaks ties between items due at the same time, which is common
+        # with a cached clock, so the actions themselves are never compared
+        self.seq = itertools.count()
 
     def add(self, delay, action, *args):
-        due = time.time() + (delay / 1000.0)
-        item = self.Item(due, action, args)
+        due = self.clock() + (delay / 1000.0)
+        item = self.Item(due, next(self.seq), action, args)
         heapq.heappush(self.queue, item)
         self.count += 1
         return item
@@ -60,7 +66,7 @@ class Scheduler:
 
     def timeout(self):
         self.prune()
-        return self.queue[0].due - time.time()
+        return self.queue[0].due - self.clock()
 
     def pop(self):
         self.prune()
@@ -69,6 +75,268 @@ class Scheduler:
         return item.action, item.args
 
 
+class Wheel:
+    """
+    A hierarchical timing wheel with the same interface as `Scheduler`.
+
+    Time is divided into 1ms ticks. The first level has a slot for each of the
+    next 256 ticks, and each following level has 64 slots which each cover an
+    entire rotation of the level below. When a lower level wraps, the next
+    slot of the level above is cascaded down. Adding and removing an item are
+    O(1) and removed items are dropped from their slot immediately, rather
+    than being left as tombstones. Expired items pop in order of due time,
+    with ties in the order they were added, just as with `Scheduler`.
+
+    The earliest item on each level is cached. Removing it only means that
+    level is searched again, the next time the earliest item is asked for, so
+    arming and cancelling a short timeout doesn't search the levels holding
+    long ones.
+    """
+    class Item:
+        __slots__ = ['due', 'seq', 'tick', 'action', 'args', 'level', 'slot']
+
+    BITS = [8, 6, 6, 6, 6]
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.count = 0
+        self.tick = self.ticks(clock())
+
+        self.levels = [[{} for _ in range(2**bits)] for bits in self.BITS]
+        self.shifts = [sum(self.BITS[:n]) for n in range(len(self.BITS))]
+        self.sizes = [0] * len(self.BITS)
+        # the earliest item on each level, None when it needs to be found
+        self.earliest = [None] * len(self.BITS)
+
+        # items whose tick has passed, as a heap of (due, seq, item) so they
+        # pop in the same order as they would from a `Scheduler`
+        self.expired = []
+        self.seq = itertools.count()
+
+    @staticmethod
+    def ticks(t):
+        return int(math.ceil(t * 1000))
+
+    def add(self, delay, action, *args):
+        item = self.Item()
+        item.due = self.clock() + (delay / 1000.0)
+        item.seq = next(self.seq)
+        item.tick = self.ticks(item.due)
+        item.action = action
+        item.args = args
+
+        if not self.count:
+            # nothing is scheduled, so we can resync to the current time
+            self.tick = self.ticks(self.clock()) - 1
+
+        self.place(item)
+        self.count += 1
+        return item
+
+    def place(self, item):
+        delta = item.tick - self.tick
+
+        if delta <= 0:
+            item.level = item.slot = None
+            heapq.heappush(self.expired, (item.due, item.seq, item))
+            return
+
+        for level, shift in enumerate(self.shifts):
+            span = 1 << (shift + self.BITS[level])
+            if delta < span or level == len(self.shifts) - 1:
+                break
+
+        # clamp items beyond the range of the wheel to its final slot, they
+        # will be placed again as they cascade down
+        tick = min(item.tick, self.tick + span - 1)
+        slots = self.levels[level]
+        slot = slots[(tick >> shift) & (len(slots) - 1)]
+        slot[item] = True
+
+        item.level = level
+        item.slot = slot
+        if not self.sizes[level]:
+            self.earliest[level] = item
+        else:
+            earliest = self.earliest[level]
+            if earliest is not None and item.due < earliest.due:
+                self.earliest[level] = item
+        self.sizes[level] += 1
+
+    def __len__(self):
+        return self.count
+
+    def remove(self, item):
+        if item.slot is not None:
+            del item.slot[item]
+            self.sizes[item.level] -= 1
+            if item is self.earliest[item.level]:
+                self.earliest[item.level] = None
+        elif item.level is None:
+            # expired, but not yet popped. mark it so pop skips over it
+            item.level = -1
+        else:
+            # already popped or removed
+            return
+
+        item.slot = None
+        self.count -= 1
+
+    def cascade(self, level):
+        slots = self.levels[level]
+        index = (self.tick >> self.shifts[level]) & (len(slots) - 1)
+        slot = slots[index]
+        if slot:
+            slots[index] = {}
+            self.sizes[level] -= len(slot)
+            earliest = self.earliest[level]
+            if earliest is not None and earliest.slot is slot:
+                self.earliest[level] = None
+            for item in slot:
+                self.place(item)
+        return index
+
+    def step(self):
+        self.tick += 1
+        for level in range(1, len(self.levels)):
+            if self.tick & ((1 << self.shifts[level]) - 1):
+                break
+            self.cascade(level)
+        self.cascade(0)
+
+    def advance(self, target):
+        """
+        Moves the wheel forward to *target* tick, expiring all items with a
+        tick up to and including *target*.
+        """
+        while self.tick < target:
+            for level, size in enumerate(self.sizes):
+                if size:
+                    break
+            else:
+                self.tick = target
+                return
+
+            if level:
+                # the levels below are empty, so skip straight to the next
+                # cascade of this level
+                boundary = self.tick | ((1 << self.shifts[level]) - 1)
+                if boundary >= target:
+                    self.tick = target
+                    return
+                self.tick = boundary
+
+            self.step()
+
+    def peek(self):
+        """
+        Returns the earliest item which is still on the wheel
+        """
+        best = None
+        for level, size in enumerate(self.sizes):
+            if not size:
+                continue
+            item = self.earliest[level]
+            if item is None:
+                item = self.earliest[level] = self.search(level)
+            if best is None or item.due < best.due:
+                best = item
+        return best
+
+    def search(self, level):
+        """
+        Returns the earliest item on *level*, which mustn't be empty.
+        """
+        slots = self.levels[level]
+        shift = self.shifts[level]
+        mask = len(slots) - 1
+        start = self.tick >> shift
+        for offset in range(1, len(slots) + 1):
+            slot = slots[(start + offset) & mask]
+            if slot:
+                break
+        # only the first level has a single tick per slot
+        return min(slot, key=lambda item: item.due)
+
+    def prune(self):
+        while self.expired and self.expired[0][2].level == -1:
+            heapq.heappop(self.expired)
+
+    def timeout(self):
+        self.prune()
+        if self.expired:
+            return self.expired[0][0] - self.clock()
+        return self.peek().due - self.clock()
+
+    def pop(self):
+        self.prune()
+        if not self.expired:
+            self.advance(self.peek().tick)
+            self.prune()
+        _, _, item = heapq.heappop(self.expired)
+        item.level = -1
+        self.count -= 1
+        return item.action, item.args
+
+
+class GreenletPool:
+    """
+    A bounded free list of greenlets for running spawned callables. Rather
+    than exiting once their callable returns, pooled greenlets park themselves
+    on the free list and are handed the next callable spawned on the hub. Once
+    the free list holds *size* greenlets, finished greenlets exit as normal.
+    """
+    def __init__(self, hub, size):
+        self.hub = hub
+        self.size = size
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, task, *a):
+        if self.free:
+            self.hits += 1
+            self.free.pop().switch(self, task, a)
+        else:
+            self.misses += 1
+            greenlet(self.main).switch(task, a)
+
+    def main(self, task, a):
+        while True:
+            try:
+                task(*a)
+            except Exception as e:
+                self.hub.log.warn(
+                    'Exception leaked back to main loop', exc_info=e)
+
+            # don't hold on to the finished task while parked
+            task = a = None
+
+            if len(self.free) >= self.size:
+                return
+
+            self.free.append(getcurrent())
+            while True:
+                try:
+                    resume = self.hub.loop.switch()
+                except Exception:
+                    continue
+                # a switch to a finished greenlet is normally a no-op, so
+                # ignore any stray switches which arrive while we're parked
+                if type(resume) is tuple and len(resume) == 3 and \
+                        resume[0] is self:
+                    break
+
+            _, task, a = resume
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'free': len(self.free),
+            'hits': self.hits,
+            'misses': self.misses, }
+
+
 class Hub:
     """
     A Vanilla Hub is a handle to a self contained world of interwoven
@@ -77,15 +345,31 @@ class Hub:
     this Hub is explicit and must be passed to coroutines that need to interact
     with it. This is particularly nice for testing, as it makes it clear what's
     going on, and other tests can't inadvertently effect each other.
+
+    *scheduler* is the class used to track timeouts and delayed spawns. It
+    defaults to a heap based `Scheduler`, `Wheel` is a timing wheel which is
+    better suited to hubs which arm and cancel many timeouts.
+
+    *clock* is the source of time for the hub's timers and defaults to
+    `time.monotonic`, so timers aren't effected by changes to the wall clock.
+
+    If *pool* is given, up to *pool* finished greenlets are kept in a
+    `GreenletPool` and reused to run newly spawned callables. Its hits and
+    misses are available from `hub.pool.stats()`.
     """
-    def __init__(self):
+    def __init__(self, scheduler=Scheduler, clock=time.monotonic, pool=0):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__))
 
+        self.clock = clock
+        self.update_now()
+
         self.ready = collections.deque()
-        self.scheduled = Scheduler()
+        self.scheduled = scheduler(clock=self.now)
 
         self.stopped = self.state()
 
+        self.pool = GreenletPool(self, pool) if pool else None
+
         self.registered = {}
         self.poll = vanilla.poll.Poll()
         self.loop = greenlet(self.main)
@@ -106,6 +390,22 @@ class Hub:
                 "If you are, you still need to install it".format(
                     name=name))
 
+    def now(self):
+        """
+        Returns the current time of the hub's clock in seconds. The value is
+        cached once per pass of the event loop, so it's cheap to call
+        frequently, but it doesn't advance while a green thread keeps
+        control::
+
+            start = h.now()
+            h.sleep(50)
+            h.now() - start # returns roughly 0.05
+        """
+        return self.cached_now
+
+    def update_now(self):
+        self.cached_now = self.clock()
+
     def pipe(self):
         """
         Returns a `Pipe`_ `Pair`_.
@@ -157,15 +457,23 @@ class Hub:
 
             for _ in recver:
                 log.info('hello') # logs 'hello' every half a second
+
+        Pulses are timed against the hub's clock, so time spent waiting on the
+        Recver doesn't cause the pulses to drift.
         """
         @self.producer
         def _(sender):
+            due = self.now()
             while True:
+                due += ms / 1000.0
                 try:
-                    self.sleep(ms)
+                    self.sleep(max(0, (due - self.now()) * 1000))
                 except vanilla.exception.Halt:
                     break
                 sender.send(item)
+                # if the recver has fallen more than a pulse behind, don't
+                # try to catch up with a burst of pulses
+                due = max(due, self.now() - ms / 1000.0)
             sender.close()
         return _
 
@@ -206,13 +514,14 @@ class Hub:
 
         A Channel can have many senders and many recvers. By default it is
         unbuffered, but you can create buffered Channels by specifying a size.
-        They're structurally equivalent to channels in Go. It's implementation
-        is *literally* a `Router`_ piped to a `Dealer`_, with an optional
-        `Queue`_ in between.
+        They're structurally equivalent to channels in Go. An unbuffered
+        Channel's implementation is *literally* a `Router`_ piped to a
+        `Dealer`_. A buffered Channel is a `Queue`_, which allows any number of
+        senders and recvers to wait on it.
         """
-        sender, recver = self.router()
         if size > 0:
-            recver = recver.pipe(self.queue(size))
+            return self.queue(size)
+        sender, recver = self.router()
         return vanilla.message.Pair(sender, recver.pipe(self.dealer()))
 
     def serialize(self, func):
@@ -242,7 +551,8 @@ class Hub:
 
             result = pipe.recv()
 
-            if type(result) is tuple and len(result) == 4 and result[0] is exc_marker:
+            if type(result) is tuple and len(result) == 4 and \
+                    result[0] is exc_marker:
                 etype, evalue, tb = result[1:]
                 raise evalue.with_traceback(tb)
 
@@ -294,7 +604,8 @@ class Hub:
 
         for end in ends:
             if end.ready:
-                return end, isinstance(end, vanilla.message.Recver) and end.recv() or None
+                return end, isinstance(end, vanilla.message.Recver) and \
+                    end.recv() or None
 
         for end in ends:
             end.select()
@@ -328,7 +639,8 @@ class Hub:
 
         # TODO: rework State's is set test to be more natural
         if self.stopped.recver.ready:
-            raise vanilla.exception.Stop('Hub stopped while we were paused. There must be a deadlock.')
+            raise vanilla.exception.Stop(
+                'Hub stopped while we were paused. There must be a deadlock.')
 
         return resume
 
@@ -442,30 +754,60 @@ class Hub:
         try:
             if isinstance(task, greenlet):
                 task.switch(*a)
+            elif self.pool is not None:
+                self.pool.run(task, *a)
             else:
                 greenlet(task).switch(*a)
         except Exception as e:
             self.log.warn('Exception leaked back to main loop', exc_info=e)
 
     def dispatch_events(self, events):
+        """
+        Resumes the green threads waiting on the file descriptors in *events*.
+
+        This runs directly on the loop greenlet: rather than sending through
+        each registered Pipe, the waiting recver is switched to as though the
+        send had happened, which saves creating a greenlet for every poll
+        wakeup. Errors close the registered Pipes, which can run arbitrary
+        onclose callbacks, so they're spawned to a green thread instead.
+        """
+        errors = []
         for fd, mask in events:
-            if fd in self.registered:
-                masks = self.registered[fd]
-                if mask == vanilla.poll.POLLERR:
-                    for sender in masks.values():
-                        sender.close()
-                elif masks[mask].ready:
-                    masks[mask].send(True)
+            masks = self.registered.get(fd)
+            if masks is None:
+                continue
+
+            if mask == vanilla.poll.POLLERR:
+                errors.append(masks)
+                continue
+
+            sender = masks.get(mask)
+            if sender is None or sender.middle.closed:
+                continue
+
+            recver = sender.other
+            if recver is not None and recver.current:
+                self.run_task(recver.peak, recver, True)
+
+        if errors:
+            self.spawn(self.dispatch_errors, errors)
+
+    def dispatch_errors(self, errors):
+        for masks in errors:
+            for sender in list(masks.values()):
+                sender.close()
 
     def main(self):
         """
         Scheduler steps:
+            - update the hub's cached now
+
             - run ready until exhaustion
 
             - if there's something scheduled
                 - run overdue scheduled immediately
-                - or if there's nothing registered, sleep until next scheduled
-                  and then go back to ready
+                - or if there's nothing registered, sleep until next scheduled,
+                  update the cached now and then go back to ready
 
             - if there's nothing registered and nothing scheduled, we've
               deadlocked, so stopped
@@ -475,6 +817,8 @@ class Hub:
         """
 
         while True:
+            self.update_now()
+
             while self.ready:
                 task, a = self.ready.popleft()
                 self.run_task(task, *a)
@@ -491,6 +835,7 @@ class Hub:
                 # if nothing registered, just sleep until next scheduled
                 if not self.registered:
                     time.sleep(timeout)
+                    self.update_now()
                     task, a = self.scheduled.pop()
                     self.run_task(task, *a)
                     continue
@@ -511,5 +856,9 @@ class Hub:
             except IOError:
                 pass
 
+            # woken green threads run straight from dispatch_events, so
+            # refresh now to cover the time spent waiting in poll
+            self.update_now()
+
             if events:
-                self.spawn(self.dispatch_events, events)
+                self.dispatch_events(events)
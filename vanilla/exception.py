@@ -21,3 +21,10 @@ class Abandoned(Halt):
 # TODO: think through HTTP Exceptions
 class ConnectionLost(Exception):
     pass
+
+
+class BadRequest(Exception):
+    def __init__(self, status, message=''):
+        super(BadRequest, self).__init__(status, message)
+        # the status code to reply with
+        self.status = status
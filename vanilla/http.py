@@ -1,24 +1,58 @@
 import collections
 import functools
-import urlparse
 import logging
 import hashlib
 import base64
-import urllib
 import struct
 import json
+import mmap
 import time
 import uuid
+import zlib
 import ssl
 import os
+import re
+
+try:
+    import urlparse
+    from urllib import urlencode
+except ImportError:
+    import urllib.parse as urlparse
+    from urllib.parse import urlencode
 
 import vanilla.exception
 import vanilla.message
 import vanilla.meta
+import vanilla.core
 
 
 HTTP_VERSION = 'HTTP/1.1'
 
+# limits on the head of a request, beyond which it's refused with a 431
+MAX_HEADERS = 100
+MAX_HEAD = 64 * 1024
+
+# the largest request body accepted, beyond which it's refused with a 413
+MAX_BODY = 16 * 1024**2
+# the most of a request body read from the socket at a time
+BODY_CHUNK = 64 * 1024
+
+# what a Content-Length, and a chunk size, may be made of
+DIGITS = re.compile(r'[0-9]+\Z')
+HEX_DIGITS = re.compile(br'[0-9a-fA-F]+\Z')
+
+# bodies smaller than this aren't worth compressing
+COMPRESS_MIN = 1024
+# one-shot bodies this large are compressed on the thread pool
+COMPRESS_OFFLOAD = 256 * 1024
+COMPRESS_LEVEL = 6
+COMPRESS_THREADS = 4
+
+# the zlib window bits for each content coding
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS, }
+
 
 log = logging.getLogger(__name__)
 
@@ -26,21 +60,44 @@ log = logging.getLogger(__name__)
 class __plugin__:
     def __init__(self, hub):
         self.hub = hub
+        self.pools = {}
 
     def connect(self, url):
         return HTTPClient(self.hub, url)
 
-    # TODO: hacking in convenience for example, still need to add test
-    # TODO: ensure connection is closed after the get is done
+    def pool(self, url, size=10, idle=60000):
+        """
+        Returns the `HTTPPool` of keep-alive connections for the scheme, host
+        and port of *url*, creating it with *size* and *idle* if this is the
+        first request for it.
+        """
+        scheme, host, port = split_url(url)
+        key = (scheme, host, port)
+        if key not in self.pools:
+            self.pools[key] = HTTPPool(
+                self.hub, '%s://%s:%s' % key, size=size, idle=idle)
+        return self.pools[key]
+
+    @vanilla.core.lazy
+    def threads(self):
+        # compresses large bodies off the hub
+        return self.hub.thread.pool(COMPRESS_THREADS)
+
     def get(self, uri, params=None, headers=None):
         parsed = urlparse.urlsplit(uri)
-        conn = self.connect('%s://%s' % (parsed.scheme, parsed.netloc))
-        return conn.get(parsed.path, params=params, headers=headers)
-
-    def listen(self, port=0, host='127.0.0.1'):
+        pool = self.pool('%s://%s' % (parsed.scheme, parsed.netloc))
+        return pool.get(parsed.path, params=params, headers=headers)
+
+    def listen(self, port=0, host='127.0.0.1', **kw):
+        """
+        Listens on *host*:*port* and returns a `Recver`_ of `HTTPServer`
+        connections. Any keyword arguments, such as *max_headers*,
+        *max_head*, *headers* and *compress*, are passed to each
+        `HTTPServer`.
+        """
         server = self.hub.tcp.listen(host=host, port=port)
         ret = server.map(
-            lambda conn: HTTPServer(self.hub, conn))
+            lambda conn: HTTPServer(self.hub, conn, **kw))
         ret.port = server.port
         return ret
 
@@ -112,11 +169,246 @@ def Status(code):
     return code, REASON_PHRASES[code]
 
 
+# the status line for each of the standard statuses, encoded up front
+STATUS_LINES = dict(
+    (Status(code), ('%s %s %s\r\n' % (HTTP_VERSION, code, phrase)).encode(
+        'latin-1'))
+    for code, phrase in REASON_PHRASES.items())
+
+
+def status_line(status):
+    try:
+        return STATUS_LINES[status]
+    except KeyError:
+        return ('%s %s %s\r\n' % ((HTTP_VERSION,) + tuple(status))).encode(
+            'latin-1')
+
+
+class HTTPDate:
+    """
+    Renders the Date header line, at most once a second.
+    """
+    def __init__(self):
+        self.second = None
+        self.line = None
+
+    def __call__(self):
+        now = int(time.time())
+        if now != self.second:
+            self.line = ('Date: %s\r\n' % time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now))).encode(
+                    'latin-1')
+            self.second = now
+        return self.line
+
+
+http_date = HTTPDate()
+
+
+class HeaderBlock:
+    """
+    Headers which are the same from one reply to the next, rendered once.
+    A block can be given as the headers of a reply, either on its own or in a
+    tuple along with blocks and dicts of headers for that reply. Blocks passed
+    to `HTTPServer` as *headers* go out on every reply on the connection.
+    """
+    def __init__(self, headers):
+        self.headers = dict(headers)
+        self.data = ''.join(
+            '%s: %s\r\n' % (k, v) for k, v in self.headers.items()).encode(
+                'latin-1')
+
+    def get(self, key, default=None):
+        return self.headers.get(key, default)
+
+
+def split_headers(headers):
+    """
+    Splits the headers given for a reply into a list of `HeaderBlock` and a
+    dict of the remaining headers. A dict given alone is returned as is, so
+    headers added to it are seen by the caller.
+    """
+    if isinstance(headers, HeaderBlock):
+        return [headers], {}
+    if not isinstance(headers, tuple):
+        return [], headers
+    blocks = []
+    rest = {}
+    for item in headers:
+        if isinstance(item, HeaderBlock):
+            blocks.append(item)
+        else:
+            rest.update(item)
+    return blocks, rest
+
+
+def accept_encoding(value):
+    """
+    Returns the content coding to use for a request's Accept-Encoding
+    *value*, gzip or deflate, or None if it accepts neither.
+    """
+    ranked = {}
+    for item in value.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        ranked[coding] = q
+    best = None
+    for coding in ('gzip', 'deflate'):
+        q = ranked.get(coding, ranked.get('*', 0.0))
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, coding)
+    return best and best[1]
+
+
+def compress(data, encoding, level=COMPRESS_LEVEL):
+    c = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return c.compress(data) + c.flush()
+
+
+def compress_stream(body, encoding, level=COMPRESS_LEVEL):
+    """
+    Returns a Recver of the chunks of *body* compressed with *encoding*. Each
+    chunk is flushed as it passes through, so a streamed response isn't held
+    back waiting for more data.
+    """
+    @body.pipe
+    def body(recver, sender):
+        c = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+        for chunk in recver:
+            sender.send(c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH))
+        sender.send(c.flush())
+        sender.close()
+    return body
+
+
+class Decompress:
+    """
+    Decodes a response body with a Content-Encoding of gzip or deflate as it
+    arrives, sending the decoded data on to *sender*.
+    """
+    def __init__(self, sender):
+        self.sender = sender
+        # detects both the gzip and zlib wrappers
+        self.d = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def send(self, data):
+        data = self.d.decompress(data)
+        if data:
+            self.sender.send(data)
+
+    def finish(self):
+        data = self.d.flush()
+        if data:
+            self.sender.send(data)
+
+
+class File:
+    """
+    A file to reply with, given as a path or an open file object. It's sent
+    with os.sendfile, falling back to sending it in chunks from an mmap when
+    sendfile can't be used. By default the whole file is sent, *offset* and
+    *length* can select part of it.
+
+    Replies with a `File` honour a single byte range in the request's Range
+    header. The file is closed once it's been sent.
+    """
+    CHUNK = 256 * 1024
+
+    def __init__(self, f, offset=0, length=None):
+        if isinstance(f, str):
+            f = open(f, 'rb')
+        self.file = f
+        self.size = os.fstat(f.fileno()).st_size
+        self.offset = offset
+        self.length = self.size - offset if length is None else length
+
+    def range(self, spec):
+        """
+        Narrows the file to the byte range *spec*, the value of a Range
+        header. Returns True if the range was applied, False if it can't be
+        satisfied and None if it's ignored, which is the case for anything
+        but a single range of bytes.
+        """
+        match = re.match(r'bytes=(\d*)-(\d*)$', spec.replace(' ', ''))
+        if not match or match.groups() == ('', ''):
+            return None
+        start, end = match.groups()
+        if not start:
+            start = max(0, self.size - int(end))
+            end = self.size - 1
+        else:
+            start = int(start)
+            end = min(int(end), self.size - 1) if end else self.size - 1
+        if start > end:
+            return False
+        self.offset = start
+        self.length = end - start + 1
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+def content_length(value):
+    """
+    Parses a Content-Length header. Anything but a run of digits, such as a
+    negative length, is refused with a 400.
+    """
+    value = value.strip()
+    if not DIGITS.match(value):
+        raise vanilla.exception.BadRequest(400, 'bad content length')
+    return int(value)
+
+
+def chunk_size(line):
+    """
+    Parses the size from the line which starts a chunk, ignoring any chunk
+    extensions. Anything but a run of hex digits is refused with a 400.
+    """
+    size = line.split(b';', 1)[0].strip()
+    if not HEX_DIGITS.match(size):
+        raise vanilla.exception.BadRequest(400, 'bad chunk size')
+    return int(size, 16)
+
+
+def split_url(url):
+    """
+    Returns the scheme, host and port of *url*, defaulting the port from the
+    scheme.
+    """
+    parsed = urlparse.urlsplit(url)
+    default_port = 443 if parsed.scheme in ('https', 'wss') else 80
+    return parsed.scheme, parsed.hostname, parsed.port or default_port
+
+
 class Headers:
+    """
+    Case insensitive headers. When created with the raw header *lines* of a
+    request, the lines are only split into names and values the first time
+    the headers are used.
+    """
     Value = collections.namedtuple('Value', ['key', 'value'])
 
-    def __init__(self):
-        self.store = {}
+    def __init__(self, lines=()):
+        self.lines = lines
+
+    @vanilla.core.lazy
+    def store(self):
+        store = {}
+        for line in self.lines:
+            key, _, value = line.partition(b':')
+            key = key.decode('latin-1')
+            store[key.lower()] = self.Value(
+                key, value.strip().decode('latin-1'))
+        self.lines = ()
+        return store
 
     def __setitem__(self, key, value):
         self.store[key.lower()] = self.Value(key, value)
@@ -128,7 +420,7 @@ class Headers:
         return self.store[key.lower()].value
 
     def __repr__(self):
-        return repr(dict(self.store.itervalues()))
+        return repr(dict(self.store.values()))
 
     def get(self, key, default=None):
         try:
@@ -137,6 +429,64 @@ class Headers:
             return default
 
 
+class RequestParser:
+    """
+    Parses request heads straight from the buffer of the `Stream`_ *recver*.
+
+    The search for the blank line which ends a head resumes where it left off
+    as more data arrives, and the head is taken from the buffer in one piece
+    and split into lines. The header lines are handed to `Headers` unparsed.
+    Heads with more than *max_headers* headers or longer than *max_size*
+    bytes raise `BadRequest` with a 431, and malformed heads with a 400.
+    """
+    def __init__(self, recver, max_headers=MAX_HEADERS, max_size=MAX_HEAD):
+        self.recver = recver
+        self.max_headers = max_headers
+        self.max_size = max_size
+        self.scanned = 0
+
+    def recv(self, timeout=-1):
+        """
+        Returns (method, path, version, headers) for the next request head.
+        """
+        buffer = self.recver.buffer
+        while True:
+            # empty lines may precede a request
+            while buffer[:2] == b'\r\n':
+                self.recver.take(2)
+                self.scanned = max(0, self.scanned - 2)
+            end = buffer.find(b'\r\n\r\n', self.scanned)
+            if end != -1:
+                break
+            if len(buffer) > self.max_size:
+                raise vanilla.exception.BadRequest(431, 'head too large')
+            self.scanned = max(0, len(buffer) - 3)
+            self.recver.fill(timeout=timeout)
+            buffer = self.recver.buffer
+        self.scanned = 0
+
+        if end > self.max_size:
+            raise vanilla.exception.BadRequest(431, 'head too large')
+
+        head = self.recver.take(end + 4)
+        lines = head[:end].split(b'\r\n')
+
+        if len(lines) - 1 > self.max_headers:
+            raise vanilla.exception.BadRequest(431, 'too many headers')
+
+        request = lines[0].split(b' ')
+        if len(request) != 3:
+            raise vanilla.exception.BadRequest(400, 'bad request line')
+
+        headers = lines[1:]
+        for line in headers:
+            if b':' not in line:
+                raise vanilla.exception.BadRequest(400, 'bad header line')
+
+        method, path, version = [x.decode('latin-1') for x in request]
+        return method, path, version, Headers(headers)
+
+
 class HTTPSocket:
     def recv_headers(self):
         headers = Headers()
@@ -144,29 +494,53 @@ class HTTPSocket:
             line = self.socket.recv_line()
             if not line:
                 break
-            k, v = line.split(': ', 1)
+            k, v = line.decode('latin-1').split(':', 1)
             headers[k] = v.strip()
         return headers
 
     def send_headers(self, headers):
-        headers = '\r\n'.join(
-            '%s: %s' % (k, v) for k, v in headers.iteritems())
-        self.socket.send(headers+'\r\n'+'\r\n')
+        self.socket.sender.write(''.join(
+            '%s: %s\r\n' % (k, v) for k, v in headers.items()).encode(
+                'latin-1') + b'\r\n')
 
     def recv_chunk(self):
         length = int(self.socket.recv_line(), 16)
         if length:
             chunk = self.socket.recv_n(length)
         else:
-            chunk = ''
-        assert self.socket.recv_n(2) == '\r\n'
+            chunk = b''
+        assert self.socket.recv_n(2) == b'\r\n'
         return chunk
 
     def send_chunk(self, chunk):
-        self.socket.send('%s\r\n%s\r\n' % (hex(len(chunk))[2:], chunk))
+        self.socket.sender.write(('%x\r\n' % len(chunk)).encode('latin-1'))
+        self.socket.sender.write(chunk)
+        self.socket.send(b'\r\n')
+
+
+class HTTPRequests:
+    """
+    The request verbs, for classes which provide a *request* method.
+    """
+    def get(self, path='/', params=None, headers=None, auth=None):
+        if auth:
+            if not headers:
+                headers = {}
+            headers['Authorization'] = 'Basic ' + base64.b64encode(
+                ('%s:%s' % auth).encode('utf-8')).decode('latin-1')
+        return self.request('GET', path, params, headers, None)
+
+    def post(self, path='/', params=None, headers=None, data=b''):
+        return self.request('POST', path, params, headers, data)
+
+    def put(self, path='/', params=None, headers=None, data=b''):
+        return self.request('PUT', path, params, headers, data)
+
+    def delete(self, path='/', params=None, headers=None):
+        return self.request('DELETE', path, params, headers, None)
 
 
-class HTTPClient(HTTPSocket):
+class HTTPClient(HTTPSocket, HTTPRequests):
     Status = collections.namedtuple('Status', ['version', 'code', 'message'])
 
     class Response:
@@ -176,7 +550,7 @@ class HTTPClient(HTTPSocket):
             self.body = body
 
         def consume(self):
-            return ''.join(self.body)
+            return b''.join(self.body)
 
         def json(self):
             return json.loads(self.consume())
@@ -191,8 +565,7 @@ class HTTPClient(HTTPSocket):
         assert parsed.query == ''
         assert parsed.fragment == ''
 
-        default_port = 443 if parsed.scheme == 'https' else 80
-        host, port = urllib.splitnport(parsed.netloc, default_port)
+        _, host, port = split_url(url)
 
         self.socket = self.hub.tcp.connect(host=host, port=port)
 
@@ -204,13 +577,14 @@ class HTTPClient(HTTPSocket):
             conn.setblocking(0)
             self.socket.sender.fd.conn = conn
 
-        self.socket.recver.sep = '\r\n'
+        self.socket.recver.sep = b'\r\n'
 
         self.agent = 'vanilla/%s' % vanilla.meta.__version__
 
         self.default_headers = dict([
             ('Accept', '*/*'),
             ('User-Agent', self.agent),
+            ('Accept-Encoding', 'gzip, deflate'),
             ('Host', parsed.netloc), ])
 
         self.requests = self.hub.router().pipe(self.hub.queue(10))
@@ -219,10 +593,36 @@ class HTTPClient(HTTPSocket):
         self.responses = self.hub.router().pipe(self.hub.queue(10))
         self.responses.pipe(self.hub.consumer(self.reader))
 
+        # the number of requests whose response hasn't been fully read yet
+        self.pending = 0
+        # once set, the connection can't be used for further requests
+        self.broken = False
+        # called as released(self) once there are no pending responses
+        self.released = None
+
     def reader(self, response):
+        body = None
+        try:
+            body = self.read_response(response)
+        finally:
+            # the response has been read from the socket, so the connection
+            # can be released before the body's recver sees the end of it
+            self.pending -= 1
+            if not self.pending and self.released is not None:
+                self.released(self)
+            if body is not None:
+                body.close()
+
+    def read_response(self, response):
+        """
+        Reads the next response from the socket and sends it to *response*.
+        Returns the sender for the response's body, for the caller to close.
+        """
         try:
-            version, code, message = self.socket.recv_line().split(' ', 2)
+            version, code, message = self.socket.recv_line().decode(
+                'latin-1').split(' ', 2)
         except vanilla.exception.Halt:
+            self.broken = True
             # TODO: could we offer the ability to auto-reconnect?
             try:
                 response.send(vanilla.exception.ConnectionLost())
@@ -239,19 +639,31 @@ class HTTPClient(HTTPSocket):
         headers = self.recv_headers()
         sender, recver = self.hub.pipe()
 
+        if version != HTTP_VERSION or \
+                headers.get('Connection', '').lower() == 'close':
+            self.broken = True
+
         response.send(self.Response(status, headers, recver))
 
         if headers.get('Connection') == 'Upgrade':
+            # the socket now belongs to the websocket
+            self.broken = True
+            self.released = None
             sender.close()
             return
 
+        # compressed bodies are decoded on the way through
+        body = sender
+        if headers.get('content-encoding', '').lower() in WBITS:
+            body = Decompress(sender)
+
         try:
             if headers.get('transfer-encoding') == 'chunked':
                 while True:
                     chunk = self.recv_chunk()
                     if not chunk:
                         break
-                    sender.send(chunk)
+                    body.send(chunk)
             else:
                 # TODO:
                 # http://www.w3.org/Protocols/rfc2616/rfc2616-sec4.html#sec4.4
@@ -262,22 +674,31 @@ class HTTPClient(HTTPSocket):
                     content-length isn't in header, assume body is marked by
                     connection closed
                     """
-                    body = ''
+                    self.broken = True
+                    data = b''
                     while True:
                         try:
-                            body += self.socket.recv()
+                            data += self.socket.recv()
                         except vanilla.exception.Closed:
                             break
-                    sender.send(body)
+                    body.send(data)
                 else:
-                    body = self.socket.recv_n(int(length))
-                    sender.send(body)
+                    data = self.socket.recv_n(int(length))
+                    body.send(data)
+            if body is not sender:
+                body.finish()
 
         except vanilla.exception.Halt:
+            self.broken = True
             # TODO: could we offer the ability to auto-reconnect?
             sender.send(vanilla.exception.ConnectionLost())
 
-        sender.close()
+        except zlib.error as e:
+            # the rest of the body is left unread
+            self.broken = True
+            sender.send(e)
+
+        return sender
 
     def request(
             self,
@@ -287,6 +708,7 @@ class HTTPClient(HTTPSocket):
             headers=None,
             data=None):
 
+        self.pending += 1
         self.requests.send((method, path, params, headers, data))
         sender, recver = self.hub.pipe()
         self.responses.send(sender)
@@ -301,46 +723,46 @@ class HTTPClient(HTTPSocket):
             request_headers.update(headers)
 
         if params:
-            path += '?' + urllib.urlencode(params)
+            path += '?' + urlencode(params)
 
         request = '%s %s %s\r\n' % (method, path, HTTP_VERSION)
-        self.socket.send(request)
+        self.socket.sender.write(request.encode('latin-1'))
+
+        # if data is a pipe, upload it with chunked encoding
+        if hasattr(data, 'recv'):
+            request_headers['Transfer-Encoding'] = 'chunked'
+            self.send_headers(request_headers)
+            self.socket.sender.flush()
+            for chunk in data:
+                self.send_chunk(chunk)
+            self.send_chunk(b'')
+            return
 
-        # TODO: handle chunked transfers
         if data is not None:
 
             if isinstance(data, dict):
                 request_headers['Content-Type'] = \
                     'application/x-www-form-urlencoded'
-                data = urllib.urlencode(data)
+                data = urlencode(data).encode('latin-1')
 
             request_headers['Content-Length'] = len(data)
 
         self.send_headers(request_headers)
 
-        # TODO: handle chunked transfers
         if data is not None:
-            self.socket.send(data)
-
-    def get(self, path='/', params=None, headers=None, auth=None):
-        if auth:
-            if not headers:
-                headers = {}
-            headers['Authorization'] = \
-                'Basic ' + base64.b64encode('%s:%s' % auth)
-        return self.request('GET', path, params, headers, None)
-
-    def post(self, path='/', params=None, headers=None, data=''):
-        return self.request('POST', path, params, headers, data)
-
-    def put(self, path='/', params=None, headers=None, data=''):
-        return self.request('PUT', path, params, headers, data)
-
-    def delete(self, path='/', params=None, headers=None):
-        return self.request('DELETE', path, params, headers, None)
-
-    def websocket(self, path='/', params=None, headers=None):
-        key = base64.b64encode(uuid.uuid4().bytes)
+            self.socket.sender.write(data)
+        self.socket.sender.flush()
+
+    def websocket(
+            self, path='/', params=None, headers=None, compress=False,
+            window_bits=15, context_takeover=True, **kw):
+        """
+        Upgrades this connection to a `WebSocket`. With *compress*,
+        permessage-deflate is offered, see `PerMessageDeflate` for
+        *window_bits* and *context_takeover*. Any other keyword arguments,
+        such as *fragment*, are passed to `WebSocket`.
+        """
+        key = base64.b64encode(uuid.uuid4().bytes).decode('latin-1')
 
         headers = headers or {}
         headers.update({
@@ -348,6 +770,9 @@ class HTTPClient(HTTPSocket):
             'Connection': 'Upgrade',
             'Sec-WebSocket-Key': key,
             'Sec-WebSocket-Version': 13, })
+        if compress:
+            headers['Sec-WebSocket-Extensions'] = PerMessageDeflate.offer(
+                window_bits, context_takeover)
 
         response = self.request('GET', path, params, headers, None).recv()
         assert response.status.code == 101
@@ -355,51 +780,225 @@ class HTTPClient(HTTPSocket):
         assert response.headers['Sec-WebSocket-Accept'] == \
             WebSocket.accept_key(key)
 
-        return WebSocket(self.hub, self.socket)
+        deflate = None
+        if compress:
+            deflate = PerMessageDeflate.accepted(
+                response.headers.get('Sec-WebSocket-Extensions', ''))
+
+        return WebSocket(self.hub, self.socket, deflate=deflate, **kw)
 
     def close(self):
         # TODO: handle inflight requests?
+        self.broken = True
         self.socket.close()
 
 
+class HTTPPool(HTTPRequests):
+    """
+    Keeps up to *size* keep-alive `HTTPClient` connections to the scheme, host
+    and port of *url*. Each request is sent on an idle connection when there
+    is one, or on a new connection while there are fewer than *size*.
+    Otherwise the calling green thread waits for a connection to be released.
+
+    A connection is released once its response has been fully read, which
+    means its body has been consumed. It goes back to the pool unless it
+    broke, or the server asked to close it. Connections which stay idle for
+    *idle* milliseconds are closed.
+    """
+    def __init__(self, hub, url, size=10, idle=60000):
+        self.hub = hub
+        self.url = url
+        self.size = size
+        self.idle = idle
+
+        # idle connections as (conn, released at), oldest first
+        self.free = collections.deque()
+        # senders for the green threads waiting on a connection
+        self.waiting = collections.deque()
+        self.active = 0
+        # whether the reaper is scheduled to close idle connections
+        self.reaping = False
+
+        self.created = 0
+        self.reused = 0
+        self.dropped = 0
+
+    def request(
+            self,
+            method,
+            path='/',
+            params=None,
+            headers=None,
+            data=None):
+        conn = self.checkout()
+        return conn.request(method, path, params, headers, data)
+
+    def checkout(self):
+        expires = self.hub.now() - self.idle / 1000.0
+        while self.free:
+            # prefer the most recently used connection
+            conn, since = self.free.pop()
+            if since > expires and not conn.socket.recver.halted:
+                self.reused += 1
+                return conn
+            self.drop(conn)
+
+        if self.active >= self.size:
+            sender, recver = self.hub.pipe()
+            self.waiting.append(sender)
+            conn = recver.recv()
+            if conn is not None:
+                self.reused += 1
+                return conn
+            # a connection was dropped, and its slot handed to us
+
+        self.active += 1
+        try:
+            conn = HTTPClient(self.hub, self.url)
+        except Exception:
+            self.active -= 1
+            self.handoff(None)
+            raise
+        conn.released = self.checkin
+        self.created += 1
+        return conn
+
+    def checkin(self, conn):
+        if conn.broken or conn.socket.recver.halted:
+            self.drop(conn)
+            self.handoff(None)
+            return
+
+        if self.handoff(conn):
+            return
+
+        self.free.append((conn, self.hub.now()))
+        if not self.reaping:
+            self.reaping = True
+            self.hub.spawn_later(self.idle, self.reap)
+
+    def handoff(self, conn):
+        """
+        Hands *conn*, or with None a free slot, to the next waiting green
+        thread. Returns True if there was one to take it.
+        """
+        while self.waiting:
+            try:
+                self.waiting.popleft().send(conn)
+                return True
+            except vanilla.exception.Halt:
+                continue
+        return False
+
+    def drop(self, conn):
+        self.active -= 1
+        self.dropped += 1
+        conn.released = None
+        conn.close()
+
+    def reap(self):
+        now = self.hub.now()
+        expires = now - self.idle / 1000.0
+        while self.free and self.free[0][1] <= expires:
+            conn, _ = self.free.popleft()
+            self.drop(conn)
+        if not self.free:
+            self.reaping = False
+            return
+        # a single reaper runs per pool, rescheduled for whenever the
+        # oldest idle connection expires
+        delay = (self.free[0][1] - expires) * 1000
+        self.hub.spawn_later(max(delay, 1), self.reap)
+
+    def close(self):
+        while self.free:
+            conn, _ = self.free.popleft()
+            self.drop(conn)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'active': self.active,
+            'idle': len(self.free),
+            'waiting': len(self.waiting),
+            'created': self.created,
+            'reused': self.reused,
+            'dropped': self.dropped, }
+
+
 class HTTPServer(HTTPSocket):
-    def __init__(self, hub, socket):
+    def __init__(
+            self, hub, socket, max_headers=MAX_HEADERS, max_head=MAX_HEAD,
+            max_body=MAX_BODY, headers=None, compress=False):
         self.hub = hub
+        # whether replies are compressed for clients which accept it
+        self.compress = compress
+        # headers sent on every reply, rendered once
+        if headers is not None and not isinstance(headers, HeaderBlock):
+            headers = HeaderBlock(headers)
+        self.headers = headers
 
         self.socket = socket
-        self.socket.recver.sep = '\r\n'
+        self.socket.recver.sep = b'\r\n'
+        self.parser = RequestParser(
+            self.socket.recver, max_headers=max_headers, max_size=max_head)
+
+        self.max_body = max_body
+        # (sender, done) for the request body currently being streamed
+        self.reading = None
+        # set once the connection can't carry any more requests
+        self.closing = False
 
         self.responses = self.hub.router()
 
         @self.responses.consume
         def writer(response):
             status, headers, body = response
-
-            self.socket.send('HTTP/1.1 %s %s\r\n' % status)
-
-            if headers.get('Connection') == 'Upgrade':
-                self.send_headers(headers)
+            blocks, headers = split_headers(headers)
+            if self.headers is not None:
+                blocks.insert(0, self.headers)
+
+            def get(key):
+                if key in headers:
+                    return headers[key]
+                for block in blocks:
+                    if key in block.headers:
+                        return block.headers[key]
+
+            if get('Connection') == 'Upgrade':
+                self.send_head(status, blocks, headers)
+                self.socket.sender.flush()
                 self.responses.close()
                 return
 
-            headers.setdefault(
-                'Date',
-                time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()))
+            if self.closing:
+                headers['Connection'] = 'close'
 
             # if body is a pipe, use chunked encoding
             if hasattr(body, 'recv'):
                 headers['Transfer-Encoding'] = 'chunked'
-                self.send_headers(headers)
+                self.send_head(status, blocks, headers, date=get('Date'))
+                # the first chunk may be a long time coming, so don't hold
+                # the headers back waiting for it
+                self.socket.sender.flush()
                 for chunk in body:
                     self.send_chunk(chunk)
-                self.send_chunk('')
+                self.send_chunk(b'')
+
+            elif isinstance(body, File):
+                headers['Content-Length'] = body.length
+                self.send_head(status, blocks, headers, date=get('Date'))
+                self.send_file(body)
 
             # otherwise send in oneshot
             else:
                 headers['Content-Length'] = len(body)
-                self.send_headers(headers)
+                self.send_head(status, blocks, headers, date=get('Date'))
                 self.socket.send(body)
 
+            if get('Connection') == 'close':
+                self.socket.close()
+
     Request = collections.namedtuple('Request', ['method', 'path', 'version', 'headers'])
 
     class Request(Request):
@@ -409,22 +1008,102 @@ class HTTPServer(HTTPSocket):
             if self.headers.get('Content-Type') != \
                     'application/x-www-form-urlencoded':
                 raise AttributeError('not a form encoded request')
-            return dict(urlparse.parse_qsl(self.body))
+            return dict(urlparse.parse_qsl(self.consume().decode('latin-1')))
 
         @property
         def form_multi(self):
             if self.headers.get('Content-Type') != \
                     'application/x-www-form-urlencoded':
                 raise AttributeError('not a form encoded request')
-            return urlparse.parse_qs(self.body)
+            return urlparse.parse_qs(self.consume().decode('latin-1'))
 
         def consume(self):
-            return self.body
+            """
+            Returns the whole of the request's body, which is best kept to
+            small bodies. Larger ones can be streamed by iterating over
+            *body*.
+            """
+            try:
+                return self.content
+            except AttributeError:
+                self.content = b''.join(self.body)
+                return self.content
 
         def reply(self, status, headers, body):
-            self.server.responses.send((status, headers, body))
+            """
+            Replies with *status*, *headers* and *body*. *headers* is a dict,
+            a `HeaderBlock`, or a tuple of them.
+            """
+            if hasattr(body, 'fileno') and not isinstance(body, File):
+                body = File(body)
+            if isinstance(body, File):
+                blocks, headers = split_headers(headers)
+                status, body = self.ranged(status, headers, body)
+                headers = tuple(blocks) + (headers,)
+            elif self.server.compress and body is not None:
+                headers, body = self.compressed(status, headers, body)
+            self.replied = True
+            self.replies.send((status, headers, body))
+
+        def compressed(self, status, headers, body):
+            """
+            Compresses *body* with the best coding the request accepts.
+            Streamed bodies are compressed chunk by chunk, and large one-shot
+            bodies on the thread pool, so the hub isn't held up.
+            """
+            if status[0] < 200 or status[0] in (204, 304):
+                return headers, body
+            encoding = accept_encoding(
+                self.headers.get('Accept-Encoding', ''))
+            if encoding is None:
+                return headers, body
+            blocks, extra = split_headers(headers)
+            if 'Content-Encoding' in extra or \
+                    any('Content-Encoding' in b.headers for b in blocks):
+                return headers, body
 
-        def upgrade(self):
+            if hasattr(body, 'recv'):
+                body = compress_stream(body, encoding)
+            elif len(body) < COMPRESS_MIN:
+                return headers, body
+            elif len(body) < COMPRESS_OFFLOAD:
+                body = compress(body, encoding)
+            else:
+                body = self.server.hub.http.threads.call(
+                    compress, body, encoding).recv()
+
+            extra['Content-Encoding'] = encoding
+            extra.setdefault('Vary', 'Accept-Encoding')
+            if blocks:
+                return tuple(blocks) + (extra,), body
+            return extra, body
+
+        def ranged(self, status, headers, body):
+            headers.setdefault('Accept-Ranges', 'bytes')
+            spec = self.headers.get('Range')
+            if status[0] != 200 or not spec:
+                return status, body
+            satisfied = body.range(spec)
+            if satisfied is None:
+                return status, body
+            if not satisfied:
+                headers['Content-Range'] = 'bytes */%s' % body.size
+                body.close()
+                return Status(416), b''
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                body.offset, body.offset + body.length - 1, body.size)
+            return Status(206), body
+
+        def upgrade(
+                self, compress=False, window_bits=15, context_takeover=True,
+                **kw):
+            """
+            Upgrades the connection to a `WebSocket`. With *compress*,
+            permessage-deflate is used if the client offers it, see
+            `PerMessageDeflate` for *window_bits* and *context_takeover*. Any
+            other keyword arguments, such as *fragment*, are passed to
+            `WebSocket`.
+            """
             # TODO: the connection header can be a list of tokens, this should
             # be handled more comprehensively
             connection_tokens = [
@@ -441,102 +1120,352 @@ class HTTPServer(HTTPSocket):
                 "Connection": "Upgrade",
                 "Sec-WebSocket-Accept": accept, }
 
+            deflate = None
+            if compress:
+                extension, deflate = PerMessageDeflate.accept(
+                    self.headers.get('Sec-WebSocket-Extensions', ''),
+                    window_bits, context_takeover)
+                if extension:
+                    headers['Sec-WebSocket-Extensions'] = extension
+
             self.reply(Status(101), headers, None)
 
             return WebSocket(
-                self.server.hub, self.server.socket, is_client=False)
+                self.server.hub, self.server.socket, is_client=False,
+                deflate=deflate, **kw)
+
+    def send_head(self, status, blocks, headers, date=True):
+        """
+        Queues the status line, *blocks* and *headers* of a reply. The status
+        line, the blocks and the Date line are already rendered, and only
+        *headers* are formatted here. The Date line is added unless *date* is
+        set, meaning one was given.
+        """
+        write = self.socket.sender.write
+        write(status_line(status))
+        for block in blocks:
+            write(block.data)
+        if not date:
+            write(http_date())
+        write(''.join(
+            '%s: %s\r\n' % (k, v) for k, v in headers.items()).encode(
+                'latin-1') + b'\r\n')
+
+    def send_file(self, body):
+        try:
+            fileno = body.file.fileno()
+            sent = self.socket.sender.sendfile(
+                fileno, body.offset, body.length)
+            if sent < body.length:
+                self.send_mmap(fileno, body.offset + sent, body.length - sent)
+        finally:
+            body.close()
+
+    def send_mmap(self, fileno, offset, length):
+        m = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(m)
+            try:
+                end = min(offset + length, len(m))
+                for i in range(offset, end, File.CHUNK):
+                    self.socket.sender.send(view[i:min(i + File.CHUNK, end)])
+            finally:
+                view.release()
+            if end < offset + length:
+                # the file shrank, so Content-Length can't be met
+                self.socket.close()
+        finally:
+            try:
+                m.close()
+            except BufferError:
+                # a failed send still holds part of the map, leave it to
+                # be collected
+                pass
 
-    def recv(self, timeout=None):
-        method, path, version = self.socket.recv_line().split(' ', 2)
-        headers = self.recv_headers()
-        request = self.Request(method, path, version, headers)
-        # TODO: handle chunked transfers
-        length = int(headers.get('content-length', 0))
-        request.body = self.socket.recv_n(length)
+    def recv(self, timeout=None, replies=None):
+        """
+        Returns the next request on the connection. Its reply is sent to
+        *replies*, which defaults to the connection's writer.
+        """
+        replies = replies or self.responses
+        # whatever is left of the previous request's body is skipped
+        self.skip_body()
+        if self.closing:
+            raise vanilla.exception.Closed
+        try:
+            method, path, version, headers = self.parser.recv()
+            request = self.Request(method, path, version, headers)
+            request.body = self.recv_body(headers)
+        except vanilla.exception.BadRequest as e:
+            replies.send((Status(e.status), {'Connection': 'close'}, b''))
+            raise
         request.server = self
+        request.replies = replies
+        request.replied = False
         return request
 
+    def recv_body(self, headers):
+        """
+        Returns a `Recver`_ of the chunks of a request's body. Nothing is read
+        from the socket until the chunks are asked for, and the next request
+        can't be read until the body has been read, or skipped.
+        """
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = self.read_chunked()
+        else:
+            length = content_length(headers.get('content-length', '0'))
+            if length > self.max_body:
+                raise vanilla.exception.BadRequest(413, 'body too large')
+            chunks = self.read_length(length) if length else None
+
+        sender, recver = self.hub.pipe()
+        if chunks is None:
+            sender.close()
+            return recver
+
+        done = self.hub.state()
+        self.reading = (sender, done)
+
+        @self.hub.spawn
+        def _():
+            try:
+                try:
+                    while True:
+                        # only read the next chunk once it's asked for
+                        if not sender.ready:
+                            sender.pause()
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        sender.send(chunk)
+                except vanilla.exception.Halt:
+                    # the body was closed or dropped, skip what's left of it
+                    for _ in chunks:
+                        pass
+            except vanilla.exception.BadRequest as e:
+                self.closing = True
+                sender.close(e)
+            except vanilla.exception.Halt:
+                # the connection was lost part way through the body
+                self.closing = True
+            finally:
+                sender.close()
+                if self.reading is not None and self.reading[1] is done:
+                    self.reading = None
+                done.send(True)
+
+        return recver
+
+    def read_some(self, n):
+        recver = self.socket.recver
+        if not recver.buffer:
+            recver.fill()
+        return recver.take(min(n, len(recver.buffer)))
+
+    def read_length(self, length):
+        while length:
+            chunk = self.read_some(min(length, BODY_CHUNK))
+            length -= len(chunk)
+            yield chunk
+
+    def read_chunked(self):
+        total = 0
+        while True:
+            size = chunk_size(self.socket.recv_line())
+            if not size:
+                break
+            total += size
+            if total > self.max_body:
+                raise vanilla.exception.BadRequest(413, 'body too large')
+            while size:
+                chunk = self.read_some(min(size, BODY_CHUNK))
+                size -= len(chunk)
+                yield chunk
+            if self.socket.recv_n(2) != b'\r\n':
+                raise vanilla.exception.BadRequest(400, 'bad chunk')
+        # skip any trailers
+        while self.socket.recv_line():
+            pass
+
+    def wait_body(self):
+        """
+        Waits for the body currently being streamed to be read, or dropped.
+        """
+        if self.reading is not None:
+            self.reading[1].recv()
+
+    def skip_body(self):
+        """
+        Skips whatever is left of the body currently being streamed.
+        """
+        if self.reading is None:
+            return
+        sender, done = self.reading
+        sender.close()
+        # wake the body's green thread if it's waiting to be asked for more
+        sender.interrupt(vanilla.exception.Closed)
+        done.recv()
+
+    def serve(self, handler, concurrency=1, limit=16):
+        """
+        Handles the requests on this connection by calling *handler* with each
+        one, from *concurrency* green threads, and returns straight away.
+
+        Pipelined requests are read ahead, up to *limit* beyond the request
+        whose response is currently being written, and then reading pauses
+        until responses have gone out. Responses are always written in the
+        order the requests arrived, however the handlers finish. A request
+        whose handler raises, or drops it without replying, gets a 500.
+        """
+        requests = self.hub.queue(limit)
+        # each request's reply queue, in the order the requests arrived
+        order = self.hub.queue(limit)
+
+        @self.hub.spawn
+        def reader():
+            try:
+                while True:
+                    sender, recver = self.hub.queue(1)
+                    order.send(recver)
+                    # the previous handler may still be streaming its body
+                    self.wait_body()
+                    try:
+                        request = self.recv(replies=sender)
+                    except (
+                            vanilla.exception.Halt,
+                            vanilla.exception.BadRequest):
+                        sender.close()
+                        break
+                    requests.send(request)
+                    del request, sender, recver
+            finally:
+                requests.close()
+                order.close()
+
+        def worker():
+            for request in requests.recver:
+                try:
+                    handler(request)
+                except Exception as e:
+                    log.warn('Exception in request handler', exc_info=e)
+                    if not request.replied:
+                        request.reply(Status(500), {}, b'')
+                # let go of the request, so an unreplied one is abandoned
+                request = None
+
+        for _ in range(concurrency):
+            self.hub.spawn(worker)
+
+        @self.hub.spawn
+        def writer():
+            for recver in order.recver:
+                try:
+                    response = recver.recv()
+                except vanilla.exception.Closed:
+                    break
+                except vanilla.exception.Abandoned:
+                    response = (Status(500), {}, b'')
+                self.responses.send(response)
+
     # TODO: we should provide the standard Recver API
     def __iter__(self):
         while True:
             try:
                 yield self.recv()
-            except vanilla.exception.Halt:
+            except (vanilla.exception.Halt, vanilla.exception.BadRequest):
                 break
 
 
 class WebSocket:
+    """
+    A WebSocket over *socket*, returned as a `Pair`_.
+
+    Text messages are sent and received as str and binary messages as bytes.
+    A Recver sent as a message is streamed, with each of its chunks going out
+    as a fragment, so a large message doesn't need to be buffered in full.
+    Messages longer than *fragment* bytes are also split up. Fragmented
+    messages received are assembled as their frames arrive, and pings are
+    answered automatically.
+
+    *deflate* is the `PerMessageDeflate` negotiated for the connection, if
+    any.
+    """
     MASK = FIN = 0b10000000
     RSV = 0b01110000
+    RSV1 = 0b01000000
     OP = 0b00001111
     CONTROL = 0b00001000
     PAYLOAD = 0b01111111
 
+    OP_CONTINUATION = 0x0
     OP_TEXT = 0x1
     OP_BIN = 0x2
     OP_CLOSE = 0x8
     OP_PING = 0x9
     OP_PONG = 0xA
 
-    SANITY = 16 * 1024**2  # limit fragments to 16MB
+    SANITY = 16 * 1024**2  # limit messages to 16MB
 
-    def __new__(cls, hub, socket, is_client=True):
+    # messages longer than this are sent in fragments
+    FRAGMENT = 1024**2
+
+    def __new__(
+            cls, hub, socket, is_client=True, fragment=FRAGMENT,
+            deflate=None):
         sender = hub.pipe() \
-            .map(functools.partial(WebSocket.send, is_client)) \
+            .pipe(functools.partial(
+                WebSocket.send, is_client, fragment, deflate)) \
             .pipe(socket).sender
 
         recver = socket \
-            .pipe(functools.partial(WebSocket.recv, is_client)).recver
+            .pipe(functools.partial(
+                WebSocket.recv, is_client, socket, deflate)).recver
 
         @recver.onclose
         def close():
-            MASK = WebSocket.MASK if is_client else 0
-            header = struct.pack(
-                '!BB',
-                WebSocket.OP_CLOSE | WebSocket.FIN,
-                MASK)
-            socket.send(header)
+            socket.send(WebSocket.frame(is_client, WebSocket.OP_CLOSE, b''))
             socket.close()
 
         return vanilla.message.Pair(sender, recver)
 
     @staticmethod
     def mask(mask, s):
-        mask_bytes = [ord(c) for c in mask]
-        return ''.join(
-            chr(mask_bytes[i % 4] ^ ord(c)) for i, c in enumerate(s))
+        """
+        XORs the bytes *s* with the repeating 4 byte *mask*. Rather than
+        working a byte at a time, the payload and the repeated mask are each
+        read as one big integer, so the XOR runs over whole machine words.
+        """
+        n = len(s)
+        if not n:
+            return b''
+        key = (mask * (n // 4 + 1))[:n]
+        return (
+            int.from_bytes(s, 'little') ^ int.from_bytes(key, 'little')
+        ).to_bytes(n, 'little')
 
     @staticmethod
     def accept_key(key):
         value = key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-        return base64.b64encode(hashlib.sha1(value).digest())
+        return base64.b64encode(
+            hashlib.sha1(value.encode('latin-1')).digest()).decode('latin-1')
 
     @staticmethod
-    def send(is_client, data):
+    def frame(is_client, opcode, data, fin=True, rsv=0):
+        """
+        Returns a single frame carrying *data*, as one buffer so frames
+        written by different green threads can't interleave.
+        """
         length = len(data)
 
         MASK = WebSocket.MASK if is_client else 0
+        b1 = opcode | rsv | (WebSocket.FIN if fin else 0)
 
         if length <= 125:
-            header = struct.pack(
-                '!BB',
-                WebSocket.OP_TEXT | WebSocket.FIN,
-                length | MASK)
-
+            header = struct.pack('!BB', b1, length | MASK)
         elif length <= 65535:
-            header = struct.pack(
-                '!BBH',
-                WebSocket.OP_TEXT | WebSocket.FIN,
-                126 | MASK,
-                length)
+            header = struct.pack('!BBH', b1, 126 | MASK, length)
         else:
-            assert length < WebSocket.SANITY, "Frames limited to 16MB for sanity"
-
-            header = struct.pack(
-                '!BBQ',
-                WebSocket.OP_TEXT | WebSocket.FIN,
-                127 | MASK,
-                length)
+            header = struct.pack('!BBQ', b1, 127 | MASK, length)
 
         if is_client:
             mask = os.urandom(4)
@@ -545,10 +1474,68 @@ class WebSocket:
             return header + data
 
     @staticmethod
-    def recv(is_client, upstream, downstream):
+    def send(is_client, fragment, deflate, upstream, downstream):
+        # compressed messages are marked with RSV1 on their first frame
+        rsv = WebSocket.RSV1 if deflate else 0
+
+        def encode(data, final=True):
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if deflate:
+                data = deflate.compress(data, final=final)
+            return data
+
+        def fragments(data):
+            view = memoryview(data)
+            for i in range(0, len(view), fragment):
+                yield view[i:i + fragment]
+
+        for message in upstream:
+            if hasattr(message, 'recv'):
+                # streamed: each chunk is a fragment, and as the last chunk
+                # isn't known until the stream closes, a final frame ends it
+                opcode = None
+                for chunk in message:
+                    if opcode is None:
+                        opcode = WebSocket.OP_TEXT \
+                            if isinstance(chunk, str) else WebSocket.OP_BIN
+                    for data in fragments(encode(chunk, final=False)):
+                        downstream.send(WebSocket.frame(
+                            is_client, opcode, data, fin=False,
+                            rsv=0 if opcode == WebSocket.OP_CONTINUATION
+                            else rsv))
+                        opcode = WebSocket.OP_CONTINUATION
+                if opcode is None:
+                    opcode = WebSocket.OP_BIN
+                downstream.send(WebSocket.frame(
+                    is_client, opcode, encode(b''),
+                    rsv=0 if opcode == WebSocket.OP_CONTINUATION else rsv))
+                continue
+
+            opcode = WebSocket.OP_TEXT \
+                if isinstance(message, str) else WebSocket.OP_BIN
+            frames = list(fragments(encode(message))) or [b'']
+            for n, data in enumerate(frames):
+                downstream.send(WebSocket.frame(
+                    is_client,
+                    WebSocket.OP_CONTINUATION if n else opcode,
+                    data,
+                    fin=n == len(frames) - 1,
+                    rsv=0 if n else rsv))
+
+    @staticmethod
+    def recv(is_client, socket, deflate, upstream, downstream):
+        # the opcode and fragments of the message being assembled
+        opcode = None
+        fragments = []
+        size = 0
+        compressed = False
+
         while True:
             b1, length, = struct.unpack('!BB', upstream.recv_n(2))
-            assert b1 & WebSocket.FIN, "Fragmented messages not supported yet"
+            rsv = b1 & WebSocket.RSV
+            assert not rsv or (deflate and rsv == WebSocket.RSV1), \
+                'unexpected RSV bits'
 
             if is_client:
                 assert not length & WebSocket.MASK
@@ -556,27 +1543,201 @@ class WebSocket:
                 assert length & WebSocket.MASK
                 length = length & WebSocket.PAYLOAD
 
-            # TODO: support binary
-            opcode = b1 & WebSocket.OP
-
-            if opcode & WebSocket.CONTROL:
-                # this is a control frame
-                assert length <= 125
-                if opcode == WebSocket.OP_CLOSE:
-                    upstream.recv_n(length)
-                    upstream.close()
-                    raise vanilla.exception.Closed
-
             if length == 126:
                 length, = struct.unpack('!H', upstream.recv_n(2))
 
             elif length == 127:
                 length, = struct.unpack('!Q', upstream.recv_n(8))
 
-            assert length < WebSocket.SANITY, 'Frames limited to 16MB for sanity'
+            assert size + length < WebSocket.SANITY, \
+                'Messages limited to 16MB for sanity'
 
             if is_client:
-                downstream.send(upstream.recv_n(length))
+                payload = upstream.recv_n(length)
             else:
                 mask = upstream.recv_n(4)
-                downstream.send(WebSocket.mask(mask, upstream.recv_n(length)))
+                payload = WebSocket.mask(mask, upstream.recv_n(length))
+
+            op = b1 & WebSocket.OP
+
+            if op & WebSocket.CONTROL:
+                # control frames can arrive between the fragments of a message
+                assert length <= 125 and b1 & WebSocket.FIN and not rsv
+                if op == WebSocket.OP_CLOSE:
+                    upstream.close()
+                    raise vanilla.exception.Closed
+                if op == WebSocket.OP_PING:
+                    socket.send(WebSocket.frame(
+                        is_client, WebSocket.OP_PONG, payload))
+                continue
+
+            if op == WebSocket.OP_CONTINUATION:
+                assert opcode is not None, 'continuation without a message'
+                assert not rsv, 'RSV1 is only set on the first frame'
+            else:
+                assert opcode is None, 'message interrupted by a new message'
+                opcode = op
+                compressed = bool(rsv)
+
+            fragments.append(payload)
+            size += length
+            if not b1 & WebSocket.FIN:
+                continue
+
+            message = fragments[0] if len(fragments) == 1 \
+                else b''.join(fragments)
+            if compressed:
+                message = deflate.decompress(message, WebSocket.SANITY)
+            if opcode == WebSocket.OP_TEXT:
+                message = message.decode('utf-8')
+            opcode = None
+            fragments = []
+            size = 0
+            downstream.send(message)
+
+
+class PerMessageDeflate:
+    """
+    The permessage-deflate extension (RFC 7692) for one end of a `WebSocket`,
+    with the parameters agreed in the upgrade handshake.
+
+    *window_bits* (9 to 15) caps the LZ77 window used in each direction, and
+    so the memory each end needs per connection. Without *context_takeover*
+    the compression context is reset for every message, which costs ratio but
+    means no state is held between messages.
+    """
+    NAME = 'permessage-deflate'
+    LEVEL = 6
+
+    # the end of a sync flush, removed from every compressed message
+    TAIL = b'\x00\x00\xff\xff'
+
+    def __init__(self, is_client, params):
+        local, remote = ('client', 'server') if is_client \
+            else ('server', 'client')
+        self.send_bits = int(params.get(local + '_max_window_bits') or 15)
+        self.send_takeover = local + '_no_context_takeover' not in params
+        self.recv_bits = int(params.get(remote + '_max_window_bits') or 15)
+        self.recv_takeover = remote + '_no_context_takeover' not in params
+        self.compressor = None
+        self.decompressor = None
+
+    @staticmethod
+    def parse(value):
+        """
+        Parses a Sec-WebSocket-Extensions header into a list of (name,
+        params) for each extension offered.
+        """
+        extensions = []
+        for item in value.split(','):
+            parts = [x.strip() for x in item.split(';')]
+            if not parts[0]:
+                continue
+            params = {}
+            for param in parts[1:]:
+                key, _, value = param.partition('=')
+                params[key.strip().lower()] = value.strip().strip('"') or None
+            extensions.append((parts[0].lower(), params))
+        return extensions
+
+    @classmethod
+    def offer(cls, window_bits=15, context_takeover=True):
+        """
+        Returns the Sec-WebSocket-Extensions offer for a client.
+        """
+        params = [cls.NAME]
+        if window_bits < 15:
+            params.append('server_max_window_bits=%s' % window_bits)
+            params.append('client_max_window_bits=%s' % window_bits)
+        else:
+            params.append('client_max_window_bits')
+        if not context_takeover:
+            params.append('server_no_context_takeover')
+            params.append('client_no_context_takeover')
+        return '; '.join(params)
+
+    @classmethod
+    def accept(cls, value, window_bits=15, context_takeover=True):
+        """
+        Picks the first offer a server can accept from a client's
+        Sec-WebSocket-Extensions *value*. Returns the header value to reply
+        with and the server's `PerMessageDeflate`, or (None, None).
+        """
+        for name, params in cls.parse(value):
+            if name != cls.NAME:
+                continue
+            if set(params) - set([
+                    'server_no_context_takeover', 'client_no_context_takeover',
+                    'server_max_window_bits', 'client_max_window_bits']):
+                continue
+
+            agreed = {}
+            if not context_takeover or 'server_no_context_takeover' in params:
+                agreed['server_no_context_takeover'] = None
+            if not context_takeover or 'client_no_context_takeover' in params:
+                agreed['client_no_context_takeover'] = None
+
+            try:
+                bits = min(window_bits, int(
+                    params.get('server_max_window_bits') or 15))
+                if 'client_max_window_bits' in params:
+                    client_bits = min(window_bits, int(
+                        params['client_max_window_bits'] or 15))
+                    if client_bits < 15:
+                        agreed['client_max_window_bits'] = client_bits
+            except ValueError:
+                continue
+            # zlib can't compress with a window smaller than 9 bits
+            if bits < 9:
+                continue
+            if bits < 15 or 'server_max_window_bits' in params:
+                agreed['server_max_window_bits'] = bits
+
+            reply = [cls.NAME] + [
+                key if value is None else '%s=%s' % (key, value)
+                for key, value in sorted(agreed.items())]
+            return '; '.join(reply), cls(False, agreed)
+        return None, None
+
+    @classmethod
+    def accepted(cls, value):
+        """
+        Returns the client's `PerMessageDeflate` for the server's
+        Sec-WebSocket-Extensions *value*, or None if it was declined.
+        """
+        for name, params in cls.parse(value):
+            if name == cls.NAME:
+                return cls(True, params)
+        return None
+
+    def compress(self, data, final=True):
+        """
+        Compresses *data*. With *final*, *data* ends a message and the
+        compressed message is completed, otherwise it's part of a message
+        which is still being sent.
+        """
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(
+                self.LEVEL, zlib.DEFLATED, -max(self.send_bits, 9))
+        data = self.compressor.compress(data) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if final:
+            if data.endswith(self.TAIL):
+                data = data[:-4]
+            if not self.send_takeover:
+                self.compressor = None
+        return data
+
+    def decompress(self, data, limit):
+        """
+        Decompresses a whole message, refusing to produce more than *limit*
+        bytes.
+        """
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-max(self.recv_bits, 9))
+        data = self.decompressor.decompress(data + self.TAIL, limit)
+        assert not self.decompressor.unconsumed_tail, \
+            'Messages limited to 16MB for sanity'
+        if not self.recv_takeover:
+            self.decompressor = None
+        return data
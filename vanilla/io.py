@@ -1,34 +1,59 @@
+import collections
+import itertools
 import socket
 import fcntl
 import errno
 import ssl
 import os
 
+from greenlet import getcurrent
+
 import vanilla.exception
 import vanilla.message
 import vanilla.poll
 
 
+# bytes queued by Sender.write before it flushes without being asked to
+FLUSH_THRESHOLD = 65536
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# errors from os.sendfile which mean it can't be used for a pair of
+# descriptors, rather than that the write failed
+SENDFILE_UNSUPPORTED = set(
+    getattr(errno, name) for name in
+    ('EINVAL', 'ENOSYS', 'ENOTSOCK', 'EOPNOTSUPP', 'ENOTSUP')
+    if hasattr(errno, name))
+
+
 class __plugin__:
     def __init__(self, hub):
         self.hub = hub
 
-    def fd_in(self, fd):
-        return Recver(FD_from_fileno_in(self.hub, fd))
+    def fd_in(self, fd, reads=None):
+        return Recver(FD_from_fileno_in(self.hub, fd), reads=reads)
 
-    def fd_out(self, fd):
-        return Sender(FD_from_fileno_out(self.hub, fd))
+    def fd_out(self, fd, threshold=FLUSH_THRESHOLD):
+        return Sender(FD_from_fileno_out(self.hub, fd), threshold=threshold)
 
-    def pipe(self):
+    def pipe(self, threshold=FLUSH_THRESHOLD, reads=None):
         r, w = os.pipe()
-        recver = Recver(FD_from_fileno_in(self.hub, r))
-        sender = Sender(FD_from_fileno_out(self.hub, w))
+        recver = Recver(FD_from_fileno_in(self.hub, r), reads=reads)
+        sender = Sender(FD_from_fileno_out(self.hub, w), threshold=threshold)
         return vanilla.message.Pair(sender, recver)
 
-    def socket(self, conn):
+    def socket(self, conn, threshold=FLUSH_THRESHOLD, reads=None):
+        """
+        Returns a `Pair`_ for the socket *conn*. *threshold* is the flush
+        threshold for the `Sender`_. *reads* is a callable returning the read
+        strategy for the `Recver`_; it defaults to `ReadSize`_.
+        """
         fd = FD_from_socket(self.hub, conn)
-        recver = vanilla.io.Recver(fd)
-        sender = vanilla.io.Sender(fd)
+        recver = vanilla.io.Recver(fd, reads=reads)
+        sender = vanilla.io.Sender(fd, threshold=threshold)
         return vanilla.message.Pair(sender, recver)
 
 
@@ -49,6 +74,9 @@ class FD_from_fileno_in:
     def read(self, n):
         return os.read(self.fileno, n)
 
+    def read_into(self, buffer):
+        return os.readv(self.fileno, [buffer])
+
     def close(self):
         try:
             os.close(self.fileno)
@@ -67,6 +95,9 @@ class FD_from_fileno_out:
     def write(self, data):
         return os.write(self.fileno, data)
 
+    def writev(self, buffers):
+        return os.writev(self.fileno, buffers)
+
     def close(self):
         try:
             os.close(self.fileno)
@@ -88,9 +119,18 @@ class FD_from_socket:
     def read(self, n):
         return self.conn.recv(n)
 
+    def read_into(self, buffer):
+        return self.conn.recv_into(buffer)
+
     def write(self, data):
         return self.conn.send(data)
 
+    def writev(self, buffers):
+        # ssl sockets don't support sendmsg
+        if isinstance(self.conn, ssl.SSLSocket):
+            return self.conn.send(b''.join(buffers))
+        return self.conn.sendmsg(buffers)
+
     def close(self):
         if self.closed:
             return
@@ -100,31 +140,130 @@ class FD_from_socket:
 
 
 class Sender:
-    def __init__(self, fd):
+    """
+    Writes to a file descriptor. Buffers given to :meth:`write` are queued and
+    gathered into a single writev/sendmsg call by :meth:`flush`. Once
+    *threshold* bytes are queued, :meth:`write` flushes by itself.
+    :meth:`send` is a write followed by a flush.
+    """
+    def __init__(self, fd, threshold=FLUSH_THRESHOLD):
         self.fd = fd
         self.hub = fd.hub
+        self.threshold = threshold
+
+        self.pending = collections.deque()
+        self.queued = 0
+        self.flushing = False
+        self.waiters = []
 
         self.gate = self.hub.router().pipe(self.hub.state())
         self.fd.pollout.pipe(self.gate)
         self.fd.pollout.onclose(self.close)
 
-        @self.hub.serialize
-        def send(data, timeout=-1):
-            # TODO: test timeout
-            while True:
+    def write(self, data):
+        if data:
+            self.pending.append(data)
+            self.queued += len(data)
+        if self.queued >= self.threshold:
+            self.flush()
+
+    def send(self, data, timeout=-1):
+        # TODO: test timeout
+        self.write(data)
+        self.flush()
+
+    def flush(self):
+        if self.flushing:
+            # the green thread already flushing will gather our data too
+            self.waiters.append(getcurrent())
+            self.hub.pause()
+            return
+
+        self.flushing = True
+        try:
+            while self.pending:
+                try:
+                    n = self.fd.writev(
+                        list(itertools.islice(self.pending, IOV_MAX)))
+                except (socket.error, OSError) as e:
+                    if e.errno == errno.EAGAIN:
+                        self.gate.clear().recv()
+                        continue
+                    self.close()
+                    raise vanilla.exception.Closed()
+                self.advance(n)
+        finally:
+            self.flushing = False
+            self.wake()
+
+    def sendfile(self, fileno, offset, count):
+        """
+        Sends *count* bytes from *offset* of the file *fileno* with
+        os.sendfile, so the data never passes through Python, pausing on
+        POLLOUT whenever the descriptor is full. Anything already written is
+        flushed first, and writes made meanwhile go out after the file.
+
+        Returns the number of bytes sent. This is short of *count* if the file
+        ends early, or if sendfile can't be used for this descriptor, in which
+        case the caller can send the rest some other way.
+        """
+        self.flush()
+        if not hasattr(os, 'sendfile') or \
+                isinstance(getattr(self.fd, 'conn', None), ssl.SSLSocket):
+            return 0
+
+        sent = 0
+        self.flushing = True
+        try:
+            while sent < count:
                 try:
-                    n = self.fd.write(data)
+                    n = os.sendfile(
+                        self.fd.fileno, fileno, offset + sent, count - sent)
                 except (socket.error, OSError) as e:
                     if e.errno == errno.EAGAIN:
                         self.gate.clear().recv()
                         continue
+                    if e.errno in SENDFILE_UNSUPPORTED:
+                        break
                     self.close()
                     raise vanilla.exception.Closed()
-                if n == len(data):
+                if not n:
                     break
-                data = data[n:]
-
-        self.send = send
+                sent += n
+        except BaseException:
+            self.flushing = False
+            # writes waiting behind the file can't go out now
+            self.wake(failed=True)
+            raise
+        self.flushing = False
+        # send anything written while the file was going out, which wakes
+        # the green threads waiting on it
+        self.flush()
+        return sent
+
+    def wake(self, failed=False):
+        """
+        Wakes the green threads waiting on a flush, throwing them `Closed`_
+        if their data can't be sent.
+        """
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if failed or self.pending:
+                self.hub.throw_to(waiter, vanilla.exception.Closed())
+            else:
+                self.hub.switch_to(waiter)
+
+    def advance(self, n):
+        # drop the buffers which were written in full, and replace a
+        # partially written one with a view onto its remainder
+        self.queued -= n
+        while n:
+            size = len(self.pending[0])
+            if n < size:
+                self.pending[0] = memoryview(self.pending[0])[n:]
+                return
+            self.pending.popleft()
+            n -= size
 
     def connect(self, recver):
         recver.consume(self.send)
@@ -134,9 +273,43 @@ class Sender:
         self.fd.close()
 
 
-def Recver(fd):
+class ReadSize:
+    """
+    Decides how much a `Recver`_ asks for on each read. The size starts at
+    *minimum*, doubles up to *maximum* each time a read fills it and halves
+    back towards *minimum* when a read comes back less than a quarter full.
+
+    With *into*, reads go into one preallocated bytearray of *maximum* bytes,
+    and only the bytes actually read are copied out, rather than allocating a
+    new object of the full requested size for every read.
+    """
+    def __init__(self, minimum=4096, maximum=262144, into=False):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = minimum
+        self.buffer = bytearray(maximum) if into else None
+
+    def update(self, n):
+        if n >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+        elif n < self.size // 4:
+            self.size = max(self.size // 2, self.minimum)
+
+    def read(self, fd):
+        if self.buffer is None:
+            data = fd.read(self.size)
+        else:
+            with memoryview(self.buffer) as view:
+                n = fd.read_into(view[:self.size])
+                data = view[:n].tobytes()
+        self.update(len(data))
+        return data
+
+
+def Recver(fd, reads=None):
     hub = fd.hub
     sender, recver = hub.pipe()
+    reads = (reads or ReadSize)()
 
     recver.onclose(fd.close)
 
@@ -145,7 +318,7 @@ def Recver(fd):
         for _ in fd.pollin:
             while True:
                 try:
-                    data = fd.read(16384)
+                    data = reads.read(fd)
                 except (socket.error, OSError) as e:
                     if e.errno == errno.EAGAIN:
                         break
@@ -58,6 +58,9 @@ class Pair(Pair):
     def recv_n(self, n, timeout=-1):
         return self.recver.recv_n(n, timeout=timeout)
 
+    def recv_into(self, buffer, timeout=-1):
+        return self.recver.recv_into(buffer, timeout=timeout)
+
     def recv_partition(self, sep, timeout=-1):
         return self.recver.recv_partition(sep, timeout=timeout)
 
@@ -133,18 +136,23 @@ class Pipe:
         p.recv()      # returns 1
     """
 
+    # Pipes are created constantly, so the Pipe and its Ends are slotted to
+    # keep them small. The Pipe only holds what's shared between the two Ends
+    __slots__ = ['hub', 'closed', 'closers', 'sender', 'recver']
+
     def __new__(cls, hub):
         self = super(Pipe, cls).__new__(cls)
         self.hub = hub
         self.closed = False
 
+        # both weakrefs share a single bound callback
+        on_abandoned = self.on_abandoned
+
         recver = Recver(self)
-        self.recver = weakref.ref(recver, self.on_abandoned)
-        self.recver_current = None
+        self.recver = weakref.ref(recver, on_abandoned)
 
         sender = Sender(self)
-        self.sender = weakref.ref(sender, self.on_abandoned)
-        self.sender_current = None
+        self.sender = weakref.ref(sender, on_abandoned)
 
         return Pair(sender, recver)
 
@@ -160,12 +168,15 @@ class Pipe:
 
 
 class End:
+    # *current* is the green thread currently waiting on this End. the
+    # __dict__ slot is only allocated for ends which are given extra
+    # attributes, such as Streams or piped Recvers
+    __slots__ = ['middle', 'hub', 'current', '__dict__', '__weakref__']
+
     def __init__(self, pipe):
         self.middle = pipe
-
-    @property
-    def hub(self):
-        return self.middle.hub
+        self.hub = pipe.hub
+        self.current = None
 
     @property
     def halted(self):
@@ -175,9 +186,10 @@ class End:
     def ready(self):
         if self.middle.closed:
             raise vanilla.exception.Closed
-        if self.other is None:
+        other = self.other
+        if other is None:
             raise vanilla.exception.Abandoned
-        return bool(self.other.current)
+        return bool(other.current)
 
     def select(self):
         assert self.current is None
@@ -187,9 +199,13 @@ class End:
         assert self.current == getcurrent()
         self.current = None
 
-    def abandoned(self):
+    def interrupt(self, exception):
+        # throw *exception* to the green thread waiting on this End
         if self.current:
-            self.hub.throw_to(self.current, vanilla.exception.Abandoned)
+            self.hub.throw_to(self.current, exception)
+
+    def abandoned(self):
+        self.interrupt(vanilla.exception.Abandoned)
 
     @property
     def peak(self):
@@ -204,22 +220,23 @@ class End:
         return ret
 
     def onclose(self, f, *a, **kw):
-        if not hasattr(self.middle, 'closers'):
+        if getattr(self.middle, 'closers', None) is None:
             self.middle.closers = [(f, a, kw)]
         else:
             self.middle.closers.append((f, a, kw))
 
     def close(self, exception=vanilla.exception.Closed):
-        closers = getattr(self.middle, 'closers', [])
+        closers = getattr(self.middle, 'closers', None)
         if closers:
-            del self.middle.closers
+            self.middle.closers = None
 
         self.middle.closed = True
 
-        if self.other is not None and bool(self.other.current):
-            self.hub.throw_to(self.other.current, exception)
+        other = self.other
+        if other is not None:
+            other.interrupt(exception)
 
-        for f, a, kw in closers:
+        for f, a, kw in closers or ():
             try:
                 f(*a, **kw)
             except vanilla.exception.Halt:
@@ -230,13 +247,7 @@ class End:
 
 
 class Sender(End):
-    @property
-    def current(self):
-        return self.middle.sender_current
-
-    @current.setter
-    def current(self, value):
-        self.middle.sender_current = value
+    __slots__ = []
 
     @property
     def other(self):
@@ -247,14 +258,25 @@ class Sender(End):
         Send an *item* on this pair. This will block unless our Rever is ready,
         either forever or until *timeout* milliseconds.
         """
+        # this is the hot path, so the ready check is inlined
+        middle = self.middle
+        if middle.closed:
+            raise vanilla.exception.Closed
+        other = middle.recver()
+        if other is None:
+            raise vanilla.exception.Abandoned
 
-        if not self.ready:
+        if not other.current:
+            # don't hold a reference to our recver while we wait, so that it
+            # can still be abandoned
+            del other
             self.pause(timeout=timeout)
+            other = self.middle.recver()
 
         if isinstance(item, Exception):
-            return self.hub.throw_to(self.other.peak, item)
+            return self.hub.throw_to(other.peak, item)
 
-        return self.hub.switch_to(self.other.peak, self.other, item)
+        return self.hub.switch_to(other.peak, other, item)
 
     def handover(self, recver):
         assert recver.ready
@@ -286,7 +308,6 @@ class Sender(End):
 
         del m1.recver
         m1.recver = weakref.ref(r2, m1.on_abandoned)
-        m1.recver_current = m2.recver_current
 
         del r1.middle
         del s2.middle
@@ -300,13 +321,7 @@ class Sender(End):
 
 
 class Recver(End):
-    @property
-    def current(self):
-        return self.middle.recver_current
-
-    @current.setter
-    def current(self, value):
-        self.middle.recver_current = value
+    __slots__ = []
 
     @property
     def other(self):
@@ -317,8 +332,17 @@ class Recver(End):
         Receive and item from our Sender. This will block unless our Sender is
         ready, either forever or unless *timeout* milliseconds.
         """
-        if self.ready:
-            return self.other.handover(self)
+        # this is the hot path, so the ready check is inlined
+        middle = self.middle
+        if middle.closed:
+            raise vanilla.exception.Closed
+        other = middle.sender()
+        if other is None:
+            raise vanilla.exception.Abandoned
+
+        if other.current:
+            return other.handover(self)
+        del other
         return self.pause(timeout=timeout)
 
     def __iter__(self):
@@ -439,7 +463,7 @@ class Recver(End):
                     break
 
 
-def Queue(hub, size):
+class Queue(Pipe):
     """
     ::
 
@@ -448,9 +472,8 @@ def Queue(hub, size):
                  | (buffer) | --> recv
                  +----------+
 
-    A Queue may also only have exactly one sender and recver. A Queue however
-    has a fifo buffer of a custom size. Sends to the Queue won't block until
-    the buffer becomes full::
+    A Queue is a Pipe with a fifo buffer of a custom size. Sends to the Queue
+    won't block until the buffer becomes full::
 
         h = vanilla.Hub()
         q = h.queue(1)
@@ -458,58 +481,168 @@ def Queue(hub, size):
         # q.send(1)    # this would deadlock however as the queue only has a
                        # buffer size of 1
         q.recv()       # returns 1
+
+    Sends append directly to the buffer and only block while it's full, and
+    recvs only block while it's empty. Any number of green threads can be
+    waiting on either end, which is what buffered `Channel`_'s are built on.
     """
-    assert size > 0
+    __slots__ = ['items', 'size']
+
+    class Sender(Sender):
+        def select(self):
+            assert getcurrent() not in self.current
+            self.current.append(getcurrent())
 
-    def main(upstream, downstream, size):
-        queue = collections.deque()
+        def unselect(self):
+            self.current.remove(getcurrent())
 
-        while True:
-            if downstream.halted:
-                # no one is downstream, so shutdown
-                upstream.close()
-                return
-
-            watch = []
-            if queue:
-                watch.append(downstream)
-            else:
-                # if the buffer is empty, and no one is upstream, shutdown
-                if upstream.halted:
-                    downstream.close()
+        @property
+        def peak(self):
+            return self.current[0]
+
+        def interrupt(self, exception):
+            for current in list(self.current):
+                self.hub.throw_to(current, exception)
+
+        @property
+        def ready(self):
+            middle = self.middle
+            if middle.closed:
+                raise vanilla.exception.Closed
+            other = middle.recver()
+            if other is None:
+                raise vanilla.exception.Abandoned
+            return bool(other.current) or len(middle.items) < middle.size
+
+        def send(self, item, timeout=-1):
+            while True:
+                middle = self.middle
+                if middle.closed:
+                    raise vanilla.exception.Closed
+                other = middle.recver()
+                if other is None:
+                    raise vanilla.exception.Abandoned
+
+                if other.current:
+                    # a recver is waiting, which means the buffer is empty,
+                    # so hand the item straight over
+                    if isinstance(item, Exception):
+                        return self.hub.throw_to(other.peak, item)
+                    return self.hub.switch_to(other.peak, other, item)
+
+                if len(middle.items) < middle.size:
+                    middle.items.append(item)
                     return
 
-            # if are upstream is still available, and there is spare room in
-            # the buffer, watch upstream as well
-            if not upstream.halted and len(queue) < size:
-                watch.append(upstream)
+                # the buffer is full, wait for a recv to make room
+                del other
+                self.pause(timeout=timeout)
 
-            try:
-                ch, item = hub.select(watch)
-            except vanilla.exception.Halt:
-                continue
+        def connect(self, recver):
+            self.onclose(recver.close)
+            recver.onclose(self.close)
+            recver.consume(self.send)
+            return self.other
 
-            if ch == upstream:
-                queue.append(item)
+    class Recver(Recver):
+        def select(self):
+            assert getcurrent() not in self.current
+            self.current.append(getcurrent())
 
-            elif ch == downstream:
-                item = queue.popleft()
-                downstream.send(item)
+        def unselect(self):
+            self.current.remove(getcurrent())
 
-    upstream = hub.pipe()
-    downstream = hub.pipe()
+        @property
+        def peak(self):
+            return self.current[0]
 
-    # TODO: rethink this
-    old_connect = upstream.sender.connect
+        def interrupt(self, exception):
+            for current in list(self.current):
+                self.hub.throw_to(current, exception)
 
-    def connect(recver):
-        old_connect(recver)
-        return downstream.recver
+        @property
+        def halted(self):
+            middle = self.middle
+            return bool(
+                not middle.items and
+                (middle.closed or middle.sender() is None))
 
-    upstream.sender.connect = connect
+        @property
+        def ready(self):
+            middle = self.middle
+            if middle.items:
+                return True
+            if middle.closed:
+                raise vanilla.exception.Closed
+            if middle.sender() is None:
+                raise vanilla.exception.Abandoned
+            # senders only wait on a full buffer
+            return False
 
-    hub.spawn(main, upstream.recver, downstream.sender, size)
-    return Pair(upstream.sender, downstream.recver)
+        def recv(self, timeout=-1):
+            middle = self.middle
+            items = middle.items
+
+            # buffered items are still delivered after our sender has gone
+            if items:
+                item = items.popleft()
+                other = middle.sender()
+                if other is not None and other.current:
+                    # wake a sender which is waiting for room
+                    self.hub.switch_to(other.peak, other, None)
+                if isinstance(item, Exception):
+                    raise item
+                return item
+
+            if middle.closed:
+                raise vanilla.exception.Closed
+            if middle.sender() is None:
+                raise vanilla.exception.Abandoned
+            return self.pause(timeout=timeout)
+
+        def pipe(self, target):
+            if callable(target):
+                return super(Queue.Recver, self).pipe(target)
+
+            # the buffer lives on our middle, so rather than rewiring the
+            # target's recver onto it, forward items on to the target
+            if isinstance(target, Pair):
+                sender, recver = target
+            else:
+                sender, recver = target, target.other
+
+            @self.hub.spawn
+            def _():
+                while True:
+                    try:
+                        item = self.recv()
+                    except vanilla.exception.Halt:
+                        sender.close()
+                        return
+                    except Exception as e:
+                        item = e
+
+                    try:
+                        sender.send(item)
+                    except vanilla.exception.Halt:
+                        self.close()
+                        return
+
+            return recver
+
+    def __new__(cls, hub, size):
+        assert size > 0
+        sender, recver = Pipe.__new__(cls, hub)
+
+        middle = sender.middle
+        middle.items = collections.deque()
+        middle.size = size
+
+        sender.__class__ = Queue.Sender
+        sender.current = collections.deque()
+        recver.__class__ = Queue.Recver
+        recver.current = collections.deque()
+        return Pair(sender, recver)
 
 
 class Dealer:
@@ -705,39 +838,73 @@ class Stream:
     A `Stream`_ is a specialized `Recver`_ which provides additional methods
     for working with streaming sources, particularly sockets and file
     descriptors.
+
+    Received data is accumulated in a single growable ``bytearray`` so that
+    :meth:`recv_n` and :meth:`recv_partition` are linear in the amount of data
+    received, regardless of how it was chunked.
     """
     class Recver(Recver):
+        def fill(self, timeout=-1):
+            self.buffer += super(Stream.Recver, self).recv(timeout=timeout)
+
+        def take(self, n):
+            with memoryview(self.buffer) as view:
+                got = view[:n].tobytes()
+            del self.buffer[:n]
+            self.scanned = max(0, self.scanned - n)
+            return got
+
         def recv(self, timeout=-1):
-            if self.extra:
-                extra = self.extra
-                self.extra = ''
-                return extra
+            if self.buffer:
+                return self.take(len(self.buffer))
             return super(Stream.Recver, self).recv(timeout=timeout)
 
+        def recv_into(self, buffer, timeout=-1):
+            """
+            Receives up to len(*buffer*) bytes into the writable *buffer*,
+            blocking only if no data is pending. Returns the number of bytes
+            written.
+            """
+            if not self.buffer:
+                self.fill(timeout=timeout)
+            with memoryview(buffer) as target:
+                n = min(len(target), len(self.buffer))
+                with memoryview(self.buffer) as view:
+                    target[:n] = view[:n]
+            del self.buffer[:n]
+            self.scanned = max(0, self.scanned - n)
+            return n
+
         def recv_n(self, n, timeout=-1):
             """
             Blocks until *n* bytes of data are available, and then returns
             them.
             """
-            got = ''
-            if n:
-                while len(got) < n:
-                    got += self.recv(timeout=timeout)
-                got, self.extra = got[:n], got[n:]
-            return got
+            while len(self.buffer) < n:
+                self.fill(timeout=timeout)
+            return self.take(n)
 
         def recv_partition(self, sep, timeout=-1):
             """
             Blocks until the seperator *sep* is seen in the stream, and then
             returns all data received until *sep*.
             """
-            got = ''
+            if not isinstance(sep, bytes):
+                sep = sep.encode()
+            if sep != self.scanning:
+                self.scanning = sep
+                self.scanned = 0
             while True:
-                got += self.recv(timeout=timeout)
-                keep, matched, extra = got.partition(sep)
-                if matched:
-                    self.extra = extra
-                    return keep
+                found = self.buffer.find(sep, self.scanned)
+                if found != -1:
+                    got = self.take(found)
+                    del self.buffer[:len(sep)]
+                    self.scanned = 0
+                    return got
+                # resume the search where it stopped, allowing for a
+                # separator split across chunks
+                self.scanned = max(0, len(self.buffer) - len(sep) + 1)
+                self.fill(timeout=timeout)
 
         def recv_line(self, timeout=-1):
             """
@@ -747,8 +914,10 @@ class Stream:
             """
             return self.recv_partition(self.sep, timeout=timeout)
 
-    def __new__(cls, recver, sep='\n'):
+    def __new__(cls, recver, sep=b'\n'):
         recver.__class__ = Stream.Recver
-        recver.extra = ''
+        recver.buffer = bytearray()
+        recver.scanned = 0
+        recver.scanning = None
         recver.sep = sep
         return recver
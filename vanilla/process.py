@@ -1,21 +1,52 @@
 from __future__ import absolute_import
 
 
+import collections
 import functools
+import importlib
+import tempfile
 import logging
+import marshal
 import select
+import socket
+import struct
 import errno
 import signal
 import ctypes
+import array
+import types
+import traceback
 import sys
+import io
 import os
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 import vanilla.exception
+import vanilla.tcp
+import vanilla.io
 
 
 log = logging.getLogger(__name__)
 
 
+# milliseconds to wait before replacing a worker which died, so a worker
+# which crashes on start doesn't have the supervisor forking flat out
+RESTART_DELAY = 1000
+# milliseconds a worker has to finish its connections once asked to stop
+GRACE = 10000
+
+# each message between a Zygote and its template process, and each result
+# from a worker, is a length followed by that many bytes of pickle
+FRAME = struct.Struct('!Q')
+# a worker's stdin, stdout, stderr and result pipe, passed to the template
+# with the request to fork it
+WORKER_FDS = 4
+
+
 # TODO: investigate the equivalent for BSD and OSX
 # TODO: should move this and poll into some kind of compat module
 #
@@ -25,6 +56,7 @@ log = logging.getLogger(__name__)
 def set_pdeathsig():
     pass
 
+
 if hasattr(select, 'epoll'):
     try:
         PR_SET_PDEATHSIG = 1
@@ -37,6 +69,70 @@ if hasattr(select, 'epoll'):
         log.warn('unable to load libc: needed to set PR_SET_PDEATHSIG')
 
 
+def frame(data):
+    return FRAME.pack(len(data)) + data
+
+
+def recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1048576))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def dump_call(f, a, kw):
+    """
+    Pickles a call of *f* with *a* and *kw*. A plain function is sent as its
+    marshalled code, so it needn't have existed when the template process was
+    forked, and runs against the template's copy of its module, along with
+    its default arguments. Any other callable is pickled as it is.
+
+    A closure's free variables can't be sent this way, so a function with
+    one is refused with a ValueError.
+    """
+    if isinstance(f, types.FunctionType):
+        if f.__closure__:
+            raise ValueError(
+                "can't send closure %s: its free variables (%s) aren't "
+                "sent with its code" % (
+                    f.__name__, ', '.join(f.__code__.co_freevars)))
+        f = (
+            'code',
+            marshal.dumps(f.__code__),
+            f.__module__,
+            f.__defaults__,
+            getattr(f, '__kwdefaults__', None))
+    else:
+        f = ('callable', f)
+    return pickle.dumps((f, a, kw), pickle.HIGHEST_PROTOCOL)
+
+
+def load_call(data):
+    f, a, kw = pickle.loads(data)
+    if f[0] == 'code':
+        _, code, module, defaults, kwdefaults = f
+        try:
+            env = importlib.import_module(module).__dict__
+        except ImportError:
+            env = {'__builtins__': __builtins__}
+        f = types.FunctionType(marshal.loads(code), env, 'f', defaults)
+        if kwdefaults:
+            f.__kwdefaults__ = kwdefaults
+    else:
+        f = f[1]
+    return f, a, kw
+
+
 class __plugin__:
     def __init__(self, hub):
         self.hub = hub
@@ -79,41 +175,90 @@ class __plugin__:
                 continue
             self.children = [
                 child for child in self.children if child.check_liveness()]
-        self.sigchld.close()
-        self.sigchld = None
+        sigchld, self.sigchld = self.sigchld, None
+        sigchld.close()
+        # a child forked while the subscription was closing needs a new one
+        if self.children:
+            self.watching()
 
     def bootstrap(self, f, *a, **kw):
-        import marshal
-        import cPickle as pickle
-
-        pipe_r, pipe_w = os.pipe()
-        os.write(pipe_w, pickle.dumps((marshal.dumps(f.func_code), a, kw)))
-        os.close(pipe_w)
+        # the call goes in an unlinked temporary file, rather than a pipe, so
+        # it can be any size without the write blocking before the exec
+        payload = tempfile.TemporaryFile()
+        payload.write(pickle.dumps(
+            (marshal.dumps(f.__code__), a, kw), pickle.HIGHEST_PROTOCOL))
+        payload.flush()
+        fd = payload.fileno()
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.set_inheritable(fd, True)
 
         bootstrap = '\n'.join(x.strip() for x in ("""
-            import cPickle as pickle
+            import pickle
             import marshal
             import types
             import sys
             import os
 
-            code, a, kw = pickle.loads(os.read(%(pipe_r)s, 4096))
-            os.close(%(pipe_r)s)
+            payload = os.fdopen(%(fd)s, 'rb')
+            code, a, kw = pickle.loads(payload.read())
+            payload.close()
 
             f = types.FunctionType(marshal.loads(code), globals(), 'f')
             f(*a, **kw)
-        """ % {'pipe_r': pipe_r}).split('\n') if x)
+        """ % {'fd': fd}).split('\n') if x)
 
         argv = [sys.executable, '-u', '-c', bootstrap]
         os.execv(argv[0], argv)
 
-    def launch(self, f, *a, **kw):
-        stderrtoout = kw.pop('stderrtoout', False)
-
+    def watching(self):
         if not self.sigchld:
             self.sigchld = self.hub.signal.subscribe(signal.SIGCHLD)
             self.hub.spawn(self.watch)
 
+    def fork(self, f, *a, **kw):
+        """
+        Forks a child which calls *f* with *a* and *kw* and then exits, with
+        its stdio shared with ours. Returns the `Child`.
+        """
+        self.watching()
+
+        pid = os.fork()
+
+        if pid == 0:
+            # child process
+            code = 0
+            try:
+                set_pdeathsig()
+                f(*a, **kw)
+            except BaseException:
+                log.exception('child %s failed', os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+
+        child = self.Child(self.hub, pid)
+        self.children.append(child)
+        return child
+
+    def prefork(self, serve, workers, port=0, host='127.0.0.1', **kw):
+        """
+        Returns a `Prefork` supervisor running *workers* processes, each
+        calling *serve* with connections to *host*:*port*.
+        """
+        return Prefork(self.hub, serve, workers, port=port, host=host, **kw)
+
+    def zygote(self, preload=()):
+        """
+        Returns a `Zygote`, a template process with the modules named in
+        *preload* imported, which forks workers on request.
+        """
+        return Zygote(self.hub, preload)
+
+    def launch(self, f, *a, **kw):
+        stderrtoout = kw.pop('stderrtoout', False)
+
+        self.watching()
+
         inpipe_r, inpipe_w = os.pipe()
         outpipe_r, outpipe_w = os.pipe()
 
@@ -187,3 +332,395 @@ class __plugin__:
             args[0],
             args,
             stderrtoout=stderrtoout)
+
+
+class Prefork:
+    """
+    Runs *size* worker processes which share a listening socket. Each worker
+    runs *serve(hub, server)* on a hub of its own, where *server* is a
+    `Recver`_ of the connections it accepts.
+
+    The socket is bound once by the supervisor and inherited by the workers.
+    With *reuse_port*, each worker instead binds its own socket with
+    SO_REUSEPORT, and the kernel spreads connections between them.
+
+    Workers which die are replaced after RESTART_DELAY milliseconds. A worker
+    asked to stop, with SIGTERM, closes its *server* and exits once *serve*
+    returns, or after *grace* milliseconds.
+    """
+    def __init__(
+            self, hub, serve, size, port=0, host='127.0.0.1',
+            reuse_port=False, grace=GRACE, **kw):
+        self.hub = hub
+        self.serve = serve
+        self.size = size
+        self.host = host
+        self.reuse_port = reuse_port
+        self.grace = grace
+        self.kw = kw
+
+        # with reuse_port, the supervisor's socket only reserves the port
+        self.sock = vanilla.tcp.bind(
+            port, host, reuse_port=reuse_port, listen=not reuse_port)
+        self.port = self.sock.getsockname()[1]
+
+        # pid -> Child for the current workers
+        self.workers = {}
+        self.stopping = False
+        self.restarts = 0
+
+        for i in range(size):
+            self.start()
+
+    def start(self):
+        """
+        Forks a new worker, and returns its `Child` once it's accepting
+        connections.
+        """
+        r, w = os.pipe()
+        child = self.hub.process.fork(self.worker, r, w)
+        os.close(w)
+        child.retired = False
+        # set by watch, which is the one waiting on child.done
+        child.exited = self.hub.state()
+        self.workers[child.pid] = child
+        self.hub.spawn(self.watch, child)
+
+        # the worker writes a byte once it's accepting and closes its end,
+        # and the pipe is left to close itself at the end of file
+        for _ in self.hub.io.fd_in(r):
+            pass
+        return child
+
+    def worker(self, r, w):
+        os.close(r)
+        # the handlers inherited from the supervisor write to its hub
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+
+        h = vanilla.Hub()
+        if self.reuse_port:
+            self.sock.close()
+            server = h.tcp.listen(
+                self.port, self.host, reuse_port=True, **self.kw)
+        else:
+            server = h.tcp.accept(self.sock, **self.kw)
+
+        events = h.router()
+        term = h.signal.subscribe(signal.SIGTERM)
+
+        @h.spawn
+        def _():
+            try:
+                self.serve(h, server)
+            finally:
+                events.send('done')
+
+        @h.spawn
+        def _():
+            term.recv()
+            events.send('term')
+
+        os.write(w, b'\x01')
+        os.close(w)
+
+        if events.recv() == 'term':
+            server.close()
+            # wake serve if it's waiting for a connection
+            server.interrupt(vanilla.exception.Closed)
+            try:
+                events.recv(timeout=self.grace)
+            except vanilla.exception.Timeout:
+                pass
+
+    def watch(self, child):
+        child.done.recv()
+        del self.workers[child.pid]
+        child.exited.send(True)
+        if self.stopping or child.retired:
+            return
+        log.warning(
+            'worker %s died (exit code %s, signal %s), restarting',
+            child.pid, child.exitcode, child.exitsignal)
+        self.restarts += 1
+        self.hub.sleep(RESTART_DELAY)
+        if not self.stopping:
+            self.start()
+
+    def retire(self, child):
+        child.retired = True
+        self.terminate(child)
+        child.exited.recv()
+
+    def terminate(self, child):
+        try:
+            child.terminate()
+        except OSError:
+            # it's already gone
+            pass
+
+    def restart(self):
+        """
+        Replaces the workers one at a time, starting each replacement before
+        stopping the worker it replaces, so the port is always served.
+        """
+        for child in list(self.workers.values()):
+            self.start()
+            self.retire(child)
+
+    def stop(self):
+        """
+        Stops all the workers, waiting for them to exit.
+        """
+        self.stopping = True
+        workers = list(self.workers.values())
+        for child in workers:
+            self.terminate(child)
+        for child in workers:
+            child.exited.recv()
+        self.sock.close()
+
+
+class Zygote:
+    """
+    Forks workers from a template process rather than starting a fresh
+    interpreter for each one. The template is forked from us when the Zygote
+    is created, so it has everything we've imported so far, along with the
+    modules named in *preload*. It also inherits our open descriptors, so a
+    Zygote is best created early.
+
+    Each request to the template carries the worker's stdio and result pipes,
+    and the call itself as a frame of pickle, so the arguments, and the
+    result, can be any size. The template reports the worker's pid, and later
+    how it exited, as the workers are its children rather than ours.
+    """
+    class Child(__plugin__.Child):
+        def __init__(self, hub, pid):
+            super(Zygote.Child, self).__init__(hub, pid)
+            self.exitcode = self.exitsignal = None
+
+        def check_liveness(self):
+            return self.exitcode is None and self.exitsignal is None
+
+        def exited(self, status):
+            self.exitcode = status >> 8
+            self.exitsignal = status & (2**8-1)
+            self.done.send(self)
+
+    def __init__(self, hub, preload=()):
+        self.hub = hub
+        # pid -> Child for the workers which are still running
+        self.children = {}
+        # for each request sent, in order, the sender for the worker's Child
+        self.pending = collections.deque()
+        self.requests = self.hub.pipe()
+
+        self.sock, theirs = socket.socketpair()
+        self.template = self.hub.process.fork(
+            self.main, self.sock, theirs, preload)
+        theirs.close()
+
+        self.ctl = self.hub.io.socket(self.sock)
+        self.hub.spawn(self.reader)
+        self.hub.spawn(self.writer)
+
+    def spawn(self, f, *a, **kw):
+        """
+        Forks a worker from the template which calls *f* with *a* and *kw*
+        and then exits. Returns its `Child`, which has *stdin*, *stdout* and
+        *stderr* as for :meth:`__plugin__.spawn`, and *result*, a `Recver`_
+        for what *f* returns, or raises.
+        """
+        body = dump_call(f, a, kw)
+
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        result_r, result_w = os.pipe()
+
+        sender, recver = self.hub.queue(1)
+        self.requests.send(
+            (body, (stdin_r, stdout_w, stderr_w, result_w), sender))
+        child = recver.recv()
+
+        child.stdin = self.hub.io.fd_out(stdin_w)
+        child.stdout = self.hub.io.fd_in(stdout_r)
+        child.stderr = self.hub.io.fd_in(stderr_r)
+        child.result = self.collect(result_r)
+        return child
+
+    def collect(self, fd):
+        results = self.hub.io.fd_in(fd)
+        sender, recver = self.hub.queue(1)
+
+        @self.hub.spawn
+        def _():
+            try:
+                n, = FRAME.unpack(results.recv_n(FRAME.size))
+                sender.send(pickle.loads(bytes(results.recv_n(n))))
+            except vanilla.exception.Halt:
+                sender.send(vanilla.exception.Closed('worker exited'))
+                return
+            # the worker closes its end as it exits
+            for _ in results:
+                pass
+
+        return recver
+
+    def writer(self):
+        for body, fds, sender in self.requests.recver:
+            # the descriptors ride along with the frame's length
+            head = FRAME.pack(len(body))
+            ancillary = [(
+                socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+            while True:
+                try:
+                    self.sock.sendmsg([head], ancillary)
+                    break
+                except (socket.error, OSError) as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    self.ctl.sender.gate.clear().recv()
+            for fd in fds:
+                os.close(fd)
+            self.pending.append(sender)
+            self.ctl.send(body)
+
+    def reader(self):
+        try:
+            while True:
+                n, = FRAME.unpack(self.ctl.recv_n(FRAME.size))
+                message = pickle.loads(bytes(self.ctl.recv_n(n)))
+                if message[0] == 'spawned':
+                    # registered here, as its exit can be reported before
+                    # the spawn waiting for it wakes
+                    child = self.Child(self.hub, message[1])
+                    self.children[child.pid] = child
+                    self.pending.popleft().send(child)
+                elif message[0] == 'exited':
+                    _, pid, status = message
+                    self.children.pop(pid).exited(status)
+        except vanilla.exception.Halt:
+            pass
+        # the workers die along with the template
+        while self.pending:
+            self.pending.popleft().send(
+                vanilla.exception.Closed('template exited'))
+        for child in self.children.values():
+            child.exited(signal.SIGTERM)
+        self.children = {}
+        self.requests.close()
+
+    def close(self):
+        """
+        Stops the template, which stops its workers, and waits for it to
+        exit.
+        """
+        self.ctl.close()
+        self.template.done.recv()
+
+    # the template process
+
+    @staticmethod
+    def main(ours, sock, preload):
+        ours.close()
+        for name in preload:
+            importlib.import_module(name)
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        # SIGCHLD only needs to wake the select below
+        wake_r, wake_w = os.pipe()
+        for fd in (wake_r, wake_w):
+            vanilla.io.unblock(fd)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wake_w)
+
+        space = socket.CMSG_SPACE(WORKER_FDS * array.array('i').itemsize)
+        while True:
+            try:
+                ready, _, _ = select.select([sock, wake_r], [], [])
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if wake_r in ready:
+                while True:
+                    try:
+                        os.read(wake_r, 4096)
+                    except OSError:
+                        break
+                Zygote.reap(sock)
+
+            if sock in ready:
+                head, ancillary, _, _ = sock.recvmsg(FRAME.size, space)
+                if not head:
+                    return
+                head += recv_exactly(sock, FRAME.size - len(head))
+                fds = array.array('i')
+                for level, kind, data in ancillary:
+                    fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+                body = recv_exactly(sock, FRAME.unpack(head)[0])
+
+                pid = os.fork()
+                if pid == 0:
+                    Zygote.worker(sock, (wake_r, wake_w), list(fds), body)
+                for fd in fds:
+                    os.close(fd)
+                sock.sendall(frame(pickle.dumps(('spawned', pid))))
+
+    @staticmethod
+    def reap(sock):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            sock.sendall(frame(pickle.dumps(('exited', pid, status))))
+
+    @staticmethod
+    def worker(sock, wake, fds, body):
+        code = 0
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            sock.close()
+            for fd in wake:
+                os.close(fd)
+            set_pdeathsig()
+
+            stdin, stdout, stderr, results = fds
+            for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2)):
+                os.dup2(fd, target)
+                os.close(fd)
+            sys.stdin = io.open(0, 'r', closefd=False)
+            sys.stdout = io.open(1, 'w', buffering=1, closefd=False)
+            sys.stderr = io.open(2, 'w', buffering=1, closefd=False)
+
+            try:
+                f, a, kw = load_call(body)
+                result = f(*a, **kw)
+            except Exception as e:
+                # as an uncaught exception would be, in a process of its own
+                traceback.print_exc()
+                result = e
+                code = 1
+
+            try:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                data = pickle.dumps(e, pickle.HIGHEST_PROTOCOL)
+                code = 1
+            write_all(results, frame(data))
+        except BaseException:
+            code = 1
+        finally:
+            for f in (sys.stdout, sys.stderr):
+                try:
+                    f.flush()
+                except Exception:
+                    pass
+            os._exit(code)
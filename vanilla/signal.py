@@ -13,15 +13,19 @@ class __plugin__:
     def start(self):
         assert not self.fd_w
         r, self.fd_w = os.pipe()
-        self.recver = self.hub.io.fd_in(r)
+        recver = self.recver = self.hub.io.fd_in(r)
 
         @self.hub.spawn
         def _():
-            for data in self.recver:
+            for data in recver:
                 for sig in data:
-                    self.mapper[sig].send(sig)
-            self.recver.close()
-            self.fd_w = self.recver = None
+                    if sig in self.mapper:
+                        self.mapper[sig].send(sig)
+            recver.close()
+            # signals may have been captured again, on a new pipe, while
+            # this one was closing
+            if self.recver is recver:
+                self.recver = None
 
     def capture(self, sig):
         if not self.fd_w:
@@ -43,7 +47,8 @@ class __plugin__:
         signal.signal(sig, signal.SIG_DFL)
         del self.mapper[sig]
         if not self.mapper:
-            os.close(self.fd_w)
+            fd_w, self.fd_w = self.fd_w, None
+            os.close(fd_w)
             # give the recv side a chance to close
             self.hub.sleep(0)
 
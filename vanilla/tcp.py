@@ -1,22 +1,58 @@
+import collections
+import itertools
 import socket
 import errno
+import os
 
 import vanilla.exception
 import vanilla.poll
 
 
+# milliseconds to wait for a connection attempt before racing the next
+# address, when connecting with happy_eyeballs
+ATTEMPT_DELAY = 250
+
+
+def bind(port=0, host='127.0.0.1', reuse_port=False, listen=True):
+    """
+    Returns a TCP socket bound to *host*:*port*, and listening unless
+    *listen* is False.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    if listen:
+        sock.listen(socket.SOMAXCONN)
+    return sock
+
+
 class __plugin__:
     def __init__(self, hub):
         self.hub = hub
 
-    def listen(self, port=0, host='127.0.0.1'):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((host, port))
-        sock.listen(socket.SOMAXCONN)
+    def listen(self, port=0, host='127.0.0.1', reuse_port=False, **kw):
+        """
+        Listens on *host*:*port* and returns a `Recver`_ of connections. Any
+        keyword arguments, such as *reads*, are passed to
+        :meth:`vanilla.io.__plugin__.socket` for each connection.
+
+        With *reuse_port*, the socket is bound with SO_REUSEPORT, so several
+        hubs, or processes, can listen on the same port and the kernel
+        spreads the incoming connections between them.
+        """
+        return self.accept(bind(port, host, reuse_port=reuse_port), **kw)
+
+    def accept(self, sock, **kw):
+        """
+        Returns a `Recver`_ of the connections accepted on *sock*, a socket
+        which is already listening, such as one inherited from a parent
+        process. The socket is closed along with the Recver.
+        """
         sock.setblocking(0)
 
-        port   = sock.getsockname()[1]
+        port = sock.getsockname()[1]
         server = self.hub.register(sock.fileno(), vanilla.poll.POLLIN)
 
         @server.pipe
@@ -25,7 +61,7 @@ class __plugin__:
                 while True:
                     try:
                         conn, host = sock.accept()
-                        downstream.send(self.hub.io.socket(conn))
+                        downstream.send(self.hub.io.socket(conn, **kw))
                     except (socket.error, OSError) as e:
                         if e.errno == errno.EAGAIN:
                             break
@@ -37,8 +73,170 @@ class __plugin__:
         server.port = port
         return server
 
-    def connect(self, port, host='127.0.0.1'):
-        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # TODO: this shouldn't block on the connect
-        conn.connect((host, port))
-        return self.hub.io.socket(conn)
+    def connect(
+            self, port, host='127.0.0.1', timeout=-1, happy_eyeballs=False,
+            **kw):
+        """
+        Connects to *host*:*port* without blocking the hub and returns a
+        `Pair`_ for the connection. Any further keyword arguments are passed to
+        :meth:`vanilla.io.__plugin__.socket`.
+
+        *timeout* is the time in milliseconds allowed for the whole connect,
+        including resolving *host*; a `Timeout`_ is raised if it expires. When
+        *host* resolves to several addresses they're tried in turn. With
+        *happy_eyeballs*, the attempts are raced instead: a new attempt is
+        started every ATTEMPT_DELAY milliseconds, or as soon as the previous
+        one fails, and the first connection established wins.
+        """
+        deadline = self.hub.now() + timeout / 1000.0 if timeout > -1 else None
+
+        def remaining():
+            if deadline is None:
+                return -1
+            left = deadline - self.hub.now()
+            if left <= 0:
+                raise vanilla.exception.Timeout('timeout: %s' % timeout)
+            return left * 1000
+
+        addrs = self.resolve(host, port, remaining())
+
+        if happy_eyeballs:
+            conn = self.race(addrs, remaining)
+        else:
+            for i, (family, addr) in enumerate(addrs):
+                try:
+                    conn = self.attempt(family, addr, remaining())
+                    break
+                except (socket.error, OSError):
+                    if i == len(addrs) - 1:
+                        raise
+
+        return self.hub.io.socket(conn, **kw)
+
+    def resolve(self, host, port, timeout=-1):
+        """
+        Returns a list of (family, address) to try when connecting to
+        *host*:*port*, alternating between address families as RFC 8305
+        recommends.
+
+        Literal addresses are resolved directly. Looking up a name can block,
+        so it's done on a separate thread, waiting up to *timeout*
+        milliseconds for the answer.
+        """
+        try:
+            infos = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            def lookup():
+                try:
+                    return socket.getaddrinfo(
+                        host, port, 0, socket.SOCK_STREAM)
+                except Exception as e:
+                    return e
+            infos = self.hub.thread.call(lookup).recv(timeout=timeout)
+            if isinstance(infos, Exception):
+                raise infos
+
+        families = collections.OrderedDict()
+        for family, _, _, _, addr in infos:
+            families.setdefault(family, []).append((family, addr))
+        addrs = []
+        for group in itertools.zip_longest(*families.values()):
+            addrs.extend(x for x in group if x is not None)
+        return addrs
+
+    def attempt(self, family, addr, timeout=-1, waiting=None):
+        """
+        Makes a single non-blocking connect to *addr*, pausing until the
+        socket is writable. Returns the connected socket, or raises the
+        connect's error.
+
+        While it's paused, the attempt's descriptor is kept in the set
+        *waiting*, if given. Removing it and unregistering the descriptor
+        cancels the attempt.
+        """
+        conn = socket.socket(family, socket.SOCK_STREAM)
+        conn.setblocking(0)
+        try:
+            err = conn.connect_ex(addr)
+            if err in (errno.EINPROGRESS, errno.EAGAIN):
+                fileno = conn.fileno()
+                pollout = self.hub.register(fileno, vanilla.poll.POLLOUT)
+                if waiting is not None:
+                    waiting.add(fileno)
+                try:
+                    pollout.recv(timeout=timeout)
+                except vanilla.exception.Halt:
+                    # a failed connect is reported as an error on the
+                    # descriptor, which closes pollout. SO_ERROR has the
+                    # reason
+                    pass
+                finally:
+                    self.hub.unregister(fileno)
+                if waiting is not None:
+                    if fileno not in waiting:
+                        raise vanilla.exception.Abandoned('cancelled')
+                    waiting.discard(fileno)
+                err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def race(self, addrs, remaining):
+        results = self.hub.queue(len(addrs))
+        waiting = set()
+        # set once the race is over, so late attempts don't start or report
+        done = []
+
+        def attempt(family, addr):
+            if done:
+                return
+            try:
+                conn = self.attempt(family, addr, remaining(), waiting=waiting)
+            except vanilla.exception.Abandoned:
+                return
+            except Exception as e:
+                conn = e
+            if done:
+                if not isinstance(conn, Exception):
+                    conn.close()
+                return
+            results.send(conn)
+
+        pending = list(addrs)
+        failed = 0
+        try:
+            while True:
+                if pending:
+                    self.hub.spawn(attempt, *pending.pop(0))
+
+                wait = remaining()
+                if pending and not -1 < wait < ATTEMPT_DELAY:
+                    wait = ATTEMPT_DELAY
+
+                try:
+                    return results.recv(timeout=wait)
+                except vanilla.exception.Timeout:
+                    if not pending:
+                        raise
+                except (socket.error, OSError):
+                    failed += 1
+                    if failed == len(addrs):
+                        raise
+        finally:
+            done.append(True)
+            # cancel the attempts still in flight
+            for fileno in list(waiting):
+                waiting.discard(fileno)
+                self.hub.unregister(fileno)
+            # and close any which connected after the winner
+            while True:
+                try:
+                    results.recv(timeout=0).close()
+                except vanilla.exception.Timeout:
+                    break
+                except (socket.error, OSError):
+                    pass
@@ -2,9 +2,13 @@ import collections
 import threading
 import os
 
-from Queue import Queue
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 import vanilla
+import vanilla.exception
 
 from vanilla import message
 
@@ -12,33 +16,79 @@ from vanilla.exception import Closed
 
 
 class Pipe:
+    """
+    Carries items sent from other OS threads to a hub. Items are queued on a
+    deque, and the hub is only woken when the deque goes from empty to
+    non-empty, rather than once per item. Each wakeup drains everything
+    queued since the last one. Wakeups go over an eventfd where the platform
+    has one, and an os.pipe otherwise.
+    """
     class Sender:
-        def __init__(self, q, w):
+        def __init__(self, q, fd, wake):
             self.q = q
-            self.w = w
+            # the sender's own descriptor for wakeups; only close() closes
+            # it, under the lock, so a send can't race the hub closing its
+            # end and write to a closed, or reused, fd
+            self.fd = fd
+            self.wake = wake
+            # set while a wakeup is outstanding, so bursts cost one write
+            self.signalled = False
+            self.closed = False
+            self.lock = threading.Lock()
 
         def send(self, item, timeout=-1):
             self.q.append(item)
-            os.write(self.w, chr(1).encode())
+            if self.signalled:
+                return
+            with self.lock:
+                if not self.signalled and not self.closed:
+                    self.signalled = True
+                    self.wake()
+
+        def drained(self):
+            # called by the hub before it drains the deque; anything sent
+            # after this wakes it again
+            with self.lock:
+                self.signalled = False
+
+        def close(self):
+            # called by the hub once it's done with the pipe; anything sent
+            # after this is dropped
+            with self.lock:
+                if not self.closed:
+                    self.closed = True
+                    os.close(self.fd)
 
     def __new__(cls, hub):
-        r, w = os.pipe()
+        if hasattr(os, 'eventfd'):
+            r = os.eventfd(0, os.EFD_CLOEXEC)
+            w = os.dup(r)
+
+            def wake():
+                os.eventfd_write(w, 1)
+        else:
+            r, w = os.pipe()
+
+            def wake():
+                os.write(w, b'\x01')
+
         q = collections.deque()
 
-        sender = Pipe.Sender(q, w)
+        sender = Pipe.Sender(q, w, wake)
 
         r = hub.io.fd_in(r)
 
         @r.pipe
         def recver(r, out):
-            for s in r:
-                for ch in s:
-                    ch = ord(ch)
-                    if not ch:
-                        break
-                    out.send(q.popleft())
-            r.close()
-            out.close()
+            try:
+                for _ in r:
+                    sender.drained()
+                    while q:
+                        out.send(q.popleft())
+            finally:
+                sender.close()
+                r.close()
+                out.close()
 
         return message.Pair(sender, recver)
 
@@ -56,54 +106,243 @@ class Wrap:
 
 
 class Pool:
-    def __init__(self, hub, size):
+    """
+    Runs calls on a pool of up to *size* OS threads. Threads are started as
+    calls come in and none are idle, and stop again once they've been idle
+    for *idle* milliseconds, down to *minimum*.
+
+    At most *size* + *backlog* calls are in flight at a time; beyond that,
+    :meth:`call` pauses the calling green thread, rather than blocking the
+    hub, until a call completes. *backlog* defaults to *size*.
+
+    Each call returns a `Recver`_ for its result. If the call raises, the
+    exception is raised by the Recver instead. Closing the Recver, or
+    dropping it, before the call has started cancels it.
+    """
+    def __init__(self, hub, size, backlog=None, minimum=0, idle=10000):
         self.hub = hub
         self.size = size
+        self.backlog = size if backlog is None else backlog
+        self.minimum = minimum
+        self.idle = idle
 
-        self.parent = hub.thread.pipe().consume(
-            lambda (sender, item): sender.send(item))
+        self.parent = hub.thread.pipe().consume(self.deliver)
+        # a slot is taken for each call in flight
+        self.slots = hub.queue(self.size + self.backlog)
 
         self.requests = Queue()
         self.closed = False
+
+        # guards the thread counts, which are shared with the threads
+        self.lock = threading.Lock()
         self.threads = 0
+        self.waiting = 0
 
-        for i in xrange(size):
-            t = threading.Thread(target=self.runner)
-            t.daemon = True
-            t.start()
-            self.threads += 1
+        for i in range(minimum):
+            self.grow()
 
     def wrap(self, target):
         return Wrap(self, target)
 
+    def grow(self):
+        with self.lock:
+            self.threads += 1
+        t = threading.Thread(target=self.runner)
+        t.daemon = True
+        t.start()
+
     def runner(self):
         while True:
-            item = self.requests.get()
-            if type(item) == Closed:
-                self.threads -= 1
-                if self.threads <= 0:
-                    # TODO: fix up shutdown
-                    self.parent.close()
-                return
+            with self.lock:
+                self.waiting += 1
+            try:
+                item = self.requests.get(timeout=self.idle / 1000.0)
+            except Empty:
+                item = None
+            with self.lock:
+                self.waiting -= 1
+                if item is None:
+                    if self.threads <= self.minimum:
+                        continue
+                    # shrink
+                    self.threads -= 1
+                    return
+                if type(item) is Closed:
+                    self.threads -= 1
+                    if not self.threads:
+                        # the hub closes the parent pipe once it's drained
+                        self.parent.send((None, None))
+                    return
 
             sender, f, a, kw = item
-            self.parent.send((sender, f(*a, **kw)))
-            self.requests.task_done()
+            if sender.halted:
+                # cancelled before it started
+                result = None
+            else:
+                try:
+                    result = f(*a, **kw)
+                except Exception as e:
+                    result = e
+            self.parent.send((sender, result))
+
+    def deliver(self, response):
+        sender, result = response
+        if sender is None:
+            self.parent.close()
+            return
+        self.slots.recv()
+        # the result waits on its own green thread until it's received, so
+        # a slow caller doesn't hold up the rest
+        self.hub.spawn(self.resolve, sender, result)
+
+    def resolve(self, sender, result):
+        try:
+            sender.send(result)
+        except vanilla.exception.Halt:
+            pass
 
     def call(self, f, *a, **kw):
         if self.closed:
             raise Closed
+        self.slots.send(None)
         sender, recver = self.hub.pipe()
         self.requests.put((sender, f, a, kw))
+        with self.lock:
+            grow = self.threads < self.size and \
+                self.requests.qsize() > self.waiting
+        if grow:
+            self.grow()
         return recver
 
+    def imap(self, f, iterable):
+        """
+        Calls *f* with each item of *iterable* and yields the results in
+        order, keeping as many calls in flight as the pool allows.
+        """
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(self.call(f, item))
+            if len(pending) >= self.size + self.backlog:
+                yield pending.popleft().recv()
+        while pending:
+            yield pending.popleft().recv()
+
+    def map(self, f, iterable):
+        return list(self.imap(f, iterable))
+
     def close(self):
         self.closed = True
-        for i in xrange(self.size):
+        with self.lock:
+            threads = self.threads
+        if not threads:
+            self.parent.close()
+        for i in range(threads):
             # tell thread pool to stop when they have finished the last request
             self.requests.put(Closed())
 
 
+class Runtime:
+    """
+    Runs *size* hubs, each on its own thread, so that their work is spread
+    over several cores where the GIL allows, such as in system calls.
+
+    Work is sent to a hub with :meth:`spawn`, :meth:`broadcast` or
+    :meth:`call`. The Sender of a ``hub.thread.pipe()`` can be used from any
+    thread, so it's how hubs send each other messages: a hub creates the
+    pipe, keeps its Recver and hands out its Sender.
+    """
+    def __init__(self, hub, size):
+        self.hub = hub
+        self.hubs = []
+        self.inboxes = []
+        self.threads = []
+        # spreads dispatched work over the hubs
+        self.next = 0
+
+        ready = hub.thread.pipe()
+        for i in range(size):
+            t = threading.Thread(target=self.bootstrap, args=(ready.sender,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        for i in range(size):
+            h, inbox = ready.recver.recv()
+            self.hubs.append(h)
+            self.inboxes.append(inbox)
+
+    def bootstrap(self, ready):
+        h = vanilla.Hub()
+        inbox = h.thread.pipe()
+        ready.send((h, inbox.sender))
+        for f, a in inbox.recver:
+            if f is None:
+                break
+            h.spawn(f, h, *a)
+        h.stop()
+
+    def spawn(self, i, f, *a):
+        """
+        Runs *f* with the hub and *a* on a new green thread on the
+        *i*'th hub. This can be called from any thread.
+        """
+        self.inboxes[i].send((f, a))
+
+    def dispatch(self, f, *a):
+        """
+        Spawns *f* with the hub and *a* on the next hub in turn.
+        """
+        i = self.next
+        self.next = (i + 1) % len(self.inboxes)
+        self.spawn(i, f, *a)
+
+    def broadcast(self, f, *a):
+        """
+        Spawns *f* with the hub and *a* on every hub.
+        """
+        for i in range(len(self.inboxes)):
+            self.spawn(i, f, *a)
+
+    def call(self, i, f, *a):
+        """
+        Runs *f* with the hub and *a* on the *i*'th hub, and returns a
+        `Recver`_ on the runtime's own hub for the result.
+        """
+        sender, recver = self.hub.thread.pipe()
+
+        def run(h, *a):
+            try:
+                result = f(h, *a)
+            except Exception as e:
+                result = e
+            sender.send(result)
+
+        self.spawn(i, run, *a)
+        return recver
+
+    def listen(self, serve, port=0, host='127.0.0.1', **kw):
+        """
+        Listens on *host*:*port* from every hub with SO_REUSEPORT, and spawns
+        *serve(hub, conn)* on the accepting hub for each connection. Returns
+        the port, which is picked by the first hub when *port* is 0.
+        """
+        def start(h, port):
+            server = h.tcp.listen(port, host, reuse_port=True, **kw)
+            server.consume(lambda conn: h.spawn(serve, h, conn))
+            return server.port
+
+        port = self.call(0, start, port).recv()
+        started = [self.call(i, start, port) for i in range(1, len(self.hubs))]
+        for recver in started:
+            recver.recv()
+        return port
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.send((None, None))
+        for t in self.threads:
+            t.join()
+
+
 class __plugin__:
     def __init__(self, hub):
         self.hub = hub
@@ -120,8 +359,18 @@ class __plugin__:
         self.t.start()
         return recver
 
-    def pool(self, size):
-        return Pool(self.hub, size)
+    def pool(self, size, backlog=None, minimum=0, idle=10000):
+        """
+        Returns a `Pool` of up to *size* threads.
+        """
+        return Pool(
+            self.hub, size, backlog=backlog, minimum=minimum, idle=idle)
+
+    def runtime(self, size):
+        """
+        Returns a `Runtime` of *size* hubs, each on its own thread.
+        """
+        return Runtime(self.hub, size)
 
     def spawn(self, f, *a):
         def bootstrap(parent, f, a):